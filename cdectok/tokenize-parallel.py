@@ -1,24 +1,16 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import gzip
-import math
 import os
-import shutil
-import subprocess
 import sys
-import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lputil import TokenizerPool, lineshards
 
 DEFAULT_JOBS = 8
-DEFAULT_TMP = '/tmp'
 
 TOKENIZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tokenize-anything.sh')
 
-def gzopen(f):
-    return gzip.open(f) if f.endswith('.gz') else open(f)
-
-def wc(f):
-    return sum(1 for line in gzopen(f))
-
 def main(argv):
 
     if len(argv[1:]) < 1:
@@ -28,46 +20,20 @@ def main(argv):
 
     in_file = argv[1]
     jobs = int(argv[2]) if len(argv[1:]) > 1 else DEFAULT_JOBS
-    tmp = argv[3] if len(argv[1:]) > 2 else DEFAULT_TMP
-
-    work = tempfile.mkdtemp(prefix='tok.', dir=tmp)
-    in_wc = wc(in_file)
-    # Don't start more jobs than we have lines
-    jobs = min(jobs, in_wc)
-    lines_per = int(math.ceil(float(in_wc)/jobs))
-
-    inp = gzopen(in_file)
-    procs = []
-    files = []
-    outs = []
-    for i in range(jobs):
-        raw = os.path.join(work, 'in.{}'.format(i))
-        tok = os.path.join(work, 'out.{}'.format(i))
-        files.append(tok)
-        # Write raw batch
-        raw_out = open(raw, 'w')
-        for _ in range(lines_per):
-            line = inp.readline()
-            if not line:
-                break
-            raw_out.write(line)
-        raw_out.close()
-        # Start tokenizer
-        raw_in = open(raw)
-        tok_out = open(tok, 'w')
-        outs.append(tok_out)
-        p = subprocess.Popen(TOKENIZER, stdin=raw_in, stdout=tok_out)
-        procs.append(p)
-
-    # Cat output of each tokenizer as it finishes
-    for (p, f, o) in zip(procs, files, outs):
-        p.wait()
-        o.close()
-        for line in open(f):
-            sys.stdout.write(line)
-
-    # Cleanup
-    shutil.rmtree(work)
+    # shards go to the tokenizers through pipes, so temp-dir is no longer used
+
+    pool = TokenizerPool([TOKENIZER], jobs)
+    if in_file.endswith('.gz'):
+        # one shard per job, as for plain files
+        with gzip.open(in_file) as fh:
+            lines = fh.readlines()
+        shards = lineshards(lines, max(1, -(-sum(map(len, lines)) // jobs)))
+    else:
+        shards = pool.shards(in_file)
+    # Cat output of each shard in order; later ones run on meanwhile
+    for tok in pool.tokenize(shards):
+        sys.stdout.buffer.write(tok)
+    sys.stdout.buffer.flush()
 
 if __name__ == '__main__':
     main(sys.argv)
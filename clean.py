@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os.path
+import subprocess
+from lputil import Cleaner
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+# in-process clean.sh: wildeclean-v1.0.pl -r, then nfkc.py, one pass over the data
+
+def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
+  ''' add the switches --arg and --no-arg that set parser.arg to true/false, respectively'''
+  group = parser.add_mutually_exclusive_group()
+  dest = arg if dest is None else dest
+  group.add_argument('--%s' % arg, dest=dest, action='store_true', default=default, help=help)
+  group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
+
+def clean(infile, outfile, report=True):
+  ''' clean infile (binary) onto outfile (text) '''
+  cleaner = Cleaner(report)
+  for line in infile:
+    text = cleaner.clean(line)
+    if text is not None:
+      outfile.write(text)
+  outfile.flush()
+  cleaner.writereport()
+
+def check(infile, cleanpath):
+  ''' compare this and cleanpath on infile; return the number of differing lines '''
+  with open(infile, 'rb') as ifh:
+    cleaner = Cleaner()
+    ours = [cleaner.clean(line) for line in ifh]
+  ours = ''.join(line for line in ours if line is not None).splitlines(True)
+  theirs = subprocess.run([cleanpath, infile], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+  theirs = theirs.stdout.decode('utf-8').splitlines(True)
+  bad = 0
+  for linenum, (ourline, theirline) in enumerate(zip(ours, theirs), start=1):
+    if ourline != theirline:
+      bad += 1
+      if bad <= 10:
+        sys.stderr.write("line {}: {!r} != {!r}\n".format(linenum, ourline, theirline))
+  if len(ours) != len(theirs):
+    sys.stderr.write("{} lines != {} lines\n".format(len(ours), len(theirs)))
+    bad += abs(len(ours)-len(theirs))
+  return bad
+
+def main():
+  parser = argparse.ArgumentParser(description="wildeclean and nfkc normalize data (clean.sh, in process)",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("infile", nargs='?', default="/dev/stdin", help="input file")
+  parser.add_argument("outfile", nargs='?', default="/dev/stdout", help="output file")
+  parser.add_argument("--check", action='store_true', default=False,
+                      help="instead of cleaning, check that the output matches that of --cleanpath")
+  parser.add_argument("--cleanpath", default=os.path.join(scriptdir, 'clean.sh'),
+                      help="path to cleaning script, for --check")
+  addonoffarg(parser, 'report', help="report changes made, as wildeclean -r does", default=True)
+
+  try:
+    args = parser.parse_args()
+  except IOError as msg:
+    parser.error(str(msg))
+
+  if args.check:
+    try:
+      bad = check(args.infile, args.cleanpath)
+    except subprocess.CalledProcessError as e:
+      sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
+      sys.exit(1)
+    if bad > 0:
+      sys.stderr.write("{} lines differ from {}\n".format(bad, args.cleanpath))
+      sys.exit(1)
+    sys.stderr.write("output matches {}\n".format(args.cleanpath))
+    return
+
+  with open(args.infile, 'rb') as infile, open(args.outfile, 'w') as outfile:
+    clean(infile, outfile, args.report)
+
+if __name__ == '__main__':
+  main()
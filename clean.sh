@@ -13,4 +13,6 @@ nfkc=$SCRIPTDIR/nfkc.py
 
 IN=${1:-/dev/stdin}
 OUT=${2:-/dev/stdout}
-$nfkc -i <($wilde -r < $IN) -o $OUT
+# processes for the normalization half
+JOBS=${CLEAN_JOBS:-4}
+$nfkc -j $JOBS -i <($wilde -r < $IN) -o $OUT
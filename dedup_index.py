@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os
+import os.path
+import re
+import gzip
+import json
+import zlib
+import hashlib
+from math import ceil, log
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from lputil import mkdir_p, nfkc
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+# near-duplicate and train/test contamination index over extracted parallel data. each side of each
+# segment gets an exact hash and a minhash signature of its normalized text; segments that share a hash,
+# or an lsh band and most of their signature, are duplicates of each other. mono data only gets its
+# exact hashes, in a bloom filter, so it can be as big as it likes
+
+def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
+  ''' add the switches --arg and --no-arg that set parser.arg to true/false, respectively'''
+  group = parser.add_mutually_exclusive_group()
+  dest = arg if dest is None else dest
+  group.add_argument('--%s' % arg, dest=dest, action='store_true', default=default, help=help)
+  group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
+
+_nonword = re.compile(r"[\W_]+")
+
+def normalize(line):
+  ''' the text duplicates are compared on: nfkc, casefolded, punctuation and spacing collapsed '''
+  return _nonword.sub(' ', nfkc(line).casefold()).strip()
+
+def exacthash(text):
+  return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+_prime = (1 << 31) - 1
+
+def permutations(perms, seed=1):
+  ''' the (a, b) of each hash a*x+b mod 2^31-1, for x < 2^31, so nothing overflows 64 bits '''
+  rng = np.random.RandomState(seed)
+  return rng.randint(1, _prime, perms).astype(np.uint64), rng.randint(0, _prime, perms).astype(np.uint64)
+
+def minhash(text, shingle, a, b):
+  ''' minhash signature of the character shingles of text '''
+  grams = set(text[i:i+shingle] for i in range(max(len(text)-shingle+1, 1)))
+  x = np.fromiter((zlib.crc32(gram.encode('utf-8')) % _prime for gram in grams), dtype=np.uint64, count=len(grams))
+  return ((np.outer(x, a)+b) % _prime).min(axis=0).astype(np.uint32)
+
+def hashchunk(task):
+  ''' exact hashes, signatures (if perms) and whether each line is long enough to count, for a chunk of lines '''
+  lines, minlength, shingle, perms = task
+  a, b = permutations(perms)
+  hashes = np.zeros(len(lines), dtype=np.uint64)
+  sigs = np.zeros((len(lines), perms), dtype=np.uint32)
+  valid = np.zeros(len(lines), dtype=bool)
+  for i, line in enumerate(lines):
+    text = normalize(line)
+    hashes[i] = exacthash(text)
+    valid[i] = len(text.split()) >= minlength
+    if perms > 0 and valid[i]:
+      sigs[i] = minhash(text, shingle, a, b)
+  return hashes, sigs, valid
+
+def readchunks(path, size):
+  ''' lists of size lines of path, newlines stripped '''
+  fh = gzip.open(path, 'rt', encoding='utf-8', errors='replace') if path.endswith(".gz") else \
+       open(path, encoding='utf-8', errors='replace')
+  with fh:
+    lines = (line.rstrip('\n') for line in fh)
+    while True:
+      chunk = list(islice(lines, size))
+      if len(chunk) == 0:
+        return
+      yield chunk
+
+def stamp(paths, **params):
+  ''' what an index of paths depends on; it's rebuilt when this changes '''
+  return json.loads(json.dumps({"inputs":[[path, os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths],
+                                "params":params}))
+
+def indexfile(path, pool, indexdir, chunksize, minlength, shingle, perms):
+  ''' (hashes, signatures, valid) of every line of path, from indexdir if it's up to date '''
+  base = os.path.join(indexdir, os.path.basename(path))
+  want = stamp([path], minlength=minlength, shingle=shingle, perms=perms)
+  if os.path.exists(base+".json") and os.path.exists(base+".npz"):
+    with open(base+".json") as sfh:
+      if json.load(sfh) == want:
+        saved = np.load(base+".npz")
+        return saved['hashes'], saved['sigs'], saved['valid']
+  parts = list(zip(*pool.map(hashchunk, ((chunk, minlength, shingle, perms) for chunk in readchunks(path, chunksize)))))
+  if len(parts) == 0:
+    parts = [[np.zeros(0, dtype=np.uint64)], [np.zeros((0, perms), dtype=np.uint32)], [np.zeros(0, dtype=bool)]]
+  hashes, sigs, valid = (np.concatenate(part) for part in parts)
+  np.savez(base+".npz", hashes=hashes, sigs=sigs, valid=valid)
+  with open(base+".json", 'w') as sfh:
+    json.dump(want, sfh)
+  return hashes, sigs, valid
+
+class BloomFilter(object):
+  ''' set of 64-bit hashes with false positives at about errorrate '''
+  def __init__(self, count, errorrate=0.001):
+    self.size = max(64, int(ceil(-max(count, 1)*log(errorrate)/log(2)**2)))
+    self.k = max(1, int(round(self.size/max(count, 1)*log(2))))
+    self.bits = np.zeros((self.size+7)//8, dtype=np.uint8)
+
+  def _positions(self, hashes):
+    low, high = hashes & np.uint64(0xffffffff), hashes >> np.uint64(32)
+    return [(low+np.uint64(i)*high) % np.uint64(self.size) for i in range(self.k)]
+
+  def add(self, hashes):
+    for pos in self._positions(hashes):
+      np.bitwise_or.at(self.bits, pos >> np.uint64(3), (1 << (pos & np.uint64(7))).astype(np.uint8))
+
+  def contains(self, hashes):
+    ''' which of hashes are (probably) in the set '''
+    ret = np.ones(len(hashes), dtype=bool)
+    for pos in self._positions(hashes):
+      ret &= (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1 == 1
+    return ret
+
+  def save(self, path):
+    np.savez(path, bits=self.bits, size=self.size, k=self.k)
+
+  @classmethod
+  def load(cls, path):
+    saved = np.load(path)
+    ret = cls.__new__(cls)
+    ret.bits, ret.size, ret.k = saved['bits'], int(saved['size']), int(saved['k'])
+    return ret
+
+def countlines(path):
+  opener = gzip.open if path.endswith(".gz") else open
+  with opener(path, 'rb') as fh:
+    return sum(block.count(b'\n') for block in iter(lambda: fh.read(1 << 20), b''))
+
+def monobloom(paths, pool, outdir, chunksize, errorrate):
+  ''' bloom filter of the exact hashes of every line of the mono files, from outdir if it's up to date '''
+  base = os.path.join(outdir, "mono.bloom")
+  want = stamp(paths, errorrate=errorrate)
+  if os.path.exists(base+".json") and os.path.exists(base+".npz"):
+    with open(base+".json") as sfh:
+      if json.load(sfh) == want:
+        return BloomFilter.load(base+".npz")
+  bloom = BloomFilter(sum(pool.map(countlines, paths)), errorrate)
+  for path in paths:
+    sys.stderr.write("hashing %s\n" % path)
+    for hashes, sigs, valid in pool.map(hashchunk, ((chunk, 0, 0, 0) for chunk in readchunks(path, chunksize))):
+      bloom.add(hashes)
+  bloom.save(base+".npz")
+  with open(base+".json", 'w') as sfh:
+    json.dump(want, sfh)
+  return bloom
+
+def monofiles(paths):
+  ''' the .flat (or .flat.gz) files named, or under the directories named '''
+  ret = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        ret.extend(os.path.join(root, file) for file in sorted(files) if file.endswith((".flat", ".flat.gz")))
+    else:
+      ret.append(path)
+  return ret
+
+def exactedges(hashes, valid):
+  ''' (i, j) of valid lines with the same hash '''
+  idx = np.flatnonzero(valid)
+  order = idx[np.argsort(hashes[idx], kind='stable')]
+  same = hashes[order[1:]] == hashes[order[:-1]]
+  return order[:-1][same], order[1:][same]
+
+def nearedges(sigs, valid, bands, threshold):
+  ''' (i, j) of valid lines that share a band of their signatures and agree on at least threshold of it all;
+  each line of a band bucket is compared to the bucket's first line only '''
+  idx = np.flatnonzero(valid)
+  rows = sigs.shape[1]//bands
+  mult = np.random.RandomState(2).randint(1, 1 << 62, rows, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+  firsts, seconds = [], []
+  for band in range(bands):
+    keys = (sigs[idx, band*rows:(band+1)*rows].astype(np.uint64)*mult).sum(axis=1, dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys, members = keys[order], idx[order]
+    starts = np.r_[True, keys[1:] != keys[:-1]] if len(keys) > 0 else np.zeros(0, dtype=bool)
+    leaders = members[np.maximum.accumulate(np.where(starts, np.arange(len(keys)), 0))]
+    others = ~starts
+    sims = (sigs[members[others]] == sigs[leaders[others]]).mean(axis=1) if others.any() else np.zeros(0)
+    close = sims >= threshold
+    firsts.append(leaders[others][close])
+    seconds.append(members[others][close])
+  # a pair usually shares several bands
+  pairs = np.unique(np.stack([np.concatenate(firsts), np.concatenate(seconds)], axis=1), axis=0)
+  return pairs[:, 0], pairs[:, 1]
+
+def clusters(count, edges):
+  ''' the root of each of count items once everything in edges is joined '''
+  parent = np.arange(count)
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+  for firsts, seconds in edges:
+    for i, j in zip(firsts.tolist(), seconds.tolist()):
+      ri, rj = find(i), find(j)
+      if ri != rj:
+        parent[max(ri, rj)] = min(ri, rj)
+  return np.array([find(i) for i in range(count)], dtype=np.int64)
+
+def clustered(roots):
+  ''' which items share their cluster with another '''
+  uniq, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+  return counts[inverse] > 1
+
+def crosscategory(roots, cats):
+  ''' which items share their cluster with an item of another category (categories < 0 don't count) '''
+  known = cats >= 0
+  pairs = np.unique(np.stack([roots[known], cats[known]], axis=1), axis=0) if known.any() else np.zeros((0, 2), dtype=np.int64)
+  uniq, counts = np.unique(pairs[:, 0], return_counts=True)
+  return known & np.isin(roots, uniq[counts > 1])
+
+def readcats(splitdir, prefix, docids):
+  ''' category name of every segment of prefix from the selection in splitdir, or None '''
+  catfile = os.path.join(splitdir, "%s.cats" % prefix)
+  if not os.path.exists(catfile):
+    return [None]*len(docids)
+  cats = {}
+  with open(catfile) as cfh:
+    for line in cfh:
+      fields = line.rstrip('\n').split('\t')
+      cats[fields[0]] = fields[1]
+  # segment-level selections are keyed by line number
+  if os.path.exists(os.path.join(splitdir, "%s.fakeids" % prefix)):
+    return [cats.get(str(linenum)) for linenum in range(1, len(docids)+1)]
+  return [cats.get(docid) for docid in docids]
+
+def main():
+  parser = argparse.ArgumentParser(description="index extracted parallel data for duplicates, report train/test "
+                                   "contamination and write a list of segments to keep out of held-out sets",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--indir", "-i", default="./filtered", help="extracted (or filtered) parallel directory")
+  parser.add_argument("--language", "-l", help="source language three digit code")
+  parser.add_argument("--outdir", "-o", default=None, help="where the index, report and exclusion list go "
+                      "(default: dedup, next to indir)")
+  parser.add_argument("--mono", "-m", nargs='*', default=[], help="mono .flat files, or directories of them, "
+                      "to check against by exact match")
+  parser.add_argument("--splits", "-s", default=None, help="selection directory (subselect_data.py output) to "
+                      "report contamination of per category")
+  parser.add_argument("--jobs", "-j", type=int, default=4, help="processes to hash with")
+  parser.add_argument("--chunksize", type=int, default=10000, help="lines per hashing task")
+  parser.add_argument("--minlength", type=int, default=4, help="words a normalized line needs for its duplicates to count")
+  parser.add_argument("--shingle", type=int, default=5, help="characters per minhash shingle")
+  parser.add_argument("--perms", type=int, default=64, help="minhash signature length")
+  parser.add_argument("--bands", type=int, default=16, help="lsh bands the signature is cut into")
+  parser.add_argument("--threshold", type=float, default=0.8, help="signature agreement that makes a near duplicate")
+  parser.add_argument("--errorrate", type=float, default=0.001, help="false positive rate of the mono bloom filter")
+  addonoffarg(parser, 'monoexclude', default=False, help="also exclude segments found in the mono data")
+
+  try:
+    args = parser.parse_args()
+  except IOError as msg:
+    parser.error(str(msg))
+
+  if args.language is None:
+    sys.stderr.write("--language is required\n")
+    sys.exit(1)
+  if args.perms % args.bands != 0:
+    sys.stderr.write("--perms (%d) must be a multiple of --bands (%d)\n" % (args.perms, args.bands))
+    sys.exit(1)
+  indir = args.indir
+  outdir = args.outdir if args.outdir is not None else os.path.join(os.path.dirname(os.path.abspath(indir)), 'dedup')
+  indexdir = os.path.join(outdir, 'index')
+  mkdir_p(indexdir)
+
+  # every segment, in order of prefix then line
+  prefixes = sorted(man[:-len(".eng.manifest")] for man in os.listdir(indir) if man.endswith(".eng.manifest"))
+  segprefix, docids, linenums = [], [], []
+  sides = {args.language:[], 'eng':[]}
+  with ProcessPoolExecutor(args.jobs) as pool:
+    for prefix in list(prefixes):
+      flats = {lang:os.path.join(indir, 'original', "%s.original.%s.flat" % (prefix, lang)) for lang in sides}
+      if not all(os.path.exists(flat) for flat in flats.values()):
+        sys.stderr.write("skipping %s: no %s\n" % (prefix, ' or '.join(flats.values())))
+        prefixes.remove(prefix)
+        continue
+      with open(os.path.join(indir, "%s.eng.manifest" % prefix)) as mfh:
+        # the document id, as subselect_data.py takes it
+        mandocids = [line.rstrip('\n').split('\t')[1 if '\t' in line else 0] for line in mfh]
+      sys.stderr.write("indexing %s\n" % prefix)
+      for lang in sides:
+        sides[lang].append(indexfile(flats[lang], pool, indexdir, args.chunksize, args.minlength, args.shingle, args.perms))
+        if len(sides[lang][-1][0]) != len(mandocids):
+          sys.stderr.write("%s has %d lines but its manifest has %d\n" % (flats[lang], len(sides[lang][-1][0]), len(mandocids)))
+          sys.exit(1)
+      segprefix.extend([prefix]*len(mandocids))
+      docids.extend(mandocids)
+      linenums.extend(range(1, len(mandocids)+1))
+    mono = monofiles(args.mono)
+    bloom = monobloom(mono, pool, outdir, args.chunksize, args.errorrate) if len(mono) > 0 else None
+
+  count = len(docids)
+  exact, near = [], []
+  inmono = np.zeros(count, dtype=bool)
+  anyvalid = np.zeros(count, dtype=bool)
+  for lang, parts in sides.items():
+    hashes, sigs, valid = (np.concatenate([part[n] for part in parts]) if len(parts) > 0 else
+                           np.zeros((0, args.perms) if n == 1 else 0) for n in range(3))
+    exact.append(exactedges(hashes, valid))
+    near.append(nearedges(sigs, valid, args.bands, args.threshold))
+    anyvalid |= valid
+    if bloom is not None:
+      inmono |= valid & bloom.contains(hashes)
+  exactroots = clusters(count, exact)
+  nearroots = clusters(count, exact+near)
+  exactdup, neardup = clustered(exactroots), clustered(nearroots)
+
+  excluded = neardup | inmono if args.monoexclude else neardup
+  with open(os.path.join(outdir, 'exclude'), 'w') as xfh:
+    for i in np.flatnonzero(excluded).tolist():
+      xfh.write("%s\t%s\t%d\n" % (segprefix[i], docids[i], linenums[i]))
+
+  report = {"segments":count, "counted":int(anyvalid.sum()),
+            "exact":int(exactdup.sum()), "near":int(neardup.sum()), "clusters":int(len(np.unique(nearroots[neardup]))),
+            "mono":int(inmono.sum()) if bloom is not None else None,
+            "excluded":{"segments":int(excluded.sum()),
+                        "documents":len(set((segprefix[i], docids[i]) for i in np.flatnonzero(excluded).tolist()))}}
+  sys.stderr.write("%d segments, %d long enough to count: %d with exact duplicates, %d with near (or exact) "
+                   "duplicates in %d clusters\n" % (count, report["counted"], report["exact"], report["near"], report["clusters"]))
+  if bloom is not None:
+    sys.stderr.write("%d segments found in the mono data\n" % report["mono"])
+  sys.stderr.write("excluding %d segments in %d documents\n" % (report["excluded"]["segments"], report["excluded"]["documents"]))
+
+  if args.splits is not None:
+    names = []
+    for prefix in prefixes:
+      names.extend(readcats(args.splits, prefix, [docids[i] for i in range(count) if segprefix[i] == prefix]))
+    catnames = sorted(set(name for name in names if name is not None))
+    cats = np.array([catnames.index(name) if name is not None else -1 for name in names], dtype=np.int64)
+    exactcross, nearcross = crosscategory(exactroots, cats), crosscategory(nearroots, cats)
+    report["splits"] = {}
+    for n, name in enumerate(catnames):
+      incat = cats == n
+      report["splits"][name] = {"segments":int(incat.sum()), "exact":int((incat & exactcross).sum()),
+                                "near":int((incat & nearcross).sum()),
+                                "mono":int((incat & inmono).sum()) if bloom is not None else None}
+      sys.stderr.write("%s: %d segments, %d with an exact and %d with a near (or exact) duplicate in another split%s\n" % (
+        name, incat.sum(), (incat & exactcross).sum(), (incat & nearcross).sum(),
+        ", %d in the mono data" % (incat & inmono).sum() if bloom is not None else ""))
+
+  with open(os.path.join(outdir, 'report.json'), 'w') as rfh:
+    json.dump(report, rfh, indent=2)
+    rfh.write("\n")
+
+if __name__ == '__main__':
+  main()
@@ -13,8 +13,9 @@ import gzip
 import os
 import glob
 import numpy as np
+import lputil
 from lputil import mkdir_p
-import unicodedata as ud
+from itertools import islice
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -35,9 +36,12 @@ def prepfile(fh, code):
   return ret
 
 
+# any C category, format characters included
+controlcats = ("Cc", "Cf", "Cn", "Co", "Cs")
+
 def iscontrol(line):
   ''' does this line contain control characters? '''
-  return "C" in set(map(lambda x: x[0], map(ud.category, list(line))))
+  return lputil.iscontrol(line, controlcats)
 
 def main():
   parser = argparse.ArgumentParser(description="filter a file into lines with and lines without control characters",
@@ -55,11 +59,17 @@ def main():
   outfile = prepfile(args.outfile, 'w')
   rejectfile = prepfile(args.rejectfile, 'w')
   
-  for line in infile:
-    if iscontrol(line.strip()):
-      rejectfile.write(line)
-    else:
-      outfile.write(line)
+  # lines are checked a batch at a time
+  while True:
+    lines = list(islice(infile, 10000))
+    if len(lines) == 0:
+      break
+    garbage = set(lputil.garbagelines(lines, controlcats))
+    for idx, line in enumerate(lines):
+      if idx in garbage:
+        rejectfile.write(line)
+      else:
+        outfile.write(line)
     
 if __name__ == '__main__':
   main()
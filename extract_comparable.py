@@ -16,21 +16,21 @@ import datetime
 import subprocess
 from subprocess import check_call, CalledProcessError
 import shlex
-from lputil import morph_tok, getgarbagemask
+from lputil import read_ltf, ltf_segment_fields, getgarbagemask, fs_listdir, fs_open, CleanTee, tokenizerpool
 from itertools import compress
 from collections import defaultdict as dd
 
 def getclusters(indir):
   ''' get cluster mappings from xml files '''
   data = dd(lambda: dd(set))
-  for filename in os.listdir(indir):
+  for filename in fs_listdir(indir):
     # assume ltf filename
     if not filename.endswith(".xml"):
       continue
     # avoid mac meta stuff
     if filename.startswith("."):
       continue
-    with open(os.path.join(indir, filename), 'r') as ifh:
+    with fs_open(os.path.join(indir, filename), 'r') as ifh:
       try:
         xobj = ET.parse(ifh)
         for cluster in xobj.findall(".//cluster"):
@@ -42,6 +42,13 @@ def getclusters(indir):
         continue
   return data
 
+def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
+  ''' add the switches --arg and --no-arg that set parser.arg to true/false, respectively'''
+  group = parser.add_mutually_exclusive_group()
+  dest = arg if dest is None else dest
+  group.add_argument('--%s' % arg, dest=dest, action='store_true', default=default, help=help)
+  group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
+
 
 def main():
   parser = argparse.ArgumentParser(description="Extract and print comparable corpus " \
@@ -80,11 +87,14 @@ def main():
                       help="subdirectory for pos tag files")
   parser.add_argument("--cleanpath", default=os.path.join(scriptdir, 'clean.sh'),
                       help="path to cleaning script")
+  addonoffarg(parser, 'inlineclean', help="clean orig and tok as they are written instead of running --cleanpath after", default=True)
   parser.add_argument("--agiletokenizer", default=os.path.join(scriptdir, 'agiletok.sh'),
                       help="path to agile tokenizer binary")
   parser.add_argument("--cdectokenizer", default=os.path.join(scriptdir,
                                                               "cdectok.sh"),
                       help="cdec tokenizer program wrapper")
+  parser.add_argument("--tokjobs", type=int, default=4,
+                      help="tokenizer batches to run at once (0 runs the tokenizer wrappers as is)")
 
   try:
     args = parser.parse_args()
@@ -127,6 +137,8 @@ def main():
   datasets = [(args.src, srcindir, args.cdectokenizer, cdectokoutdir),
               (args.trg, trgindir, args.agiletokenizer, agiletokoutdir)]
 
+  # each language is tokenized while the next is extracted
+  tokenized = []
   for lang, indir, exttokenizer, exttokoutdir in datasets:
     inbase = lang
     man_fh = open(os.path.join(args.outdir, "%s.manifest" % inbase),'w')
@@ -138,11 +150,17 @@ def main():
       garbage_fh = open(os.path.join(garbageoutdir, "%s.flat" % inbase), 'w')
       garbage_man_fh = open(os.path.join(garbageoutdir, "%s.manifest" % inbase),'w')
     tok_fh = open(os.path.join(tokoutdir, "%s.flat" % inbase), 'w')
+    clean_orig = os.path.join(cleanorigoutdir, "%s.flat" % inbase)
+    clean_tok =  os.path.join(cleantokoutdir, "%s.flat" % inbase)
+    if args.inlineclean:
+      # raw orig->clean orig, raw tok->clean tok in the same pass
+      orig_fh = CleanTee(orig_fh, clean_orig)
+      tok_fh = CleanTee(tok_fh, clean_tok)
     morphtok_fh = open(os.path.join(morphtokoutdir,
                                            "%s.flat" % inbase), 'w')
     morph_fh = open(os.path.join(morphoutdir, "%s.flat" % inbase), 'w')
     pos_fh = open(os.path.join(posoutdir, "%s.flat" % inbase), 'w')
-    for filename in os.listdir(indir):
+    for filename in fs_listdir(indir):
       # assume ltf filename
       if not filename.endswith("ltf.xml"):
         continue
@@ -150,10 +168,9 @@ def main():
       if filename.startswith("."):
         continue
       # print info.filename
-      with open(os.path.join(indir, filename), 'r') as ifh:
+      with fs_open(os.path.join(indir, filename), 'r') as ifh:
         try:
-          xobj = ET.parse(ifh)
-          docid = xobj.findall(".//DOC")[0].get('id')
+          docid, segs = read_ltf(ifh)
           if len(clusters[lang][docid]) < 1:
             sys.stderr.write("Warning: no clusters for %s\n" % docid)
             clusid="NONE"
@@ -162,11 +179,10 @@ def main():
             if len(clset) > 1:
               sys.stderr.write("Warning: multiple clusters for %s\n" % docid)
             clusid = '_'.join(clset)
-          origlines = [ x.text+"\n" for x in xobj.findall(".//ORIGINAL_TEXT") ]
+          origlines = [ x.text+"\n" for x in segs ]
           garbagemask = getgarbagemask(origlines, disabled=args.nogarbage)
           goodmask = [not x for x in garbagemask]
-          seginfo = [ [ x.get(y) for y in ('id', 'start_char', 'end_char') ]
-                      for x in xobj.findall(".//SEG") ]
+          seginfo = [ [ x.id, x.start_char, x.end_char ] for x in segs ]
           for line in compress(origlines, garbagemask):
             orig_fh.write(line)
           for tup in compress(seginfo, garbagemask):
@@ -177,20 +193,8 @@ def main():
               garbage_fh.write(line)
             for tup in compress(seginfo, goodmask):
               garbage_man_fh.write("\t".join(map(str, [filename,docid]+tup+[clusid,]))+"\n")
-          for x in compress(xobj.findall(".//SEG"), garbagemask):
-            tokens = x.findall(".//TOKEN")
-            toktext = []
-            morphtoktext = []
-            morphtext = []
-            postext = []
-            for y in tokens:
-              if y.text is None:
-                continue
-              toktext.append(y.text)
-              postext.append(y.get("pos") or "none")
-              for mt, mtt in morph_tok(y):
-                morphtext.append(mt)
-                morphtoktext.append(mtt)
+          for x in compress(segs, garbagemask):
+            toktext, morphtoktext, morphtext, postext = ltf_segment_fields(x)
             tok_fh.write(' '.join(toktext)+"\n")
             morphtok_fh.write(' '.join(morphtoktext)+"\n")
             morph_fh.write(' '.join(morphtext)+"\n")
@@ -200,17 +204,22 @@ def main():
           continue
     orig_fh.close()
     tok_fh.close()
-    clean_orig = os.path.join(cleanorigoutdir, "%s.flat" % inbase)
-    clean_tok =  os.path.join(cleantokoutdir, "%s.flat" % inbase)
-    for inclean, outclean in zip((orig_fh.name, tok_fh.name), (clean_orig, clean_tok)):
-      cleancmd = "{cmd} {inclean} {outclean}".format(cmd=cleanpath, inclean=inclean, outclean=outclean)
-      sys.stderr.write(cleancmd+"\n")
-      try:
-        check_call(shlex.split(cleancmd))
-      except CalledProcessError as e:
-        sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
-        sys.exit(1)
+    if not args.inlineclean:
+      for inclean, outclean in zip((orig_fh.name, tok_fh.name), (clean_orig, clean_tok)):
+        cleancmd = "{cmd} {inclean} {outclean}".format(cmd=cleanpath, inclean=inclean, outclean=outclean)
+        sys.stderr.write(cleancmd+"\n")
+        try:
+          check_call(shlex.split(cleancmd))
+        except CalledProcessError as e:
+          sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
+          sys.exit(1)
 
+    tokenizer = tokenizerpool(exttokenizer, args.tokjobs)
+    if tokenizer is not None:
+      tokenized.append(tokenizer.submit_file(orig_fh.name,
+                                             os.path.join(exttokoutdir, "%s.flat.lc" % inbase),
+                                             os.path.join(exttokoutdir, "%s.flat" % inbase)))
+      continue
     ext_cmd = "%s -i %s -o %s -t %s" % (exttokenizer,
                                          orig_fh.name,
                                          os.path.join(exttokoutdir,
@@ -219,6 +228,8 @@ def main():
                                                       "%s.flat" % inbase))
     p = subprocess.Popen(shlex.split(ext_cmd))
     p.wait()
+  for future in tokenized:
+    future.result()
 
 if __name__ == '__main__':
   main()
@@ -13,17 +13,10 @@ import gzip
 import os
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 import datetime
-from lputil import funornone, is_sn
+from lputil import funornone, is_sn, fs_find, fs_exists, fs_parse
 
 # Scrape annotation files for full/simple entities and semantic annotation
 
-# http://stackoverflow.com/questions/2865278/in-python-how-to-find-all-the-files
-# -under-a-directory-including-the-files-in-s
-def recursive_file_gen(mydir):
-  for root, dirs, files in os.walk(mydir):
-    for file in files:
-      yield os.path.join(root, file)
-
 def main():
   import codecs
   parser = argparse.ArgumentParser(description="Extract and print laf annotat" \
@@ -46,18 +39,17 @@ def main():
   outfile = open(args.outfile, 'w')
   twtdir = args.extwtdir
   anndir = os.path.join(args.rootdir, 'data', 'annotation')
-  if not os.path.exists(anndir):
+  if not fs_exists(anndir):
     sys.stderr.write("No annotation directory found\n")
     sys.exit(0)
   if twtdir is not None and not os.path.exists(twtdir):
     sys.stderr.write("Warning: no {}\n".format(twtdir))
     twtdir = None
   # print anndir
-  for annfile in recursive_file_gen(anndir):
-    if annfile.endswith("laf.xml") and \
-       not os.path.basename(annfile).startswith("."):
+  for annfile in fs_find(anndir, "laf"):
+    if not os.path.basename(annfile).startswith("."):
       try:
-        xobj = ET.parse(annfile)
+        xobj = fs_parse(annfile)
       except:
         sys.stderr.write("Problem parsing "+annfile+"\n")
         continue
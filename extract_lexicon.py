@@ -10,8 +10,8 @@ import xml.etree.ElementTree as ET
 from zipfile import ZipFile as zf
 import os
 import datetime
-import shutil
 from io import TextIOWrapper
+from lputil import FileType, fs_open, fs_listdir, fs_copy
 
 class SkipEntry(Exception):
   pass
@@ -19,7 +19,7 @@ class SkipEntry(Exception):
 def main():
   import codecs
   parser = argparse.ArgumentParser(description="Extract lexicon file from xml")
-  parser.add_argument("--infiles", "-i", nargs='+', type=argparse.FileType('r'),
+  parser.add_argument("--infiles", "-i", nargs='+', type=FileType('r'),
                       help="input lexicon files")
   parser.add_argument("--outfile", "-o", help="output file")
   parser.add_argument("--version", "-v", choices=["1.4", "1.5", "il3", "il5", "il6"], default="1.5", help="dtd version")
@@ -67,7 +67,7 @@ def main():
   if args.version == "il6":
     neofiles = []
     for infile in infiles:
-      archive = zf(infile.name)
+      archive = zf(fs_open(infile.name, 'rb'))
       for info in archive.infolist():
         if info.file_size < 20:
           continue
@@ -119,10 +119,10 @@ def main():
   lexicon_dirs = set([os.path.dirname(x.name) for x in args.infiles])
   sys.stderr.write("Extracted %d entries\n" % (stats))
   for lexicon_dir in lexicon_dirs:
-    for i in os.listdir(lexicon_dir):
+    for i in fs_listdir(lexicon_dir):
       name = os.path.join(lexicon_dir, i)
       outname = '%s_%s' % (outfile, i)
-      shutil.copy(name, outname)
+      fs_copy(name, outname)
       source_fh.write("Extracted extra lexicon from %s to %s\n" % (name, outname))
 
 if __name__ == '__main__':
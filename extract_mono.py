@@ -12,9 +12,10 @@ scriptdir = os.path.dirname(os.path.abspath(__file__))
 import subprocess
 from subprocess import check_call, CalledProcessError
 import shlex
-from lputil import morph_tok, getgarbagemask
+from lputil import read_ltf, ltf_segment_fields, getgarbagemask, FileType, CleanTee, tokenizerpool
 from itertools import compress
 from io import TextIOWrapper
+from multiprocessing import Pool
 
 
 def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
@@ -25,11 +26,57 @@ def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
     group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
 
 
+# per-worker state for --jobs
+_worker = {}
+
+
+def _openarchive(path, inbase, nogarbage, removesn):
+    _worker["archive"] = zf(path)
+    _worker["args"] = (inbase, nogarbage, removesn)
+
+
+def _extract_member(info):
+    return extract_document(_worker["archive"], info, *_worker["args"])
+
+
+def extract_document(archive, info, inbase, nogarbage=False, removesn=False):
+    ''' parse and garbage-filter one ltf member of archive. Returns a message for stderr (or None) and the
+    text for manifest, raw original, garbage original, garbage manifest, tokenized, morph-tokenized, morph and pos '''
+    outputs = [[] for x in range(8)]
+    man, orig, garbage, garbage_man, tok, morphtok, morph, pos = outputs
+    with TextIOWrapper(archive.open(info, 'r')) as ifh:
+        try:
+            docid, segs = read_ltf(ifh)
+        except ET.ParseError:
+            return "Parse error on " + ifh.name + "\n", []
+    # avoid anonymized tweets in packages but not relocated downloaded mono tweets
+    if "tweets" not in inbase and removesn and "_SN_" in docid:
+        return "SN skip: not extracting {}\n".format(docid), []
+    origlines = [x.text + "\n" for x in segs]
+    garbagemask = getgarbagemask(origlines, disabled=nogarbage)
+    goodmask = [not x for x in garbagemask]
+    seginfo = [[x.id, x.start_char, x.end_char] for x in segs]
+    orig.extend(compress(origlines, garbagemask))
+    for tup in compress(seginfo, garbagemask):
+        man.append("\t".join(map(str, [info.filename, docid] + tup)) + "\n")
+    if not nogarbage:
+        garbage.extend(compress(origlines, goodmask))
+        for tup in compress(seginfo, goodmask):
+            garbage_man.append("\t".join(map(str, [info.filename, docid] + tup)) + "\n")
+    for x in compress(segs, garbagemask):
+        toktext, morphtoktext, morphtext, postext = ltf_segment_fields(x)
+        tok.append(' '.join(toktext) + "\n")
+        morphtok.append(' '.join(morphtoktext) + "\n")
+        morph.append(' '.join(morphtext) + "\n")
+        pos.append(' '.join(postext) + "\n")
+    return None, [''.join(x) for x in outputs]
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract and print monolingual" \
                                                  " data, tokenized, morph, pos tag and " \
                                                  "original, with manifests")
-    parser.add_argument("--infile", "-i", nargs='+', type=argparse.FileType('rb'),
+    parser.add_argument("--infile", "-i", nargs='+', type=FileType('rb'),
                         default=[sys.stdin, ],
                         help="input zip file(s) (each contains a multi file)")
     parser.add_argument("--outdir", "-o",
@@ -61,7 +108,13 @@ def main():
     parser.add_argument("--cdectokenizer", default=os.path.join(scriptdir,
                                                                 "cdectok.sh"),
                         help="cdec tokenizer program wrapper")
+    addonoffarg(parser, 'inlineclean', help="clean orig and tok as they are written instead of running --cleanpath after",
+                default=True)
     addonoffarg(parser, 'cdec', help="do cdec tokenization", default=True)
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="documents to parse at once (output is the same as with one)")
+    parser.add_argument("--tokjobs", type=int, default=4,
+                        help="tokenizer batches to run at once (0 runs --cdectokenizer as is)")
     addonoffarg(parser, 'removesn', help="remove SN from mono zip (to avoid underscore tweets)", default=False)
 
     try:
@@ -97,6 +150,9 @@ def main():
         if not os.path.exists(dir):
             os.makedirs(dir)
 
+    # the tokenizer runs on each archive while the next is extracted
+    tokenizer = tokenizerpool(args.cdectokenizer, args.tokjobs) if args.cdec else None
+    tokenized = []
     defaultcount = 0
     for infile in args.infile:
         inbase = '.'.join(os.path.basename(infile.name).split('.')[:-2])
@@ -113,76 +169,57 @@ def main():
             garbage_fh = open(os.path.join(garbageoutdir, "%s.flat" % inbase), 'w')
             garbage_man_fh = open(os.path.join(garbageoutdir, "%s.manifest" % inbase), 'w')
         tok_fh = open(os.path.join(tokoutdir, "%s.flat" % inbase), 'w')
+        clean_orig = os.path.join(cleanorigoutdir, "%s.flat" % inbase)
+        clean_tok = os.path.join(cleantokoutdir, "%s.flat" % inbase)
+        if args.inlineclean:
+            # raw orig->clean orig, raw tok->clean tok in the same pass
+            orig_fh = CleanTee(orig_fh, clean_orig)
+            tok_fh = CleanTee(tok_fh, clean_tok)
         morphtok_fh = open(os.path.join(morphtokoutdir,
                                         "%s.flat" % inbase), 'w')
         morph_fh = open(os.path.join(morphoutdir, "%s.flat" % inbase), 'w')
         pos_fh = open(os.path.join(posoutdir, "%s.flat" % inbase), 'w')
-        for info in archive.infolist():
-            if info.file_size < 20:
-                continue
-            # assume ltf filename
-            if not info.filename.endswith("ltf.xml"):
-                continue
-            # print info.filename
-            with TextIOWrapper(archive.open(info, 'r')) as ifh:
-                try:
-                    xobj = ET.parse(ifh)
-                    docid = xobj.findall(".//DOC")[0].get('id')
-                    # avoid anonymized tweets in packages but not relocated downloaded mono tweets
-                    if "tweets" not in inbase and args.removesn and "_SN_" in docid:
-                        sys.stderr.write("SN skip: not extracting {}\n".format(docid))
-                        continue
-                    origlines = [x.text + "\n" for x in xobj.findall(".//ORIGINAL_TEXT")]
-                    garbagemask = getgarbagemask(origlines, disabled=args.nogarbage)
-                    goodmask = [not x for x in garbagemask]
-                    seginfo = [[x.get(y) for y in ('id', 'start_char', 'end_char')]
-                               for x in xobj.findall(".//SEG")]
-                    for line in compress(origlines, garbagemask):
-                        orig_fh.write(line)
-                    for tup in compress(seginfo, garbagemask):
-                        man_fh.write("\t".join(map(str, [info.filename, docid] + tup)) + "\n")
-                    if not args.nogarbage:
-                        for line in compress(origlines, goodmask):
-                            garbage_fh.write(line)
-                        for tup in compress(seginfo, goodmask):
-                            garbage_man_fh.write("\t".join(map(str, [info.filename, docid] + tup)) + "\n")
-                    for x in compress(xobj.findall(".//SEG"), garbagemask):
-                        tokens = x.findall(".//TOKEN")
-                        toktext = []
-                        morphtoktext = []
-                        morphtext = []
-                        postext = []
-                        for y in tokens:
-                            if y.text is None:
-                                continue
-                            toktext.append(y.text)
-                            postext.append(y.get("pos") or "none")
-                            for mt, mtt in morph_tok(y):
-                                morphtext.append(mt)
-                                morphtoktext.append(mtt)
-                        tok_fh.write(' '.join(toktext) + "\n")
-                        morphtok_fh.write(' '.join(morphtoktext) + "\n")
-                        morph_fh.write(' '.join(morphtext) + "\n")
-                        pos_fh.write(' '.join(postext) + "\n")
-                except ET.ParseError:
-                    sys.stderr.write("Parse error on " + ifh.name + "\n")
-                    continue
+        members = [info for info in archive.infolist()
+                   if info.file_size >= 20 and info.filename.endswith("ltf.xml")]
+        outfhs = [man_fh, orig_fh, garbage_fh, garbage_man_fh, tok_fh, morphtok_fh, morph_fh, pos_fh]
+        # workers need their own handle on the zip; that takes a real file
+        if args.jobs > 1 and os.path.isfile(infile.name):
+            pool = Pool(args.jobs, initializer=_openarchive,
+                        initargs=(infile.name, inbase, args.nogarbage, args.removesn))
+            bundles = pool.imap(_extract_member, members, chunksize=64)
+        else:
+            pool = None
+            bundles = (extract_document(archive, info, inbase, args.nogarbage, args.removesn)
+                       for info in members)
+        # imap hands results back in archive order, so output matches a serial run
+        for message, outputs in bundles:
+            if message is not None:
+                sys.stderr.write(message)
+            for fh, text in zip(outfhs, outputs):
+                if fh is not None and len(text) > 0:
+                    fh.write(text)
+        if pool is not None:
+            pool.close()
+            pool.join()
         orig_fh.close()
         tok_fh.close()
         # raw orig->clean orig
         # raw tok->clean tok
-        clean_orig = os.path.join(cleanorigoutdir, "%s.flat" % inbase)
-        clean_tok = os.path.join(cleantokoutdir, "%s.flat" % inbase)
-        for inclean, outclean in zip((orig_fh.name, tok_fh.name), (clean_orig, clean_tok)):
-            cleancmd = "{cmd} {inclean} {outclean}".format(cmd=cleanpath, inclean=inclean, outclean=outclean)
-            sys.stderr.write(cleancmd + "\n")
-            try:
-                check_call(shlex.split(cleancmd))
-            except CalledProcessError as e:
-                sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
-                sys.exit(1)
-
-        if args.cdec:
+        if not args.inlineclean:
+            for inclean, outclean in zip((orig_fh.name, tok_fh.name), (clean_orig, clean_tok)):
+                cleancmd = "{cmd} {inclean} {outclean}".format(cmd=cleanpath, inclean=inclean, outclean=outclean)
+                sys.stderr.write(cleancmd + "\n")
+                try:
+                    check_call(shlex.split(cleancmd))
+                except CalledProcessError as e:
+                    sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
+                    sys.exit(1)
+
+        if tokenizer is not None:
+            tokenized.append(tokenizer.submit_file(orig_fh.name,
+                                                   os.path.join(cdectokoutdir, "%s.flat.lc" % inbase),
+                                                   os.path.join(cdectokoutdir, "%s.flat" % inbase)))
+        elif args.cdec:
             cdec_cmd = "%s -i %s -o %s -t %s" % (args.cdectokenizer,
                                                  orig_fh.name,
                                                  os.path.join(cdectokoutdir,
@@ -191,6 +228,8 @@ def main():
                                                               "%s.flat" % inbase))
             p = subprocess.Popen(shlex.split(cdec_cmd))
             p.wait()
+    for future in tokenized:
+        future.result()
 
 
 if __name__ == '__main__':
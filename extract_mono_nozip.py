@@ -10,7 +10,7 @@ import xml.etree.ElementTree as ET
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 import subprocess
 import shlex
-from lputil import morph_tok, getgarbagemask
+from lputil import read_ltf, ltf_segment_fields, getgarbagemask, fs_listdir
 from itertools import compress
 
 
@@ -95,19 +95,17 @@ def main():
     morph_fh = open(os.path.join(morphoutdir, "mono.flat"), 'w')
     pos_fh = open(os.path.join(posoutdir, "mono.flat"), 'w')
 
-    for srcfile in os.listdir(indir):
+    for srcfile in fs_listdir(indir):
         if srcfile.startswith(".") or not srcfile.endswith("ltf.xml"):
             continue
         srcfile = os.path.join(indir, srcfile)
         with open(srcfile, 'r') as ifh:
             try:
-                xobj = ET.parse(ifh)
-                docid = xobj.findall(".//DOC")[0].get('id')
-                origlines = [x.text + "\n" for x in xobj.findall(".//ORIGINAL_TEXT")]
+                docid, segs = read_ltf(ifh)
+                origlines = [x.text + "\n" for x in segs]
                 garbagemask = getgarbagemask(origlines, disabled=args.nogarbage)
                 goodmask = [not x for x in garbagemask]
-                seginfo = [[x.get(y) for y in ('id', 'start_char', 'end_char')]
-                           for x in xobj.findall(".//SEG")]
+                seginfo = [[x.id, x.start_char, x.end_char] for x in segs]
                 for line in compress(origlines, garbagemask):
                     orig_fh.write(line)
                 for tup in compress(seginfo, garbagemask):
@@ -117,20 +115,8 @@ def main():
                         garbage_fh.write(line)
                     for tup in compress(seginfo, goodmask):
                         garbage_man_fh.write("\t".join(map(str, [srcfile, docid] + tup)) + "\n")
-                for x in compress(xobj.findall(".//SEG"), garbagemask):
-                    tokens = x.findall(".//TOKEN")
-                    toktext = []
-                    morphtoktext = []
-                    morphtext = []
-                    postext = []
-                    for y in tokens:
-                        if y.text is None:
-                            continue
-                        toktext.append(y.text)
-                        postext.append(y.get("pos") or "none")
-                        for mt, mtt in morph_tok(y):
-                            morphtext.append(mt)
-                            morphtoktext.append(mtt)
+                for x in compress(segs, garbagemask):
+                    toktext, morphtoktext, morphtext, postext = ltf_segment_fields(x)
                     tok_fh.write(' '.join(toktext) + "\n")
                     morphtok_fh.write(' '.join(morphtoktext) + "\n")
                     morph_fh.write(' '.join(morphtext) + "\n")
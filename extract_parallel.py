@@ -13,6 +13,50 @@ import lputil
 import datetime
 from subprocess import check_call, CalledProcessError
 from itertools import compress
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+
+def extract_pair(task):
+    ''' read and garbage-filter one pair of files. Returns a warning (or None) and the lines to write,
+    keyed by side and output '''
+    m, el, swap, garbagedisabled = task
+    sdata, tdata = el(*m)
+
+    # found data sometimes seems to require swap behavior
+    if swap:
+        sdata, tdata = tdata, sdata
+
+    if sdata is None or tdata is None:
+        return "Warning: empty files:\n%s or %s\n" % (m[0], m[1]), None
+    # Strict rejection of different length lines. If these are desired,
+    # do gale & church or brown et al or something similar here
+    slen = len(sdata["ORIG"])
+    tlen = len(tdata["ORIG"])
+    if slen != tlen:
+        return "Warning: different number of lines in files:\n" \
+               "%s %d\n%s %d\n" % (m[0], slen, m[1], tlen), None
+
+    # filter out control code-bearing lines here. mask out the data from all fields
+    garbagemask = lputil.getgarbagemask(sdata["ORIG"], tdata["ORIG"], disabled=garbagedisabled)
+    goodmask = [not x for x in garbagemask]
+
+    lines = {}
+    for side, fname, data in (('src', m[0], sdata), ('trg', m[1], tdata)):
+        ### original
+        lines[(side, 'orig')] = list(compress(data["ORIG"], garbagemask))
+        ### manifest
+        tups = list(zip(data["DOCID"], data["SEGID"], data["START"], data["END"]))
+        lines[(side, 'man')] = ["\t".join(map(str, (fname,) + tup)) + "\n" for tup in compress(tups, garbagemask)]
+        ### garbage original and manifest
+        if not garbagedisabled:
+            lines[(side, 'garbage')] = list(compress(data["ORIG"], goodmask))
+            lines[(side, 'garbageman')] = ["\t".join(map(str, (fname,) + tup)) + "\n"
+                                           for tup in compress(tups, goodmask)]
+        ### tokenized, morph tokenized, pos tag
+        for name, field in zip(('tok', 'morphtok', 'morph', 'pos'), ("TOK", "MORPHTOK", "MORPH", "POS")):
+            lines[(side, name)] = list(compress(data[field], garbagemask))
+    return None, lines
 
 
 def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbageoutdir,
@@ -20,8 +64,9 @@ def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbag
              agiletokoutdir, agiletoklcoutdir, morphoutdir, posoutdir,
              agiletokpath, cdectokpath, cleanpath, docdec,
              stp=lputil.selected_translation_pairs, el=lputil.extract_lines,
-             tweet=False, swap=False):
-    ''' Find files and print them out '''
+             tweet=False, swap=False, pool=None, inlineclean=False, tokjobs=0):
+    ''' Find files and print them out. Pairs are read in pool, if given.
+        Returns futures for tokenization still running '''
     src_man_fh = open(os.path.join(outdir, "%s.%s.manifest" % (prefix, src)), 'w')
     trg_man_fh = open(os.path.join(outdir, "%s.%s.manifest" % (prefix, trg)), 'w')
 
@@ -47,6 +92,11 @@ def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbag
             if doopen:
                 entry = open(entry, 'w')
             outfiles[sidename][dirname] = entry
+        if inlineclean:
+            # raw orig->clean orig, raw tok->clean tok in the same pass
+            for contents in ('orig', 'tok'):
+                outfiles[sidename][contents] = lputil.CleanTee(outfiles[sidename][contents],
+                                                               outfiles[sidename]["clean{}".format(contents)])
 
     garbagefhs = {}
     garbagedisabled = True
@@ -63,69 +113,27 @@ def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbag
         trg_garbage_man_fh = open(os.path.join(outdir, garbageoutdir, "%s.%s.manifest" % (prefix, trg)), 'w')
         garbagefhs[trg_man_fh] = trg_garbage_man_fh
 
-    (stpsrc, stptrg) = (trg, src) if swap else (src, trg)
-    for m in stp(path, src=stpsrc, trg=stptrg, xml=True, tweet=tweet):
-        sdata, tdata = el(*m)
-
-        # found data sometimes seems to require swap behavior
-        if swap:
-            sdata, tdata = tdata, sdata
+    # where each kind of line in extract_pair's output goes
+    outfhs = {}
+    for side, man_fh in (('src', src_man_fh), ('trg', trg_man_fh)):
+        for field in ('orig', 'tok', 'morphtok', 'morph', 'pos'):
+            outfhs[(side, field)] = outfiles[side][field]
+        outfhs[(side, 'man')] = man_fh
+        if not garbagedisabled:
+            outfhs[(side, 'garbage')] = garbagefhs[outfiles[side]['orig']]
+            outfhs[(side, 'garbageman')] = garbagefhs[man_fh]
 
-        if sdata is None or tdata is None:
-            sys.stderr.write("Warning: empty files:\n%s or %s\n" % (m[0], m[1]))
-            continue
-        # Strict rejection of different length lines. If these are desired,
-        # do gale & church or brown et al or something similar here
-        slen = len(sdata["ORIG"])
-        tlen = len(tdata["ORIG"])
-        # print(slen,tlen)
-        if slen != tlen:
-            sys.stderr.write("Warning: different number of lines in files:\n" \
-                             "%s %d\n%s %d\n" % (m[0], slen, m[1], tlen))
+    (stpsrc, stptrg) = (trg, src) if swap else (src, trg)
+    # find the pairs here, not in the pool's feeder thread, so that corpora being extracted at once find theirs at once
+    tasks = [(m, el, swap, garbagedisabled) for m in stp(path, src=stpsrc, trg=stptrg, xml=True, tweet=tweet)]
+    # (i)map hands results back in pair order, so output doesn't depend on the pool
+    bundles = map(extract_pair, tasks) if pool is None else pool.imap(extract_pair, tasks)
+    for message, lines in bundles:
+        if message is not None:
+            sys.stderr.write(message)
             continue
-
-        # filter out control code-bearing lines here. mask out the data from all fields
-        garbagemask = lputil.getgarbagemask(sdata["ORIG"], tdata["ORIG"], disabled=garbagedisabled)
-
-        goodmask = [not x for x in garbagemask]
-        ### Write original
-        for fh, data in zip((outfiles['src']['orig'], outfiles['trg']['orig']), (sdata["ORIG"], tdata["ORIG"])):
-            for line in compress(data, garbagemask):
-                fh.write(line)
-            ### Write garbage original
-            if not garbagedisabled:
-                for line in compress(data, goodmask):
-                    garbagefhs[fh].write(line)
-
-        ### Write manifest
-
-        try:
-            for fh, fname, tupgen in zip((src_man_fh, trg_man_fh), (m[0], m[1]),
-                                         (list(zip(sdata["DOCID"], sdata["SEGID"],
-                                                   sdata["START"], sdata["END"])),
-                                          list(zip(tdata["DOCID"], tdata["SEGID"],
-                                                   tdata["START"], tdata["END"])))):
-                for tup in compress(tupgen, garbagemask):
-                    fh.write("\t".join(map(str, (fname,) + tup)) + "\n")
-                if not garbagedisabled:
-                    for tup in compress(tupgen, goodmask):
-                        garbagefhs[fh].write("\t".join(map(str, (fname,) + tup)) + "\n")
-        except:
-            sys.stderr.write(src_man_fh.name)
-            # sys.stderr.write(fname)
-            raise
-
-        ### Write tokenized, morph tokenized, pos tag
-
-        zipset = zip(
-            ((outfiles["src"]["tok"], outfiles["src"]["morphtok"], outfiles["src"]["morph"], outfiles["src"]["pos"]),
-             (outfiles["trg"]["tok"], outfiles["trg"]["morphtok"], outfiles["trg"]["morph"], outfiles["trg"]["pos"])),
-            (sdata, tdata))
-
-        for fhset, data in zipset:
-            for fh, field in zip(fhset, ("TOK", "MORPHTOK", "MORPH", "POS")):
-                for line in compress(data[field], garbagemask):
-                    fh.write(line)
+        for key, keylines in lines.items():
+            outfhs[key].writelines(keylines)
 
     # raw orig->clean orig
     # raw tok->clean tok
@@ -136,6 +144,8 @@ def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbag
     for side in ('src', 'trg'):
         for contents in ('orig', 'tok'):
             outfiles[side][contents].close()
+            if inlineclean:
+                continue
             cleancmd = "{cmd} {infile} {outfile}".format(cmd=cleanpath, infile=outfiles[side][contents].name,
                                                          outfile=outfiles[side]["clean{}".format(contents)])
             sys.stderr.write(cleancmd + "\n")
@@ -144,17 +154,27 @@ def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbag
             except CalledProcessError as e:
                 sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
                 sys.exit(1)
-    agiletok_cmd = "%s -i %s -o %s -t %s " % (
-    agiletokpath, outfiles['trg']['cleanorig'], outfiles["trg"]["agiletoklc"], outfiles["trg"]["agiletok"])
-    sys.stderr.write(agiletok_cmd + "\n")
-    try:
-        check_call(shlex.split(agiletok_cmd))
-    except CalledProcessError as e:
-        sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
-        sys.exit(1)
+    tokenized = []
+    agiletokenizer = lputil.tokenizerpool(agiletokpath, tokjobs)
+    if agiletokenizer is not None:
+        tokenized.append(agiletokenizer.submit_file(outfiles['trg']['cleanorig'], outfiles["trg"]["agiletoklc"],
+                                                    outfiles["trg"]["agiletok"]))
+    else:
+        agiletok_cmd = "%s -i %s -o %s -t %s " % (
+        agiletokpath, outfiles['trg']['cleanorig'], outfiles["trg"]["agiletoklc"], outfiles["trg"]["agiletok"])
+        sys.stderr.write(agiletok_cmd + "\n")
+        try:
+            check_call(shlex.split(agiletok_cmd))
+        except CalledProcessError as e:
+            sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
+            sys.exit(1)
     # run cdec tokenizer on source orig
 
-    if docdec:
+    cdectokenizer = lputil.tokenizerpool(cdectokpath, tokjobs) if docdec else None
+    if cdectokenizer is not None:
+        tokenized.append(cdectokenizer.submit_file(outfiles['src']['cleanorig'], outfiles["src"]["cdectoklc"],
+                                                   outfiles["src"]["cdectok"]))
+    elif docdec:
         cdectok_cmd = "%s -i %s -o %s -t %s " % (
         cdectokpath, outfiles['src']['cleanorig'], outfiles["src"]["cdectoklc"], outfiles["src"]["cdectok"])
         sys.stderr.write(cdectok_cmd + "\n")
@@ -163,6 +183,7 @@ def printout(prefix, path, src, trg, outdir, origoutdir, cleanorigoutdir, garbag
         except CalledProcessError as e:
             sys.stderr.write("Error code %d running %s\n" % (e.returncode, e.cmd))
             sys.exit(1)
+    return tokenized
 
 
 '''
@@ -238,6 +259,12 @@ def main():
                         help="path to cdec tokenizer binary")
     parser.add_argument("--cleanpath", default=os.path.join(scriptdir, 'clean.sh'),
                         help="path to cleaning script")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="pairs of files to read at once (output is the same as with one)")
+    parser.add_argument("--tokjobs", type=int, default=4,
+                        help="tokenizer batches to run at once (0 runs the tokenizer wrappers as is)")
+    addonoffarg(parser, 'inlineclean', help="clean orig and tok as they are written instead of running --cleanpath after",
+                default=True)
     addonoffarg(parser, 'cdec', help="do cdec tokenization", default=True)
     addonoffarg(parser, 'swap', help="swap source/translation in found file (il3=true, cmn=false)", default=False)
 
@@ -287,6 +314,11 @@ def main():
                                                    ' '.join(sys.argv),
                                                    os.getcwd()))
     datadirs = [args.rootdir, ] + args.datadirs
+    # reading an unexpanded lrlp: pull the translation data out of the
+    # tarballs in one pass rather than seeking back and forth for each pair
+    index = lputil.tarindex()
+    if index is not None:
+        index.preload([os.path.join(*datadirs)])
 
     '''
     from_eng/ -- manual translations from English into LRLP (elicitation,
@@ -306,17 +338,35 @@ def main():
                   tokoutdir, cleantokoutdir, morphtokoutdir, cdectokoutdir, cdectoklcoutdir,
                   agiletokoutdir, agiletoklcoutdir, morphoutdir, posoutdir,
                   agiletokpath, cdectokpath, cleanpath, args.cdec]
-    for corpustuple in corpustuples:
-        printout(corpustuple[0], corpustuple[1], *commonargs)
+    # each corpus writes its own files, so with --jobs they are all extracted at once, sharing one pool
+    pool = Pool(args.jobs) if args.jobs > 1 else None
+    corpora = [(corpustuple[0], corpustuple[1], {}) for corpustuple in corpustuples]
 
     # Found data
-    printout("found.generic", args.rootdir, *commonargs,
-             stp=lputil.all_found_tuples, el=lputil.get_aligned_sentences, swap=args.swap)
+    corpora.append(("found.generic", args.rootdir,
+                    dict(stp=lputil.all_found_tuples, el=lputil.get_aligned_sentences, swap=args.swap)))
 
     # # Tweet data
-    printout("fromsource.tweet",
-             os.path.join(*(datadirs + ["from_%s" % args.src, ])), *commonargs,
-             tweet=True)
+    corpora.append(("fromsource.tweet", os.path.join(*(datadirs + ["from_%s" % args.src, ])), dict(tweet=True)))
+
+    # tokenizing a corpus goes on while the next ones are extracted
+    tokenized = []
+    if pool is None:
+        for prefix, path, kwargs in corpora:
+            tokenized.extend(printout(prefix, path, *commonargs, inlineclean=args.inlineclean,
+                                      tokjobs=args.tokjobs, **kwargs))
+    else:
+        with ThreadPoolExecutor(len(corpora)) as executor:
+            futures = [executor.submit(printout, prefix, path, *commonargs, pool=pool,
+                                       inlineclean=args.inlineclean, tokjobs=args.tokjobs, **kwargs)
+                       for prefix, path, kwargs in corpora]
+            # in corpus order, so that the first failure is the one reported
+            for future in futures:
+                tokenized.extend(future.result())
+        pool.close()
+        pool.join()
+    for future in tokenized:
+        future.result()
 
 
 if __name__ == '__main__':
@@ -14,6 +14,7 @@ import os
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 import datetime
 from io import TextIOWrapper
+from lputil import FileType
 
 # Scrape monolingual psms for posts and headlines (elsewhere)
 
@@ -24,7 +25,7 @@ def main():
                                    "able to insertion into future xml",
                                    formatter_class=\
                                    argparse.ArgumentDefaultsHelpFormatter)
-  parser.add_argument("--infile", "-i", nargs='+', type=argparse.FileType('rb'),
+  parser.add_argument("--infile", "-i", nargs='+', type=FileType('rb'),
                       default=[sys.stdin,], help="input zip file(s)" \
                       " (each contains a multi file)")
   parser.add_argument("--outfile", "-o", type=argparse.FileType('w'),
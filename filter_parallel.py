@@ -6,14 +6,17 @@ if sys.version_info[0] == 2:
   from itertools import izip
 else:
   izip = zip
-from collections import defaultdict as dd, Counter
 import re
 import os.path
 import gzip
 import os
 import glob
 import numpy as np
+from itertools import islice, compress
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from lputil import mkdir_p
+import pairscorers
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -34,18 +37,96 @@ def prepfile(fh, code):
   return ret
 
 
-def filterlines(ifh, blackballs, seqs, lows, highs, keepfh, rejectfh):
-  ''' pair ifh and seqs. if low < seq < high for all, then write to keepfh, else write to rejectfh '''
-  for ln, (line, bb, *vals) in enumerate(zip(ifh, blackballs, *seqs)):
-    doreject=True
-    if not bb:
-      for val, low, high in zip(vals, lows, highs):
-        if val > low and val < high:
-          doreject=False
-          break
-    #sys.stderr.write("{} {} {} vs {} to {}: {}\n".format(ifh.name, ln, vals, lows, highs, doreject))
-    fh = rejectfh if doreject else keepfh
-    fh.write(line)
+def filterlines(ifh, keep, keepfh, rejectfh, chunksize=100000):
+  ''' pair ifh with the (packed, length) keep mask; kept lines go to keepfh, the others to rejectfh.
+  Lines past the end of the mask go nowhere '''
+  packed, length = keep
+  keep = np.unpackbits(packed, count=length).astype(bool)
+  for start in range(0, length, chunksize):
+    lines = list(islice(ifh, min(chunksize, length-start)))
+    chunk = keep[start:start+len(lines)]
+    keepfh.writelines(compress(lines, chunk))
+    rejectfh.writelines(compress(lines, ~chunk))
+    if len(lines) < chunksize:
+      break
+
+def filterfile(infilename, keep, keepfilename, rejectfilename):
+  ''' filterlines, from and to files '''
+  with open(infilename, 'r') as infh, \
+       open(keepfilename, 'w', buffering=1<<20) as keepfh, \
+       open(rejectfilename, 'w', buffering=1<<20) as rejectfh:
+    filterlines(prepfile(infh, 'r'), keep, prepfile(keepfh, 'w'), prepfile(rejectfh, 'w'))
+
+def measure(eorig, forig):
+  ''' word length ratio, word length difference and blackball of each line pair, as arrays, and
+  the (0-based) lines with no foreign words '''
+  elens = []
+  flens = []
+  blackballs = []
+  with open(eorig, 'r') as efh, open(forig, 'r') as ffh:
+    for eline, fline in izip(prepfile(efh, 'r'), prepfile(ffh, 'r')):
+      elens.append(len(eline.split()))
+      flens.append(len(fline.split()))
+      blackballs.append(blackball(eline, fline))
+  elens = np.array(elens, dtype=float)
+  flens = np.array(flens, dtype=float)
+  ratios = np.divide(elens, flens, out=np.zeros_like(elens), where=flens > 0)
+  return ratios, np.abs(elens-flens), np.array(blackballs, dtype=bool), np.flatnonzero(flens == 0)
+
+def readpairs(eorig, forig, batchsize, limit=None):
+  ''' batches of (foreign lines, english lines) of a genre, newlines stripped '''
+  with open(eorig, 'r') as efh, open(forig, 'r') as ffh:
+    pairs = islice(izip(prepfile(ffh, 'r'), prepfile(efh, 'r')), limit)
+    while True:
+      batch = list(islice(pairs, batchsize))
+      if len(batch) == 0:
+        return
+      yield [f.rstrip('\n') for f, e in batch], [e.rstrip('\n') for f, e in batch]
+
+# the scorers, in each scoring process
+_scorers = []
+
+def _initscorers(scorers):
+  global _scorers
+  _scorers = scorers
+
+def _score(task):
+  which, flines, elines = task
+  return [_scorers[i].score(flines, elines) for i in which]
+
+def scoreall(scorers, genres, origs, scoredir, jobs, batchsize):
+  ''' genre -> per-line scores of each scorer, reusing those saved in scoredir while the
+  scorer's options and the original files are the same '''
+  sample = [batch for eorig, forig in origs for batch in readpairs(eorig, forig, batchsize, batchsize)]
+  for scorer in scorers:
+    scorer.prepare([f for flines, elines in sample for f in flines], [e for flines, elines in sample for e in elines])
+  mkdir_p(scoredir)
+  ret = {}
+  with ProcessPoolExecutor(jobs, initializer=_initscorers, initargs=(scorers,)) as pool:
+    for genre, (eorig, forig) in zip(genres, origs):
+      ret[genre] = [None]*len(scorers)
+      inputs = [[f, os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in (eorig, forig)]
+      stamps = {}
+      for i, scorer in enumerate(scorers):
+        stamps[i] = {"scorer":scorer.name, "options":scorer.options(), "inputs":inputs}
+        saved = os.path.join(scoredir, "%s.%s" % (genre, scorer.name))
+        if os.path.exists(saved+".json") and os.path.exists(saved+".npy"):
+          with open(saved+".json") as sfh:
+            if json.load(sfh) == json.loads(json.dumps(stamps[i])):
+              ret[genre][i] = np.load(saved+".npy")
+      which = [i for i in range(len(scorers)) if ret[genre][i] is None]
+      if len(which) == 0:
+        sys.stderr.write("reusing saved scores for %s\n" % genre)
+        continue
+      sys.stderr.write("scoring %s with %s\n" % (genre, ', '.join(scorers[i].name for i in which)))
+      parts = list(zip(*pool.map(_score, ((which, flines, elines) for flines, elines in readpairs(eorig, forig, batchsize)))))
+      for n, i in enumerate(which):
+        ret[genre][i] = np.concatenate(parts[n]) if len(parts) > 0 else np.zeros(0)
+        saved = os.path.join(scoredir, "%s.%s" % (genre, scorers[i].name))
+        np.save(saved+".npy", ret[genre][i])
+        with open(saved+".json", 'w') as sfh:
+          json.dump(stamps[i], sfh)
+  return ret
 
 def countfiles(dir):
   ''' how many (non-directory) files in this dir? '''
@@ -74,6 +155,15 @@ def main():
   parser.add_argument("--filterdir", "-f", default="./filtered", help="output filter directory")
   parser.add_argument("--genre", "-g", default="original", help="genre to use when filtering (could try tokenized but not available for twitter)")
   parser.add_argument("--remaindir", "-r", default="./remainder", help="output remainder directory")
+  parser.add_argument("--threads", "-t", type=int, default=8, help="files to filter at once")
+  parser.add_argument("--scorer", "-S", action='append', default=[],
+                      help="also reject lines on this score: name[:std:K] (outside mean±K·std; K defaults to --stds) or "
+                      "name:pct:P (the P%% most suspect); names are %s, or module.Class for a pairscorers.Scorer "
+                      "of your own" % ', '.join(sorted(pairscorers.scorers)))
+  parser.add_argument("--lexicon", default=None, help="lexicon.norm (from normalize_lexicon_tg.py) for the lexicon scorer")
+  parser.add_argument("--scoredir", default=None, help="where per-line scores are saved (default: scores, next to the filter directory)")
+  parser.add_argument("--scorejobs", type=int, default=4, help="processes to score with")
+  parser.add_argument("--batchsize", type=int, default=10000, help="line pairs per scoring batch")
 
 
 
@@ -96,14 +186,12 @@ def main():
   # assumption: there are a number of *.eng.manifest files, each paired with *.<lang>.manifest, and for each i, there is original/i.eng.flat and original/i.<lang>.flat
   engmanifests = glob.glob(os.path.join(indir, "*.eng.manifest"))
   fmanifests = []
-  ratios = dd(list)
-  deltas = dd(list)
-  blackballs = dd(list)
-  genres = set()
+  genres = []
+  origs = []
   for eman in engmanifests:
     ebase = os.path.basename(eman)
     genre = '.'.join(ebase.split('.')[:-2])
-    genres.add(genre)
+    genres.append(genre)
     fman = os.path.join(os.path.dirname(eman), "%s.%s.manifest" % (genre, args.lang))
     fmanifests.append(fman)
     eorig = os.path.join(args.indir, args.genre, "%s.%s.eng.flat" % (genre, args.genre))
@@ -113,60 +201,93 @@ def main():
       if not os.path.exists(f):
         sys.stderr.write("ERROR: %s does not exist\n" % f)
         sys.exit(1)
-    #slurp files, calculate ratios, store ratios
-    eorig = prepfile(open(eorig, 'r'), 'r')
-    forig = prepfile(open(forig, 'r'), 'r')
-    for ln, (eline, fline) in enumerate(izip(eorig, forig)):
-      ewords = eline.strip().split()
-      fwords = fline.strip().split()
-      blackballs[genre].append(blackball(eline, fline))
-      deltas[genre].append(abs(len(ewords)-len(fwords)))
-      try:
-        ratios[genre].append((len(ewords)+0.0)/(len(fwords)+0.0))
-      except ZeroDivisionError:
-        sys.stderr.write("0-length foreign sentence at line {} of {}\n".format(ln+1, forig.name))
-        ratios[genre].append(0.)
-
-  allratios = np.concatenate(list(map(np.array, ratios.values())), 0)
-  alldeltas = np.concatenate(list(map(np.array, deltas.values())), 0)
-  allblackballs = np.concatenate(list(map(np.array, blackballs.values())), 0)
-  bbrejectsize = Counter(allblackballs)[True]
+    origs.append((eorig, forig))
+
+  pool = ThreadPoolExecutor(args.threads)
+  #slurp files, calculate ratios, store ratios
+  ratios = {}
+  deltas = {}
+  blackballs = {}
+  for genre, (eorig, forig), (rats, delts, bbs, zeros) in zip(genres, origs, pool.map(lambda o: measure(*o), origs)):
+    for ln in zeros:
+      sys.stderr.write("0-length foreign sentence at line {} of {}\n".format(ln+1, forig))
+    ratios[genre] = rats
+    deltas[genre] = delts
+    blackballs[genre] = bbs
+
+  allratios = np.concatenate(list(ratios.values())+[np.zeros(0)])
+  alldeltas = np.concatenate(list(deltas.values())+[np.zeros(0)])
+  allblackballs = np.concatenate(list(blackballs.values())+[np.zeros(0, dtype=bool)])
+  bbrejectsize = int(np.count_nonzero(allblackballs))
   ratiomean = np.mean(allratios)
   ratiostd = np.std(allratios)
   lowratio = ratiomean-(args.stds*ratiostd)
   highratio = ratiomean+(args.stds*ratiostd)
-  rejectratiosize = len(list(filter(lambda x: x<lowratio or x > highratio, allratios)))
+  badratio = (allratios < lowratio) | (allratios > highratio)
+  rejectratiosize = int(np.count_nonzero(badratio))
 
   deltamean = np.mean(alldeltas)
   deltastd = np.std(alldeltas)
   lowdelta = deltamean-(args.stds*deltastd)
   highdelta = deltamean+(args.stds*deltastd)
-  rejectdeltasize = len(list(filter(lambda x: x<lowdelta or x > highdelta, alldeltas)))
+  baddelta = (alldeltas < lowdelta) | (alldeltas > highdelta)
+  rejectdeltasize = int(np.count_nonzero(baddelta))
 
   sys.stderr.write("Could be rejecting %d of %d lines (%f %%) with ratio below %f or above %f\n" % (rejectratiosize, len(allratios), 100.0*rejectratiosize/len(allratios), lowratio, highratio))
   sys.stderr.write("Could be rejecting %d of %d lines (%f %%) with delta below %f or above %f\n" % (rejectdeltasize, len(alldeltas), 100.0*rejectdeltasize/len(alldeltas), lowdelta, highdelta))
 
-  reject_ratio_delta_size = len(list(filter(lambda x: (x[0]<lowratio or x[0]>highratio) and (x[1]<lowdelta or x[1]>highdelta), zip(allratios, alldeltas))))
+  reject_ratio_delta_size = int(np.count_nonzero(badratio & baddelta))
   sys.stderr.write("Actually rejecting %d of %d lines (%f %%) meeting both delta and ratio criteria\n" % (reject_ratio_delta_size, len(alldeltas), 100.0*reject_ratio_delta_size/len(alldeltas)))
 
   sys.stderr.write("Also rejecting %d of %d lines (%f %%) for blackball criteria\n" % (bbrejectsize, len(allblackballs), 100.0*bbrejectsize/len(allblackballs)))
+
+  # scorers: what they make of each line, and where they draw the line
+  scorepasses = {genre:np.ones(len(ratios[genre]), dtype=bool) for genre in genres}
+  if len(args.scorer) > 0:
+    specs = []
+    for spec in args.scorer:
+      fields = spec.split(':')
+      if len(fields) not in (1, 3) or (len(fields) == 3 and fields[1] not in ('std', 'pct')):
+        sys.stderr.write("Bad scorer %s; expected name, name:std:K or name:pct:P\n" % spec)
+        sys.exit(1)
+      try:
+        cls = pairscorers.getscorer(fields[0])
+      except (KeyError, ImportError, AttributeError) as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+      specs.append((cls(args), fields[1] if len(fields) == 3 else 'std', float(fields[2]) if len(fields) == 3 else args.stds))
+    scoredir = args.scoredir if args.scoredir is not None else os.path.join(os.path.dirname(os.path.abspath(filterdir)), 'scores')
+    scores = scoreall([scorer for scorer, how, amount in specs], genres, origs, scoredir, args.scorejobs, args.batchsize)
+    for i, (scorer, how, amount) in enumerate(specs):
+      ok, low, high = pairscorers.passes(np.concatenate([scores[genre][i] for genre in genres]+[np.zeros(0)]),
+                                         scorer.sides, how, amount)
+      sys.stderr.write("Rejecting %d of %d lines (%f %%) with %s score below %f or above %f\n" % (
+        len(ok)-np.count_nonzero(ok), len(ok), 100.0*(len(ok)-np.count_nonzero(ok))/max(len(ok), 1), scorer.name, low, high))
+      start = 0
+      for genre in genres:
+        scorepasses[genre] &= ok[start:start+len(ratios[genre])]
+        start += len(ratios[genre])
+
+  # the decision for every line, made once: keep it if it isn't blackballed, either its ratio or its delta is in range,
+  # and every scorer passes it
+  keeps = {}
+  rejectsizes = {}
+  for genre in genres:
+    rats, delts = ratios[genre], deltas[genre]
+    inrange = ((rats > lowratio) & (rats < highratio)) | ((delts > lowdelta) & (delts < highdelta))
+    keeps[genre] = (np.packbits(inrange & ~blackballs[genre] & scorepasses[genre]), len(rats))
+    rejectsizes[genre] = int(np.count_nonzero(((rats < lowratio) | (rats > highratio)) & ((delts < lowdelta) | (delts > highdelta))))
+
   # iterate through manifests and all files and filter per ratio and delta
+  jobs = []
   for manset in (engmanifests, fmanifests):
     for man in manset:
       sys.stderr.write("filtering %s\n" % man)
       base = os.path.basename(man)
       genre = '.'.join(base.split('.')[:-2])
       sys.stderr.write("genre %s\n" % genre)
-      rats = ratios[genre]
-      delts = deltas[genre]
-      bbs = blackballs[genre]
-      reject_ratio_delta_size = len(list(filter(lambda x: (x[0]<lowratio or x[0]>highratio) and (x[1]<lowdelta or x[1]>highdelta), zip(rats, delts))))
-      #rejectratiosize = len(list(filter(lambda x: x<lowratio or x > highratio, rats)))
-      sys.stderr.write("rejecting %d of %d\n" % (reject_ratio_delta_size, len(rats)))
-      infile = prepfile(open(man, 'r'), 'r')
-      filterfile = prepfile(open(os.path.join(filterdir, base), 'w'), 'w')
-      remainfile = prepfile(open(os.path.join(remaindir, base), 'w'), 'w')
-      filterlines(infile, bbs, (rats, delts), (lowratio,lowdelta), (highratio,highdelta), filterfile, remainfile)
+      sys.stderr.write("rejecting %d of %d\n" % (rejectsizes[genre], keeps[genre][1]))
+      jobs.append((man, keeps[genre], os.path.join(filterdir, base), os.path.join(remaindir, base)))
 
   # for directories in extracted
   #http://stackoverflow.com/questions/973473/getting-a-list-of-all-subdirectories-in-the-current-directory
@@ -185,13 +306,15 @@ def main():
         base = "%s.%s.%s.flat" % (genre, subdir, lang)
         infilename = os.path.join(insubdir, base)
         if os.path.exists(infilename):
-          infile = prepfile(open(infilename, 'r'), 'r')
-          filterfile = prepfile(open(os.path.join(filtersubdir, base), 'w'), 'w')
-          remainfile = prepfile(open(os.path.join(remainsubdir, base), 'w'), 'w')
-          filterlines(infile, blackballs[genre], (ratios[genre], deltas[genre]), (lowratio,lowdelta), (highratio,highdelta), filterfile, remainfile)
+          jobs.append((infilename, keeps[genre], os.path.join(filtersubdir, base), os.path.join(remainsubdir, base)))
         else:
           sys.stderr.write("%s does not exist\n" % infilename)
 
+  # each file is read once and written once, several at a time
+  for result in [pool.submit(filterfile, *job) for job in jobs]:
+    result.result()
+  pool.shutdown()
+
   # count files in each of the directories; should be the same
   for dir in (indir, filterdir, remaindir):
     sys.stderr.write("%d files in %s\n" % (countfiles(dir), dir))
@@ -8,7 +8,7 @@ from collections import defaultdict as dd
 import re
 import os
 import os.path
-from lputil import mkdir_p
+from lputil import mkdir_p, fs_exists, fs_isdir, fs_isfile, fs_copy
 import shutil
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
@@ -27,14 +27,14 @@ manifest = {"docs":"docs",
 transferexcluded = set(["tools"])
 
 def copything(src, dst):
-  if os.path.isdir(src):
+  if fs_isdir(src):
     # nfs to nfs copytree bug
     try:
-      shutil.copytree(src, dst)
+      fs_copy(src, dst)
     except shutil.Error:
       sys.stderr.write("possible nfs bug encountered moving {} to {}\n".format(src, dst))
-  elif os.path.isfile(src):
-    shutil.copy(src, dst)
+  elif fs_isfile(src):
+    fs_copy(src, dst)
   else:
     sys.stderr.write("%s not directory or file; skipping" % src)
   
@@ -58,7 +58,7 @@ def main():
   mkdir_p(args.target)
   for indirstub, outdirstub in manifest.items():
     indir = os.path.join(args.source, indirstub)
-    if os.path.exists(indir):
+    if fs_exists(indir):
       outdir = os.path.join(args.target, outdirstub)
       sys.stderr.write("Copying {} to {}\n".format(indir, outdir))
       copything(indir, outdir)
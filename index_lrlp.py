@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import os
+import os.path
+import datetime
+from subprocess import check_call, CalledProcessError
+from lputil import TarIndex, mkdir_p
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+# parts of the lrlp that are written to disk anyway, since they are read by
+# things that can't go through the index (ruby tools, shell redirects)
+materialized = set(["docs", "tools"])
+
+def main():
+  parser = argparse.ArgumentParser(description="index lrlp tarballs so the lrlp can be read without unpacking it. "
+                                   "Streaming counterpart of unpack_lrlp.sh; prints the (virtual) expanded lrlp path",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("tarballs", nargs='+', help='lrlp tarballs (all part of the same package)')
+  parser.add_argument("--language", "-l", default='uzb', help='language of the lrlp')
+  parser.add_argument("--root", "-r", default='/home/nlg-02/LORELEI/ELISA/data', help='data root')
+  parser.add_argument("--key", "-k", default=None, help='key to decrypt with')
+  parser.add_argument("--set", "-s", default=None, help='set to decrypt')
+  parser.add_argument("--index", "-o", default=None,
+                      help='where to write the member index (default root/language/lrlps/lrlp.index.json)')
+
+  try:
+    args = parser.parse_args()
+  except IOError as msg:
+    parser.error(str(msg))
+
+  lrlploc = os.path.join(args.root, args.language, 'lrlps')
+  exploc = os.path.join(args.root, args.language, 'expanded')
+  expdir = os.path.join(exploc, 'lrlp')
+  indexpath = args.index if args.index is not None else os.path.join(lrlploc, 'lrlp.index.json')
+  mkdir_p(lrlploc)
+  mkdir_p(expdir)
+
+  tarballs = []
+  for part, tarball in enumerate(args.tarballs):
+    tarball = os.path.realpath(tarball)
+    if not os.path.exists(tarball):
+      sys.stderr.write("Couldn't find %s\n" % tarball)
+      sys.exit(1)
+    link = os.path.join(lrlploc, "%s.part.%d.tar.gz" % (args.language, part))
+    if os.path.lexists(link):
+      os.remove(link)
+    os.symlink(tarball, link)
+    tarballs.append(tarball)
+    with open(os.path.join(lrlploc, 'source'), 'a') as fh:
+      fh.write("Linked %s to %s on %s.\nWill index to %s;\nUsing [ %s ] from %s\n" % \
+               (tarball, link, datetime.datetime.now(), indexpath, ' '.join(sys.argv), os.getcwd()))
+
+  encrypted = None if args.key is None else "%s.tar.bz2.openssl" % args.set
+  def materialize(rel):
+    return os.sep not in rel or rel.split(os.sep)[0] in materialized or rel == encrypted
+  index = TarIndex.build(tarballs, expdir, indexpath, materialize)
+  with open(os.path.join(exploc, 'source'), 'a') as fh:
+    fh.write("Indexed %s here on %s (only %s and top level files unpacked).\nUsing [ %s ] from %s\n" % \
+             (' '.join(tarballs), datetime.datetime.now(), ', '.join(sorted(materialized)),
+              ' '.join(sys.argv), os.getcwd()))
+  sys.stderr.write("Indexed %d files from %d tarballs into %s\n" % (len(index.members), len(tarballs), indexpath))
+  print(expdir)
+  sys.stdout.flush()
+  if encrypted is not None:
+    # the decrypted set is unpacked for real; it's small
+    try:
+      check_call("cat %s | openssl enc -d -aes-256-cbc -salt -k %s | tar jxf -" % (encrypted, args.key),
+                 shell=True, cwd=expdir)
+    except CalledProcessError as e:
+      sys.stderr.write("Error code %d decrypting %s\n" % (e.returncode, encrypted))
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -14,8 +14,8 @@ import gzip
 import tempfile
 import shutil
 import atexit
-from lputil import mkdir_p, is_sn
-from subprocess import check_call
+from lputil import mkdir_p, is_sn, TokenizerPool, lineshards
+from subprocess import check_call, CalledProcessError
 import shlex
 from glob import iglob
 
@@ -50,8 +50,8 @@ def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
   group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
 
 
-def tokrsd(dldir, ruby, exec, param, workdir):
-  ''' create ltfs from rsds '''
+def tokrsd(dldir, ruby, exec, param, workdir, jobs=1):
+  ''' create ltfs from rsds, jobs tokenizers at once '''
   rsddir = dldir
   parent = os.path.dirname(rsddir)
   ltfdir = os.path.join(parent, 'ltf')
@@ -59,12 +59,26 @@ def tokrsd(dldir, ruby, exec, param, workdir):
     sys.stderr.write("Directories not set up properly; couldn't find {}\n".format(rsddir))
     sys.exit(1)
   mkdir_p(ltfdir)
+  rsds = ["{}\n".format(l) for l in iglob(os.path.join(rsddir, '*.rsd.txt'))]
+  paramtxt = "" if param is None else "-t {}".format(param)
+  if jobs > 1 and len(rsds) > 1:
+    # token_parse.rb goes file by file, so pieces of the list can go to several at once, on stdin
+    cmd = "{} {} {} /dev/stdin".format(ruby, exec, paramtxt)
+    rsds = [l.encode('utf-8', 'surrogateescape') for l in rsds]
+    pool = TokenizerPool(shlex.split(cmd), jobs, shardbytes=-(-sum(map(len, rsds))//jobs), check=True, quiet=False)
+    try:
+      # whatever the tool prints comes through, as it does from check_call
+      for out in pool.tokenize(lineshards(rsds, pool.shardbytes)):
+        sys.stdout.buffer.write(out)
+      sys.stdout.buffer.flush()
+    except CalledProcessError as e:
+      return e.returncode
+    return 0
   listfile = os.path.join(workdir, 'list')
   lfh = prepfile(listfile, 'w')
-  for l in iglob(os.path.join(rsddir, '*.rsd.txt')):
-    lfh.write("{}\n".format(l))
+  for l in rsds:
+    lfh.write(l)
   lfh.close()
-  paramtxt = "" if param is None else "-t {}".format(param)
   cmd = "{} {} {} {}".format(ruby, exec, paramtxt, listfile)
   return check_call(shlex.split(cmd))
 
@@ -176,6 +190,7 @@ def main():
   parser.add_argument("--param", "-p", required=True, help="path to ldc tokenizer parameter set; usually tools/tokenization_parameters.v4.0.yaml in the lrlp", default=None)
   parser.add_argument("--outfile", "-o", nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="output file")
   addonoffarg(parser, 'verbose', help="print specific errors per file", default=False)
+  parser.add_argument("--jobs", "-j", type=int, default=1, help="tokenizers to run at once, each on part of the file list")
   try:
     args = parser.parse_args()
   except IOError as msg:
@@ -190,7 +205,7 @@ def main():
     print(workdir)
   else:
     atexit.register(cleanwork)
-  retval = tokrsd(args.dldir, args.ruby, args.exec, args.param, workdir)
+  retval = tokrsd(args.dldir, args.ruby, args.exec, args.param, workdir, args.jobs)
   if retval != 0:
     sys.stderr.write("Error tokenizing: {}\n".format(retval))
     sys.exit(retval)
@@ -2,15 +2,18 @@
 
 # utilities for dealing with LRLPs
 import argparse
+import bisect
+import io
 import sys
 import os
 import re
 import os.path
-from collections import defaultdict as dd
+import threading
+from collections import defaultdict as dd, namedtuple
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import ParseError
 import unicodedata as ud
-from subprocess import check_output, check_call, CalledProcessError
+from subprocess import check_output, check_call, CalledProcessError, Popen, PIPE
 #from functools import reduce
 
 scriptdir = os.path.dirname(os.path.abspath(__file__))
@@ -24,7 +27,7 @@ def is_sn(docid):
 def dirfind(path, extension):
   ''' find files that end with the given extension in the given path '''
   ret = []
-  for root, dirs, files in os.walk(path):
+  for root, dirs, files in fs_walk(path):
     for file in files:
         if file.endswith(extension):
           ret.append(os.path.join(root, file))
@@ -32,27 +35,491 @@ def dirfind(path, extension):
 
 def getgarbagemask(*linesets, disabled=False):
   ''' True in a position if all lines in that position are not garbage '''
+  linesets = [list(lines) for lines in linesets]
+  length = min(map(len, linesets)) if len(linesets) > 0 else 0
+  if disabled:
+    return [True]*length
+  garbage = set()
+  for lines in linesets:
+    garbage.update(garbagelines(lines[:length]))
+  return [x not in garbage for x in range(length)]
+
+# used in garbage detection
+_charclasses = {}
+
+def controlmatcher(categories=("Cn", "Co", "Cs", "Cc")):
+  ''' compiled regex matching a character in any of the given unicode categories,
+  as this python's unicode database has them, and one for the ascii ones '''
+  categories = tuple(sorted(categories))
+  if categories not in _charclasses:
+    ranges = []
+    for code in range(sys.maxunicode+1):
+      if ud.category(chr(code)) in categories:
+        if len(ranges) > 0 and ranges[-1][1] == code-1:
+          ranges[-1][1] = code
+        else:
+          ranges.append([code, code])
+    def charclass(ranges):
+      # a class of basic plane characters compiles to a bitmap; one with
+      # astral ranges in it to a list of ranges, tried one by one. So astral
+      # characters are matched separately, after a one range test
+      bmp = [[a, min(b, 0xffff)] for a, b in ranges if a <= 0xffff]
+      astral = [[max(a, 0x10000), b] for a, b in ranges if b > 0xffff]
+      classes = []
+      if len(bmp) > 0:
+        classes.append("[%s]" % ''.join("\\U%08x-\\U%08x" % tuple(x) for x in bmp))
+      if len(astral) > 0:
+        classes.append("[\\U00010000-\\U0010ffff](?<=[%s])" % ''.join("\\U%08x-\\U%08x" % tuple(x) for x in astral))
+      return re.compile('|'.join(classes) or r"(?!)")
+    _charclasses[categories] = (charclass(ranges),
+                                charclass([[a, min(b, 127)] for a, b in ranges if a < 128]))
+  return _charclasses[categories]
+
+def garbagelines(lines, categories=("Cn", "Co", "Cs", "Cc")):
+  ''' indices of the lines that (once stripped) contain control characters,
+  found by searching all of them at once '''
+  stripped = [line.strip() for line in lines]
+  # a space is in none of the categories, so it can't start or complete a match
+  text = ' '.join(stripped)
+  allchars, asciichars = controlmatcher(categories)
+  pattern = asciichars if text.isascii() else allchars
   ret = []
-  for lines in zip(*linesets):
-    if disabled:
-      ret.append(True)
-      continue
-    result = False
-    for line in lines:
-      result = result or iscontrol(line.strip())
-    ret.append(not result)
+  match = pattern.search(text)
+  if match is None:
+    return ret
+  starts = []
+  pos = 0
+  for line in stripped:
+    starts.append(pos)
+    pos += len(line)+1
+  while match is not None:
+    idx = bisect.bisect_right(starts, match.start())-1
+    ret.append(idx)
+    # on to the next line
+    if idx+1 >= len(starts):
+      break
+    match = pattern.search(text, starts[idx+1])
   return ret
-#    ret.append(not reduce(lambda x, y: x or iscontrol(y.strip()), lines, False)) = hard to understand but elegant!
 
-# used in garbage detection
-def iscontrol(line):
+def iscontrol(line, categories=("Cn", "Co", "Cs", "Cc")):
   ''' does this line contain control characters? '''
-  cats = set(map(ud.category, list(line)))
   # Cf is valid; others not so much
-  for code in ("Cn", "Co", "Cs", "Cc"):
-    if code in cats:
-      return True
-  return False
+  allchars, asciichars = controlmatcher(categories)
+  return (asciichars if line.isascii() else allchars).search(line) is not None
+
+
+# clean.sh (wildeclean-v1.0.pl -r, then nfkc.py) as an in-process stage.
+# wildeclean works on raw bytes, so the port does too; '\C2' in the perl
+# delete pattern is an any-byte escape followed by a literal '2'
+_wilde2 = re.compile(rb"\xC3([\x80-\x9F])\xC2([\x80-\xBF])")
+_wilde3 = re.compile(rb"\xC3([\xA0-\xAF])\xC2([\x80-\xBF])\xC2([\x80-\xBF])")
+_wildedelete = re.compile(rb"[\x00-\x08\x0B-\x1F\x7F]|[\x00-\xFF]2[\x80-\x9F]|\xD9\x80|\xE2\x80[\x8B-\x8F]|\xEF\xB8[\x80-\x8F]|\xEF\xBB\xBF|\xF3\xA0[\x84-\x87][\x80-\xBF]")
+_wildespace = re.compile(rb"\xC2\xA0|\xE2\x80[\x82-\x8A]|\xE2\x80\xAF|\xE2\x81\x9F")
+_wildeempty = re.compile(rb"\s+\n?")
+
+class WildeCleaner(object):
+  ''' wildeclean-v1.0.pl without -win, one line (bytes) at a time '''
+  def __init__(self, report=False):
+    self.report = report
+    self.linenumber = 0
+    self.counts = dd(lambda: dd(int))
+    self.lines = dd(lambda: dd(list))
+
+  def _change(self, type, change):
+    self.counts[type][change] += 1
+    seen = self.lines[type][change]
+    if not seen or seen[-1] != self.linenumber:
+      seen.append(self.linenumber)
+
+  def _fix2(self, m):
+    c1 = bytes((m.group(1)[0]+0x40,))
+    if self.report:
+      self._change(b"CHANGE2", m.group(0)+b" TO "+c1+m.group(2))
+    return c1+m.group(2)
+
+  def _fix3(self, m):
+    c1 = bytes((m.group(1)[0]+0x40,))
+    if self.report:
+      self._change(b"CHANGE3", m.group(0)+b" TO "+c1+m.group(2)+m.group(3))
+    return c1+m.group(2)+m.group(3)
+
+  def _delete(self, m):
+    self._change(b"DELETE1", m.group(0))
+    return b""
+
+  def _space(self, m):
+    self._change(b"NORM_SP", m.group(0))
+    return b" "
+
+  def clean(self, line):
+    ''' the wildeclean'ed line '''
+    self.linenumber += 1
+    line = _wilde2.sub(self._fix2, line)
+    line = _wilde3.sub(self._fix3, line)
+    line = _wildedelete.sub(self._delete if self.report else b"", line)
+    line = _wildespace.sub(self._space if self.report else b" ", line)
+    if _wildeempty.fullmatch(line):
+      if self.report:
+        self._change(b"NOZERO", b"empty to _")
+      line = b"_\n"
+    return line
+
+  def writereport(self, fh):
+    ''' the -r report, to a binary handle '''
+    total = 0
+    for type in sorted(self.counts):
+      counts = self.counts[type]
+      for change in sorted(counts, key=lambda c: -counts[c]):
+        total += counts[change]
+        lines = [b"%d" % n for n in self.lines[type][change]]
+        if len(lines) > 10:
+          lines[10:] = [b"..."]
+        fh.write(b"%s %s (%d) in lines %s\n" % (type, change, counts[change], b" ".join(lines)))
+      fh.write(b"\n")
+    fh.write(b"Total number of changes: %d\n" % total)
+
+def nfkc(text):
+  ''' NFKC normal form of text, skipping the work when it already is '''
+  if text.isascii() or ud.is_normalized('NFKC', text):
+    return text
+  return ud.normalize('NFKC', text)
+
+class Cleaner(object):
+  ''' clean.sh, one line (bytes) at a time '''
+  def __init__(self, report=False):
+    self.wilde = WildeCleaner(report)
+    self.skipped = 0
+
+  def clean(self, line):
+    ''' the cleaned line as text, or None if it isn't utf-8 (nfkc.py drops those) '''
+    try:
+      return nfkc(self.wilde.clean(line).decode('utf-8'))
+    except UnicodeDecodeError:
+      self.skipped += 1
+      return None
+
+  def writereport(self, fh=None):
+    ''' what clean.sh would have written to stderr '''
+    if fh is None:
+      sys.stderr.flush()
+      fh = sys.stderr.buffer
+    if self.wilde.report:
+      self.wilde.writereport(fh)
+    if self.skipped > 0:
+      fh.write(b"%d lines skipped for unicode errors\n" % self.skipped)
+    fh.flush()
+
+class CleanTee(object):
+  ''' text file handle that also writes the clean.sh version of what it is given to cleanpath '''
+  def __init__(self, fh, cleanpath, report=True):
+    self.fh = fh
+    self.name = fh.name
+    self.cleanfh = open(cleanpath, 'w')
+    self.cleaner = Cleaner(report)
+    self.partial = ""
+
+  def write(self, text):
+    self.fh.write(text)
+    lines = (self.partial+text).split("\n")
+    self.partial = lines.pop()
+    for line in lines:
+      self._clean(line+"\n")
+
+  def _clean(self, line):
+    # surrogates can sneak in from the source; clean.sh would see them as bad bytes
+    clean = self.cleaner.clean(line.encode('utf-8', 'surrogateescape'))
+    if clean is not None:
+      self.cleanfh.write(clean)
+
+  def flush(self):
+    self.fh.flush()
+    self.cleanfh.flush()
+
+  def close(self):
+    if self.partial:
+      self._clean(self.partial)
+      self.partial = ""
+    self.fh.close()
+    if not self.cleanfh.closed:
+      self.cleanfh.close()
+      self.cleaner.writereport()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+# the tokenizers that cdectok.sh and agiletok.sh wrap. A TokenizerPool runs
+# them directly, without the wrapper's shell, tee and sed, on several shards
+# at once; they are line-by-line, so the shards' output put together is
+# the output of one run over the whole file
+_wrappedtokenizers = {
+  'cdectok.sh': os.path.join(scriptdir, 'cdectok', 'tokenize-anything.sh'),
+  'agiletok.sh': os.path.join(scriptdir, 'agile_tokenizer', 'gale-eng-tok.sh'),
+}
+_tokenizerpools = {}
+_tokenizerlock = threading.Lock()
+
+def sedlower(text):
+  ''' lowercase text as the wrappers' sed \\L does: one character to one character, no final sigma '''
+  return text.replace('İ', 'i').replace('Σ', 'σ').lower()
+
+class TokenCache(object):
+  ''' tokenizer output for lines seen before, kept in sqlite at path and keyed by
+  (tokenizer, line). Holds about maxentries lines, dropping the least recently used;
+  hit and miss counts since resetstats() are kept with it '''
+  def __init__(self, path, maxentries=None):
+    import sqlite3
+    self.path = path
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, timeout=600, check_same_thread=False)
+    with self.lock, self.db:
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, out BLOB, used REAL)")
+      self.db.execute("CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)")
+      self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+      if maxentries is not None:
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('maxentries', ?)", (maxentries,))
+      row = self.db.execute("SELECT value FROM meta WHERE name='maxentries'").fetchone()
+    self.maxentries = row[0] if row is not None else 5000000
+    self.added = 0
+    self.evict()
+
+  @staticmethod
+  def key(toolid, line):
+    import hashlib
+    return hashlib.sha1(toolid+b"\0"+line).digest()
+
+  def get(self, keys):
+    ''' key -> cached output line for those of keys that are cached '''
+    import time
+    keys = list(set(keys))
+    found = {}
+    with self.lock, self.db:
+      for start in range(0, len(keys), 500):
+        chunk = keys[start:start+500]
+        marks = ",".join("?"*len(chunk))
+        found.update(self.db.execute("SELECT key, out FROM tokens WHERE key IN (%s)" % marks, chunk))
+        self.db.execute("UPDATE tokens SET used=? WHERE key IN (%s)" % marks, [time.time()]+chunk)
+    return found
+
+  def put(self, pairs, hits, misses):
+    ''' cache (key, output line) pairs, and count lines that were and weren't found '''
+    import time
+    now = time.time()
+    pairs = [(key, out, now) for key, out in pairs]
+    with self.lock, self.db:
+      self.db.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", pairs)
+      for name, count in (('hits', hits), ('misses', misses)):
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES (?, 0)", (name,))
+        self.db.execute("UPDATE meta SET value=value+? WHERE name=?", (count, name))
+      self.added += len(pairs)
+      due = self.added*10 > self.maxentries
+    if due:
+      self.evict()
+
+  def evict(self):
+    ''' drop the least recently used lines beyond maxentries '''
+    with self.lock, self.db:
+      self.added = 0
+      over = self.db.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]-self.maxentries
+      if over > 0:
+        self.db.execute("DELETE FROM tokens WHERE key IN (SELECT key FROM tokens ORDER BY used LIMIT ?)", (over,))
+
+  def seed(self, path):
+    ''' take in the lines cached at path (by a previous extraction, say) '''
+    with self.lock:
+      self.db.execute("ATTACH DATABASE ? AS seed", (path,))
+      try:
+        with self.db:
+          self.db.execute("INSERT OR IGNORE INTO tokens SELECT * FROM seed.tokens")
+      finally:
+        self.db.execute("DETACH DATABASE seed")
+    self.evict()
+
+  def resetstats(self):
+    with self.lock, self.db:
+      self.db.execute("DELETE FROM meta WHERE name IN ('hits', 'misses')")
+
+  def stats(self):
+    ''' hits, misses, hit rate and size, for the run report '''
+    with self.lock:
+      counts = dict(self.db.execute("SELECT name, value FROM meta"))
+      entries = self.db.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+    hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+    return {"path":self.path, "hits":hits, "misses":misses,
+            "hit_rate":hits/(hits+misses) if hits+misses > 0 else None,
+            "entries":entries, "maxentries":self.maxentries}
+
+_tokencaches = {}
+
+def tokencache():
+  ''' the TokenCache named by $LRLP_TOKCACHE, if any '''
+  path = os.environ.get("LRLP_TOKCACHE")
+  if not path:
+    return None
+  with _tokenizerlock:
+    if path not in _tokencaches:
+      _tokencaches[path] = TokenCache(path)
+    return _tokencaches[path]
+
+def fileshards(path, count):
+  ''' the bytes of path in count (or fewer) pieces that end at line ends, cut by offset, read as asked for '''
+  size = os.path.getsize(path)
+  if size == 0:
+    return
+  cuts = [0]
+  with open(path, 'rb') as fh:
+    for i in range(1, count):
+      offset = size*i//count
+      if offset <= cuts[-1]:
+        continue
+      # to the end of the line holding the byte before the cut
+      fh.seek(offset-1)
+      fh.readline()
+      if fh.tell() >= size:
+        break
+      if fh.tell() > cuts[-1]:
+        cuts.append(fh.tell())
+    cuts.append(size)
+    for start, end in zip(cuts, cuts[1:]):
+      fh.seek(start)
+      yield fh.read(end-start)
+
+def lineshards(lines, shardbytes):
+  ''' lines (str or bytes) gathered into pieces of bytes of about shardbytes '''
+  shard = []
+  length = 0
+  for line in lines:
+    if not isinstance(line, bytes):
+      line = line.encode('utf-8', 'surrogateescape')
+    shard.append(line if line.endswith(b"\n") else line+b"\n")
+    length += len(shard[-1])
+    if length >= shardbytes:
+      yield b"".join(shard)
+      shard = []
+      length = 0
+  if shard:
+    yield b"".join(shard)
+
+class TokenizerPool(object):
+  ''' run a line-by-line tokenizer over shards of its input, workers shards at once, from any number of threads.
+      cmd reads the shard on stdin; one that wants a file name can be given /dev/stdin '''
+  def __init__(self, cmd, workers=4, shardbytes=1<<24, check=False, quiet=True, cache=False):
+    from concurrent.futures import ThreadPoolExecutor
+    self.cmd = cmd
+    self.workers = workers
+    self.shardbytes = shardbytes
+    self.check = check
+    self.quiet = quiet
+    # only for tokenizers whose output is their stdout, line for line; see tokencache()
+    self.cache = cache
+    self._toolid = None
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+    # whole files wait on shards, so they get threads of their own
+    self.files = ThreadPoolExecutor(max_workers=workers)
+
+  def toolid(self):
+    ''' what the tokenizer is: its command and the contents of the scripts it names '''
+    import hashlib
+    if self._toolid is None:
+      h = hashlib.sha1()
+      scripts = [arg for arg in self.cmd if os.path.isfile(arg)]
+      if len(self.cmd) > 0 and os.path.isfile(self.cmd[0]):
+        # a tokenizer is usually a script that runs the others next to it
+        for root, dirs, files in os.walk(os.path.dirname(os.path.abspath(self.cmd[0]))):
+          dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+          scripts.extend(os.path.join(root, f) for f in sorted(files))
+      for arg in self.cmd:
+        h.update(arg.encode('utf-8', 'surrogateescape')+b"\0")
+      for script in scripts:
+        with open(script, 'rb') as f:
+          h.update(f.read())
+      self._toolid = h.digest()
+    return self._toolid
+
+  def _tokenize(self, shard):
+    # like the wrappers, tokenizer complaints go nowhere unless asked for
+    with open(os.devnull, 'w') as devnull:
+      proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=devnull if self.quiet else None)
+      out, _ = proc.communicate(shard)
+    if self.check and proc.returncode != 0:
+      raise CalledProcessError(proc.returncode, self.cmd)
+    return out, proc.returncode == 0
+
+  def _run(self, shard):
+    cache = tokencache() if self.cache else None
+    if cache is None or not shard.endswith(b"\n"):
+      return self._tokenize(shard)[0]
+    lines = shard[:-1].split(b"\n")
+    keys = [cache.key(self.toolid(), line) for line in lines]
+    found = cache.get(keys)
+    missing = {}
+    for key, line in zip(keys, lines):
+      if key not in found and key not in missing:
+        missing[key] = line
+    pairs = []
+    if missing:
+      out, ok = self._tokenize(b"".join(line+b"\n" for line in missing.values()))
+      outlines = out[:-1].split(b"\n") if out.endswith(b"\n") else []
+      if not ok or len(outlines) != len(missing):
+        # not line for line this time (a failure, or a \r cdec splits on); leave it out of the cache
+        return out if len(missing) == len(lines) else self._tokenize(shard)[0]
+      pairs = list(zip(missing, outlines))
+      found.update(pairs)
+    cache.put(pairs, len(lines)-len(missing), len(missing))
+    return b"".join(found[key]+b"\n" for key in keys)
+
+  def tokenize(self, shards):
+    ''' tokenizer output (bytes) for each shard (bytes), in order '''
+    pending = []
+    for shard in shards:
+      pending.append(self.executor.submit(self._run, shard))
+      # shards finish in any order; keep a few ahead, not the whole input in memory
+      if len(pending) > 2*self.workers:
+        yield pending.pop(0).result()
+    for future in pending:
+      yield future.result()
+
+  def tokenize_lines(self, lines):
+    ''' tokenized text of an in-memory stream of lines, in pieces, in order '''
+    for out in self.tokenize(lineshards(lines, self.shardbytes)):
+      yield out.decode('utf-8', 'surrogateescape')
+
+  def shards(self, path):
+    ''' the file at path in shards: at least one per worker, none much over shardbytes '''
+    return fileshards(path, max(self.workers, -(-os.path.getsize(path)//self.shardbytes)))
+
+  def tokenize_path(self, path):
+    ''' tokenized text of the file at path, in pieces, in order '''
+    for out in self.tokenize(self.shards(path)):
+      yield out.decode('utf-8', 'surrogateescape')
+
+  def tokenize_file(self, infile, lcfile, tokfile):
+    ''' what wrapper -i infile -o lcfile -t tokfile does '''
+    with open(lcfile, 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as lcfh, \
+         open(tokfile, 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as tokfh:
+      for text in self.tokenize_path(infile):
+        tokfh.write(text)
+        lcfh.write(sedlower(text))
+
+  def submit_file(self, infile, lcfile, tokfile):
+    ''' tokenize_file in the background; returns its Future '''
+    return self.files.submit(self.tokenize_file, infile, lcfile, tokfile)
+
+def tokenizerpool(wrapper, workers=4):
+  ''' the shared TokenizerPool for what wrapper runs, or None if it isn't one of the wrappers here '''
+  if workers < 1 or os.path.dirname(os.path.abspath(wrapper)) != scriptdir:
+    return None
+  cmd = _wrappedtokenizers.get(os.path.basename(wrapper))
+  if cmd is None or not os.path.exists(cmd):
+    return None
+  with _tokenizerlock:
+    if cmd not in _tokenizerpools:
+      _tokenizerpools[cmd] = TokenizerPool([cmd], workers, cache=True)
+    return _tokenizerpools[cmd]
 
 
 # http://stackoverflow.com/questions/1158076/implement-touch-using-python
@@ -71,6 +538,534 @@ def mkdir_p(path):
       pass
     else: raise
 
+# Reading an lrlp straight out of its tarballs. A TarIndex records where each
+# file of the expanded lrlp lives inside the tarballs; when LRLP_TARINDEX names
+# one (see index_lrlp.py), the fs_* functions below overlay it on the real
+# directory tree, so the extractors find files that were never unpacked.
+# Files that exist on disk always win.
+
+class _MemberFile(io.BufferedReader):
+  ''' a tar member read into memory (or a temp file, if big) '''
+  def __init__(self, raw, name):
+    super().__init__(raw)
+    self._name = name
+  @property
+  def name(self):
+    return self._name
+
+def _opentar(path):
+  ''' the decompressed byte stream of a tarball '''
+  import bz2
+  import gzip
+  import lzma
+  with open(path, 'rb') as f:
+    magic = f.read(6)
+  if magic.startswith(b'\x1f\x8b'):
+    return gzip.open(path, 'rb')
+  if magic.startswith(b'BZh'):
+    return bz2.open(path, 'rb')
+  if magic.startswith(b'\xfd7zXZ\x00'):
+    return lzma.open(path, 'rb')
+  return open(path, 'rb')
+
+class TarIndex:
+  ''' where the files of an lrlp live inside its tarballs '''
+  spoolsize = 64*1024*1024
+  def __init__(self, path):
+    import json
+    with open(path) as f:
+      data = json.load(f)
+    self.path = path
+    self.root = data["root"]
+    self.tarballs = data["tarballs"]
+    self.members = data["members"]
+    # directory -> its entries (as an ordered set), in tarball order
+    self.dirs = dd(dict)
+    self.dirs["."] = {}
+    for rel in sorted(self.members, key=lambda x: self.members[x][:2]):
+      child = rel
+      while child != ".":
+        parent = os.path.dirname(child) or "."
+        known = parent in self.dirs
+        self.dirs[parent][os.path.basename(child)] = None
+        if known:
+          break
+        child = parent
+    self.preloaded = {}
+    self.local = threading.local()
+
+  @staticmethod
+  def build(tarballs, root, path, materialize=lambda rel: False):
+    ''' index the tarballs as if unpacked into root, the way unpack_lrlp.sh
+    does it (top directory of each stripped, dot files dropped, later
+    tarballs win). Members for which materialize(rel) is true are written
+    to disk under root as well. Everything is done in one pass per tarball '''
+    import json
+    import shutil
+    import tarfile
+    root = os.path.abspath(root)
+    members = {}
+    for t, tarball in enumerate(tarballs):
+      with tarfile.open(tarball, 'r:*') as tar:
+        for member in tar:
+          parts = [x for x in os.path.normpath(member.name).split(os.sep) if x not in ('', '.')]
+          if len(parts) < 2 or not member.isfile() or parts[-1].startswith('.'):
+            continue
+          rel = os.path.join(*parts[1:])
+          members[rel] = [t, member.offset_data, member.size]
+          if materialize(rel):
+            dest = os.path.join(root, rel)
+            mkdir_p(os.path.dirname(dest))
+            with tar.extractfile(member) as ifh, open(dest, 'wb') as ofh:
+              shutil.copyfileobj(ifh, ofh)
+    tmp = path+".tmp"
+    with open(tmp, 'w') as f:
+      json.dump({"root":root, "tarballs":[os.path.abspath(x) for x in tarballs],
+                 "members":members}, f)
+    os.replace(tmp, path)
+    return TarIndex(path)
+
+  def rel(self, path):
+    ''' path relative to the lrlp root, or None if outside of it '''
+    rel = os.path.relpath(os.path.abspath(path), self.root)
+    if rel == os.pardir or rel.startswith(os.pardir+os.sep):
+      return None
+    return rel
+
+  def isfile(self, path):
+    rel = self.rel(path)
+    return rel is not None and rel in self.members
+
+  def isdir(self, path):
+    rel = self.rel(path)
+    return rel is not None and rel in self.dirs
+
+  def listdir(self, path):
+    ''' entries of a directory, in tarball order '''
+    return list(self.dirs.get(self.rel(path), []))
+
+  def _stream(self, t, offset):
+    ''' this thread's decompressed stream of tarball t, positioned at offset.
+    Streams only move forward, so reading in tarball order is cheapest '''
+    streams = getattr(self.local, 'streams', None)
+    if streams is None:
+      streams = self.local.streams = {}
+    stream = streams.get(t)
+    if stream is None or stream.tell() > offset:
+      if stream is not None:
+        stream.close()
+      stream = streams[t] = _opentar(self.tarballs[t])
+    stream.seek(offset)
+    return stream
+
+  def _spool(self, stream, size):
+    ''' the next size bytes of stream, as a seekable raw file '''
+    import tempfile
+    if size <= self.spoolsize:
+      return io.BytesIO(stream.read(size))
+    raw = tempfile.TemporaryFile(buffering=0)
+    left = size
+    while left > 0:
+      chunk = stream.read(min(left, 1024*1024))
+      if not chunk:
+        break
+      raw.write(chunk)
+      left -= len(chunk)
+    raw.seek(0)
+    return raw
+
+  def open(self, path):
+    ''' a binary, seekable file object with the contents of a member '''
+    rel = self.rel(path)
+    if rel in self.preloaded:
+      return _MemberFile(io.BytesIO(self.preloaded[rel]), path)
+    t, offset, size = self.members[rel]
+    return _MemberFile(self._spool(self._stream(t, offset), size), path)
+
+  def preload(self, paths, limit=1024*1024*1024):
+    ''' read every member under the given paths into memory in one pass (up
+    to limit bytes), so they can then be read in any order cheaply '''
+    wanted = []
+    for path in paths:
+      rel = self.rel(path)
+      if rel is None:
+        continue
+      prefix = "" if rel == "." else rel+os.sep
+      for member, entry in self.members.items():
+        if (member == rel or member.startswith(prefix)) and member not in self.preloaded:
+          wanted.append((entry, member))
+    total = 0
+    for (t, offset, size), member in sorted(wanted):
+      if total+size > limit:
+        break
+      self.preloaded[member] = self._stream(t, offset).read(size)
+      total += size
+
+class Inventory:
+  ''' the directory tree of an expanded lrlp, listed with os.scandir and kept
+  in a file next to it. A directory is only listed again when its mtime changes '''
+  # file kind -> name suffix (alignment files are also anything under sentence_alignment)
+  kinds = (("ltf", "ltf.xml"), ("laf", "laf.xml"), ("psm", "psm.xml"),
+           ("zip", ".zip"), ("tab", ".tab"), ("align", ".align"))
+
+  def __init__(self, path, root=None):
+    import json
+    import atexit
+    self.path = path
+    self.dirs = {}
+    data = {}
+    if os.path.exists(path):
+      try:
+        with open(path) as f:
+          data = json.load(f)
+      except ValueError:
+        data = {}
+    if root is None:
+      root = data["root"]
+    self.root = os.path.abspath(root)
+    if data.get("root") == self.root:
+      self.dirs = data["dirs"]
+    # directories known to be up to date in this process
+    self.checked = set()
+    self.dirty = False
+    self.lock = threading.Lock()
+    atexit.register(self.save)
+
+  @staticmethod
+  def kind(path):
+    ''' the kind (see Inventory.kinds) of a file, or None '''
+    for kind, suffix in Inventory.kinds:
+      if path.endswith(suffix):
+        return kind
+    if os.path.basename(os.path.dirname(path)) == "sentence_alignment":
+      return "align"
+    return None
+
+  def rel(self, path):
+    ''' path relative to the lrlp root, or None if outside of it '''
+    rel = os.path.relpath(os.path.abspath(path), self.root)
+    if rel == os.pardir or rel.startswith(os.pardir+os.sep):
+      return None
+    return rel
+
+  def _scan(self, full, st):
+    import time
+    entry = {"names":[], "dirs":[], "files":[], "links":[]}
+    with os.scandir(full) as it:
+      for e in it:
+        entry["names"].append(e.name)
+        try:
+          if e.is_dir():
+            entry["dirs"].append(e.name)
+            if e.is_symlink():
+              entry["links"].append(e.name)
+          elif e.is_file():
+            entry["files"].append(e.name)
+        except OSError:
+          pass
+    # a directory changed within the mtime granularity may change again unnoticed
+    entry["mtime"] = st.st_mtime_ns if time.time_ns()-st.st_mtime_ns > 2*10**9 else None
+    return entry
+
+  def _dir(self, rel):
+    ''' the up to date listing of directory rel, or None if it isn't one '''
+    import stat
+    with self.lock:
+      if rel in self.checked:
+        return self.dirs.get(rel)
+      self.checked.add(rel)
+      full = os.path.join(self.root, rel)
+      try:
+        st = os.stat(full)
+      except OSError:
+        st = None
+      if st is None or not stat.S_ISDIR(st.st_mode):
+        if self.dirs.pop(rel, None) is not None:
+          self.dirty = True
+        return None
+      entry = self.dirs.get(rel)
+      if entry is None or entry["mtime"] != st.st_mtime_ns:
+        entry = self.dirs[rel] = self._scan(full, st)
+        self.dirty = True
+      return entry
+
+  def _parent(self, rel):
+    if rel is None or rel == ".":
+      return None, None
+    return self._dir(os.path.dirname(rel) or "."), os.path.basename(rel)
+
+  def isdir(self, path):
+    rel = self.rel(path)
+    if rel == ".":
+      return self._dir(rel) is not None
+    parent, name = self._parent(rel)
+    return parent is not None and name in parent["dirs"]
+
+  def isfile(self, path):
+    parent, name = self._parent(self.rel(path))
+    return parent is not None and name in parent["files"]
+
+  def listdir(self, path):
+    ''' entries of a directory, in os.listdir order '''
+    entry = self._dir(self.rel(path))
+    if entry is None:
+      raise FileNotFoundError(2, "No such directory", path)
+    return list(entry["names"])
+
+  def walk(self, path):
+    ''' os.walk (top down, not following links) '''
+    entry = self._dir(self.rel(path))
+    if entry is None:
+      return
+    dirs = list(entry["dirs"])
+    isdir = set(dirs)
+    yield path, dirs, [x for x in entry["names"] if x not in isdir]
+    links = set(entry["links"])
+    for name in dirs:
+      if name not in links:
+        yield from self.walk(os.path.join(path, name))
+
+  def refresh(self):
+    ''' bring the whole inventory up to date and save it '''
+    for root, dirs, files in self.walk(self.root):
+      pass
+    # directories that are gone
+    for rel in list(self.dirs):
+      self._dir(rel)
+    self.save()
+
+  def save(self):
+    import json
+    with self.lock:
+      if not self.dirty:
+        return
+      tmp = "%s.%d.tmp" % (self.path, os.getpid())
+      try:
+        with open(tmp, 'w') as f:
+          json.dump({"root":self.root, "dirs":self.dirs}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+      except OSError as e:
+        sys.stderr.write("Couldn't save inventory %s: %s\n" % (self.path, e))
+
+_tarindexes = {}
+_tarindexlocal = threading.local()
+_inventories = {}
+_inventorylocal = threading.local()
+
+def _afterfork():
+  # a forked child shares the file offsets of the parent's open tarball
+  # streams; it has to open its own. Locks held by other threads stay held
+  for index in _tarindexes.values():
+    index.local = threading.local()
+  for inv in _inventories.values():
+    inv.lock = threading.Lock()
+  # and has none of the parent's tokenizer threads, nor can it use its sqlite connections
+  global _tokenizerlock
+  _tokenizerpools.clear()
+  _tokencaches.clear()
+  _tokenizerlock = threading.Lock()
+os.register_at_fork(after_in_child=_afterfork)
+
+def tarindex():
+  ''' the TarIndex named by $LRLP_TARINDEX (or using_tarindex), if any '''
+  path = getattr(_tarindexlocal, "path", os.environ.get("LRLP_TARINDEX"))
+  if not path:
+    return None
+  if path not in _tarindexes:
+    _tarindexes[path] = TarIndex(path)
+  return _tarindexes[path]
+
+def inventory():
+  ''' the Inventory named by $LRLP_INVENTORY (or using_inventory), if any '''
+  path = getattr(_inventorylocal, "path", os.environ.get("LRLP_INVENTORY"))
+  if not path:
+    return None
+  if path not in _inventories:
+    if not os.path.exists(path):
+      return None
+    _inventories[path] = Inventory(path)
+  return _inventories[path]
+
+def update_inventory(root, path):
+  ''' make (or bring up to date) the inventory of root, kept at path '''
+  if path not in _inventories or _inventories[path].root != os.path.abspath(root):
+    _inventories[path] = Inventory(path, root)
+  _inventories[path].refresh()
+  return _inventories[path]
+
+class _usingpath:
+  ''' with ...: override the path taken from the environment, in this thread '''
+  local = None
+  def __init__(self, path):
+    self.path = path
+  def __enter__(self):
+    self.old = getattr(self.local, "path", None)
+    self.had = hasattr(self.local, "path")
+    self.local.path = self.path
+    return self
+  def __exit__(self, *exc):
+    if self.had:
+      self.local.path = self.old
+    else:
+      del self.local.path
+    return False
+
+class using_tarindex(_usingpath):
+  ''' with using_tarindex(path): make the fs_* functions in this thread use
+  the given index (None for none) for the duration '''
+  local = _tarindexlocal
+
+class using_inventory(_usingpath):
+  ''' with using_inventory(path): make the fs_* functions in this thread use
+  the given inventory (None for none) for the duration '''
+  local = _inventorylocal
+
+def _ondisk(path):
+  ''' the inventory that lists path, if any '''
+  inv = inventory()
+  if inv is None or inv.rel(path) is None:
+    return None
+  return inv
+
+def fs_exists(path):
+  ''' os.path.exists, for a possibly unexpanded lrlp '''
+  return fs_isfile(path) or fs_isdir(path)
+
+def fs_isfile(path):
+  ''' os.path.isfile, for a possibly unexpanded (or inventoried) lrlp '''
+  index = tarindex()
+  inv = _ondisk(path)
+  if inv is not None and index is None:
+    return inv.isfile(path)
+  return os.path.isfile(path) or (index is not None and index.isfile(path))
+
+def fs_isdir(path):
+  ''' os.path.isdir, for a possibly unexpanded (or inventoried) lrlp '''
+  index = tarindex()
+  inv = _ondisk(path)
+  if inv is not None and index is None:
+    return inv.isdir(path)
+  return os.path.isdir(path) or (index is not None and index.isdir(path))
+
+def fs_listdir(path):
+  ''' os.listdir, for a possibly unexpanded (or inventoried) lrlp '''
+  index = tarindex()
+  inv = _ondisk(path)
+  if inv is not None and index is None:
+    return inv.listdir(path)
+  if index is None or not index.isdir(path):
+    return os.listdir(path)
+  ret = os.listdir(path) if os.path.isdir(path) else []
+  ondisk = set(ret)
+  ret.extend(x for x in index.listdir(path) if x not in ondisk)
+  return ret
+
+def fs_walk(path):
+  ''' os.walk, for a possibly unexpanded (or inventoried) lrlp '''
+  if tarindex() is None:
+    inv = _ondisk(path)
+    if inv is not None:
+      yield from inv.walk(path)
+    else:
+      yield from os.walk(path)
+    return
+  if not fs_isdir(path):
+    return
+  names = fs_listdir(path)
+  dirs = [x for x in names if fs_isdir(os.path.join(path, x))]
+  isdir = set(dirs)
+  files = [x for x in names if x not in isdir]
+  yield path, dirs, files
+  for name in dirs:
+    yield from fs_walk(os.path.join(path, name))
+
+def fs_glob(pattern):
+  ''' sorted glob.glob, for a possibly unexpanded lrlp '''
+  import fnmatch
+  import glob
+  if tarindex() is None:
+    return sorted(glob.glob(pattern))
+  dirname, basename = os.path.split(pattern)
+  if glob.has_magic(dirname):
+    dirs = [x for x in fs_glob(dirname) if fs_isdir(x)]
+  else:
+    dirs = [dirname,]
+  ret = []
+  for dir in dirs:
+    if not glob.has_magic(basename):
+      if fs_exists(os.path.join(dir, basename)):
+        ret.append(os.path.join(dir, basename))
+      continue
+    if not fs_isdir(dir or os.curdir):
+      continue
+    names = fs_listdir(dir or os.curdir)
+    if not basename.startswith('.'):
+      names = [x for x in names if not x.startswith('.')]
+    ret.extend(os.path.join(dir, x) for x in fnmatch.filter(names, basename))
+  return sorted(ret)
+
+def fs_find(path, kind=None, docid=None):
+  ''' files under path of a kind (see Inventory.kinds) and/or for a docid
+  (file name up to the first .), in walk order '''
+  ret = []
+  for root, dirs, files in fs_walk(path):
+    for file in files:
+      if docid is not None and file.split('.')[0] != docid:
+        continue
+      if kind is not None and Inventory.kind(os.path.join(root, file)) != kind:
+        continue
+      ret.append(os.path.join(root, file))
+  return ret
+
+def fs_open(path, mode='r', encoding=None, errors=None):
+  ''' open (for reading), for a possibly unexpanded lrlp '''
+  index = tarindex()
+  if index is None or 'r' not in mode or os.path.exists(path) or not index.isfile(path):
+    return open(path, mode, encoding=encoding, errors=errors)
+  fh = index.open(path)
+  if 'b' in mode:
+    return fh
+  return io.TextIOWrapper(fh, encoding=encoding, errors=errors)
+
+def fs_copy(src, dst):
+  ''' copy a file or a tree, for a possibly unexpanded lrlp '''
+  import shutil
+  if os.path.exists(src) and tarindex() is None:
+    if os.path.isdir(src):
+      shutil.copytree(src, dst)
+    else:
+      shutil.copy(src, dst)
+    return
+  if not fs_isdir(src):
+    if os.path.isdir(dst):
+      dst = os.path.join(dst, os.path.basename(src))
+    with fs_open(src, 'rb') as ifh, open(dst, 'wb') as ofh:
+      shutil.copyfileobj(ifh, ofh)
+    return
+  for root, dirs, files in fs_walk(src):
+    target = os.path.join(dst, os.path.relpath(root, src))
+    mkdir_p(target)
+    for file in files:
+      with fs_open(os.path.join(root, file), 'rb') as ifh, \
+           open(os.path.join(target, file), 'wb') as ofh:
+        shutil.copyfileobj(ifh, ofh)
+
+def fs_parse(path):
+  ''' ET.parse, for a possibly unexpanded lrlp '''
+  with fs_open(path, 'rb') as fh:
+    return ET.parse(fh)
+
+class FileType(argparse.FileType):
+  ''' argparse.FileType that can also open files of an unexpanded lrlp '''
+  def __call__(self, string):
+    if string == '-' or 'r' not in self._mode or tarindex() is None or os.path.exists(string):
+      return super().__call__(string)
+    try:
+      return fs_open(string, self._mode, encoding=self._encoding, errors=self._errors)
+    except (OSError, KeyError) as exc:
+      raise argparse.ArgumentTypeError("can't open '%s': %s" % (string, exc))
+
 def funornone(entity, fun, default="None"):
   ''' Apply fun to entity if it is not NoneType. Otherwise, return default '''
   if entity is None:
@@ -99,11 +1094,11 @@ def get_aligned_sentences_flat(srcfile, trgfile, alignfile):
   tids = []
   s = None
   t = None
-  with codecs.open(srcfile, 'r', 'utf-8') as f:
+  with codecs.getreader('utf-8')(fs_open(srcfile, 'rb')) as f:
     s = f.read()
-  with codecs.open(trgfile, 'r', 'utf-8') as f:
+  with codecs.getreader('utf-8')(fs_open(trgfile, 'rb')) as f:
     t = f.read()
-  with open(alignfile) as f:
+  with fs_open(alignfile) as f:
     for line in f.readlines():
       ss, sl, ts, tl = list(map(int, line.strip().split('\t')))
       slines.append(s[ss:ss+sl]+"\n")
@@ -135,13 +1130,22 @@ def spans_from_xml(spans, xml, tokenize):
                      tok.find("ORIGINAL_TEXT"), tok.get('id')))
       except TypeError:
         continue
+  # tokens of an ltf don't overlap, so their ends are sorted and the first
+  # token that can be in a span is found by bisection. If they aren't, every
+  # span has to look at every token
+  ends = [e for s, e, tok, id in toks]
+  sortedends = all(a <= b for a, b in zip(ends, ends[1:]))
   segid = ""
   for start, end in spans:
     span = []
     firsts = 0
     laste = 0
-    # TODO: make more efficient; consume tokens!
-    for s, e, tok, id in toks:
+    first = bisect.bisect_left(ends, start) if sortedends else 0
+    if first > 0:
+      # the tokens skipped over would have been visited (and skipped) too
+      segid = toks[first-1][3]
+    for idx in range(first, len(toks)):
+      s, e, tok, id = toks[idx]
       segid = id
       # Not yet in range (move on)
       if e < start:
@@ -172,7 +1176,7 @@ def get_spans_from_flat_al(alignfile):
   ''' using flat align files, get sentence spans '''
   srcspans = []
   trgspans = []
-  with open(alignfile) as f:
+  with fs_open(alignfile) as f:
     for line in f.readlines():
       ss, sl, ts, tl = list(map(int, line.strip().split('\t')))
       srcspans.append((ss, ss+sl-1))
@@ -190,10 +1194,10 @@ def get_spans_from_xml_al(alignfile, srcfile, trgfile):
   ''' using xml align files, get sentence spans '''
   srcspans = []
   trgspans = []
-  alroot = ET.parse(alignfile)
-  srcroot = ET.parse(srcfile)
+  alroot = fs_parse(alignfile)
+  srcroot = fs_parse(srcfile)
   srctable = _get_seg_table(srcroot)
-  trgroot = ET.parse(trgfile)
+  trgroot = fs_parse(trgfile)
   trgtable = _get_seg_table(trgroot)
 
   count = 0
@@ -215,10 +1219,9 @@ def _get_seg_by_id(xmlfile):
   ''' quickly (?) build a dict of id->seg
   also return docid '''
   table = {}
-  root = ET.parse(xmlfile)
-  docid = root.find('.//DOC').get('id')
-  for seg in root.findall(".//SEG"):
-    table[seg.get('id')]=seg
+  docid, segs = read_ltf(xmlfile)
+  for seg in segs:
+    table[seg.id]=seg
   return docid, table
 
 
@@ -230,7 +1233,7 @@ def _fast_get_aligned_data(srcfile, trgfile, alignfile):
 
   srcdoc, srctable = _get_seg_by_id(srcfile)
   trgdoc, trgtable = _get_seg_by_id(trgfile)
-  alroot = ET.parse(alignfile)
+  alroot = fs_parse(alignfile)
   sys.stderr.write("Getting data from {} : {} <-> {}\n".format(alignfile, srcfile, trgfile))
   for align in alroot.findall(".//alignment"):
     srcsegs = align.find(".//source").get('segments').split(' ')
@@ -269,13 +1272,13 @@ def _fast_get_aligned_data(srcfile, trgfile, alignfile):
       morphseg = []
       for seg in segs:
         segx = table[seg]
-        orig.append(segx.find('.//ORIGINAL_TEXT').text)
-        segid.append(segx.get('id'))
+        orig.append(segx.text)
+        segid.append(segx.id)
         subtok = []
         subpos = []
         submorph = []
         submorphseg = []
-        for tokx in segx.findall('.//TOKEN'):
+        for tokx in segx.tokens:
           subtok.append(tokx.text)
           subpos.append(tokx.get('pos') or "None")
           for mt, mtt in morph_tok(tokx):
@@ -310,7 +1313,7 @@ def get_aligned_sentences_xml(srcfile, trgfile, alignfile, alxml=False):
   else:
     srcspans, trgspans = get_spans_from_flat_al(alignfile)
   for file, spans, data in zip((srcfile, trgfile), (srcspans, trgspans), (sdata, tdata)):
-    root = ET.parse(file)
+    root = fs_parse(file)
     # cf. get_segments
     for span, docid, _, start, end in spans_from_xml(spans, root, True):
       data["DOCID"].append(docid)
@@ -328,7 +1331,7 @@ def get_aligned_sentences_xml(srcfile, trgfile, alignfile, alxml=False):
       data["MORPH"].append(' '.join(mt_tmp)+'\n')
       data["MORPHTOK"].append(' '.join(mtt_tmp)+'\n')
     # TODO: is this needed?
-    root = ET.parse(file)
+    root = fs_parse(file)
     for span, _, segid, start, end in spans_from_xml(spans, root, False):
       # only segid is good here
       data["ORIG"].append(' '.join([x.text for x in span])+'\n')
@@ -341,11 +1344,64 @@ def get_aligned_sentences_xml(srcfile, trgfile, alignfile, alxml=False):
 
   return [sdata, tdata]
 
+class _FileIndex:
+  ''' the files of a directory, looked up for pairing by a regex prefix of
+  literal characters and '.'s, or by docid. Files that are taken aren't found again '''
+  def __init__(self, files):
+    self.files = files
+    self.taken = set()
+    # (literal positions, prefix length) -> characters at those positions -> file indices
+    self.indexes = {}
+    # docid (name up to the first .) -> file indices
+    self.docids = None
+
+  def matches(self, prefix, ext, repl):
+    ''' indices of the untaken files that match repl, which is prefix.*\\.ext, in order '''
+    special = r"\^$*+?{}[]()|"
+    if any(c in special for c in prefix) or any(c in special+'.' for c in ext):
+      # not a simple prefix; try everything
+      return [idx for idx, f in enumerate(self.files) if idx not in self.taken and re.match(repl, f)]
+    positions = tuple(i for i, c in enumerate(prefix) if c != '.')
+    key = (positions, len(prefix))
+    if key not in self.indexes:
+      index = dd(list)
+      for idx, f in enumerate(self.files):
+        if len(f) >= len(prefix):
+          index[tuple(f[i] for i in positions)].append(idx)
+      self.indexes[key] = index
+    # the rest of repl: .*\.ext
+    tail = "."+ext
+    return [idx for idx in self.indexes[key].get(tuple(prefix[i] for i in positions), [])
+            if idx not in self.taken and tail in self.files[idx][len(prefix):]]
+
+  def search(self, docid):
+    ''' index of the first untaken file named for docid or, failing that, with
+    docid (a regex) anywhere in its name; None if there's none '''
+    if self.docids is None:
+      self.docids = dd(list)
+      for idx, f in enumerate(self.files):
+        self.docids[f.split('.')[0]].append(idx)
+    for idx in self.docids.get(docid, []):
+      if idx not in self.taken:
+        return idx
+    # file naming convention varies!
+    for idx, f in enumerate(self.files):
+      if idx not in self.taken and re.search(docid, f):
+        return idx
+    return None
+
+  def take(self, idx):
+    self.taken.add(idx)
+
+  def remaining(self):
+    ''' the untaken files, in order '''
+    return [f for idx, f in enumerate(self.files) if idx not in self.taken]
+
 def pair_files(srcdir, trgdir, ext='txt', tweet=False):
   ''' Heuristically pair files from rsd directories together based on observed
   filename conventions. Warn on unmatched files and mismatched lengths
   if xml is False, .ltf.xml -> .rsd.txt'''
-  if (not os.path.exists(srcdir)) or (not os.path.exists(trgdir)):
+  if (not fs_exists(srcdir)) or (not fs_exists(trgdir)):
     sys.stderr.write("Warning: couldn't find "+srcdir+" or "+trgdir+"\n")
     return ([], [], [])
   pats = []
@@ -381,31 +1437,36 @@ def pair_files(srcdir, trgdir, ext='txt', tweet=False):
   pats.append((pat_from_trg_pbook, repl_from_trg_pbook))
   matches = []
   unsrcs = []
-  trgfiles = os.listdir(trgdir)
-  for srcfile in os.listdir(srcdir):
+  ambiguous = []
+  trgfiles = fs_listdir(trgdir)
+  index = _FileIndex(trgfiles)
+  for srcfile in fs_listdir(srcdir):
     filematch = None
     if is_sn(srcfile) == tweet: # make sure it's either all tweets or none tweets
       for pat, repltmp in pats:
-#        print("Trying "+str(pat)+" on "+srcfile)
-        if re.match(pat, srcfile):
-#          print("Matched")
-          repl = repltmp % re.match(pat, srcfile).groups()
-#          print("Using "+repl+" to match "+srcfile)
-          for trgfile in trgfiles:
-            if re.match(repl, trgfile):
-#              print("Matched to "+trgfile+"!")
-              filematch= trgfile
-              break # From trg file search
-          if filematch is not None:
+        patmatch = re.match(pat, srcfile)
+        if patmatch:
+          repl = repltmp % patmatch.groups()
+          # every repl is <prefix>.*\.ext; look targets up by prefix
+          found = index.matches(repltmp[:repltmp.rindex(r".*\.")] % patmatch.groups(), ext, repl)
+          if len(found) > 1:
+            ambiguous.append((srcfile, [trgfiles[idx] for idx in found]))
+          if len(found) > 0:
+            filematch = found[0]
             break # From pattern search
       if filematch is not None:
-        trgfiles.remove(filematch)
+        index.take(filematch)
         matches.append((os.path.join(srcdir, srcfile),
-                        os.path.join(trgdir, filematch)))
+                        os.path.join(trgdir, trgfiles[filematch])))
       else:
         sys.stderr.write("No match for "+srcdir+"/"+srcfile+"\n")
         unsrcs.append(srcdir+"/"+srcfile)
-  return (matches, unsrcs, ['%s/%s' % (trgdir, i) for i in trgfiles if is_sn(i) == tweet])
+  if len(ambiguous) > 0:
+    sys.stderr.write("Warning: %d files of %s could pair with more than one of %s; took the first:\n" % \
+                     (len(ambiguous), srcdir, trgdir))
+    for srcfile, trgs in ambiguous:
+      sys.stderr.write("%s: %s\n" % (srcfile, ' '.join(trgs)))
+  return (matches, unsrcs, ['%s/%s' % (trgdir, i) for i in index.remaining() if is_sn(i) == tweet])
 
 
 # @deprecated
@@ -460,67 +1521,54 @@ def pair_files(srcdir, trgdir, ext='txt', tweet=False):
 #   return (matches, unsrcs, ['%s/%s' % (trgdir, i) for i in trgfiles \
 #                             if "SN_" in i])
 
-def pair_found_files_from_al_xml(srcdir, trgdir, aldir):
-  ''' use xml alignment format to pair segments together; just read the headers '''
+def _al_header(path):
+  ''' source and translation ids from the root of an xml alignment file '''
+  with fs_open(path, 'rb') as fh:
+    for event, elem in ET.iterparse(fh, events=('start',)):
+      return elem.get('source_id'), elem.get('translation_id')
+
+def pair_found_files_from_al_xml(srcdir, trgdir, aldir, threads=8):
+  ''' use xml alignment format to pair segments together; just read the headers (threads at a time) '''
+  from concurrent.futures import ThreadPoolExecutor
   matches = []
   unals = []
-  trgfiles = os.listdir(trgdir)
-  srcfiles = os.listdir(srcdir)
-  alfiles = os.listdir(aldir)
-  for alfile in alfiles:
-    if not alfile.endswith(".xml") or alfile.startswith("."):
-      continue
-    #print(alfile)
-    alroot = ET.parse(os.path.join(aldir, alfile)).getroot()
+  srcindex = _FileIndex(fs_listdir(srcdir))
+  trgindex = _FileIndex(fs_listdir(trgdir))
+  alfiles = [alfile for alfile in fs_listdir(aldir) if alfile.endswith(".xml") and not alfile.startswith(".")]
+  with ThreadPoolExecutor(threads) as pool:
+    headers = list(pool.map(_al_header, [os.path.join(aldir, alfile) for alfile in alfiles]))
+  for alfile, (sid, tid) in zip(alfiles, headers):
     # LDC BUG?
-    sid=alroot.get('source_id')
-    tid=alroot.get('translation_id')
-#    sid=alroot.get('translation_id')
-#    tid=alroot.get('source_id')
-    
-    srcmatch = None
-    trgmatch = None
-    # file naming convention varies!
-    for srcfile in srcfiles:
-      #sys.stderr.write("Searching for source %s in %s\n" % (sid, srcfile))
-      if re.search(sid, srcfile):
-        srcmatch = srcfile
-        break
+#    sid, tid = tid, sid
+    srcmatch = srcindex.search(sid)
+    srcmatchdir, srcmatchindex = srcdir, srcindex
     if srcmatch is None:
-      for trgfile in trgfiles:
-        #sys.stderr.write("Backup: Searching for source %s in %s\n" % (sid, trgfile))
-        if re.search(sid, trgfile):
-          srcmatch = trgfile
-          break
+      # backup: the source may be among the targets
+      srcmatch = trgindex.search(sid)
+      srcmatchdir, srcmatchindex = trgdir, trgindex
+    trgmatch = None
     if srcmatch is not None:
-      for trgfile in trgfiles:
-        #sys.stderr.write("Searching for target %s in %s\n" % (tid, trgfile))
-        if re.search(tid, trgfile):
-          trgmatch = trgfile
-          break
-      # if trgmatch is None:
-      #   for srcfile in srcfiles:
-      #     sys.stderr.write("Searching for target %s in %s\n" % (tid, trgfile))
-      #   if re.search(tid, trgfile):
-      #     trgmatch = trgfile
-      #     break
+      # (taken first, so a source found among the targets isn't its own target)
+      srcmatchindex.take(srcmatch)
+      trgmatch = trgindex.search(tid)
+      if trgmatch is None:
+        srcmatchindex.taken.discard(srcmatch)
 
     if srcmatch is not None and trgmatch is not None:
-      srcfiles.remove(srcmatch)
-      trgfiles.remove(trgmatch)
-      matches.append((os.path.join(srcdir, srcmatch),
-                      os.path.join(trgdir, trgmatch),
+      trgindex.take(trgmatch)
+      matches.append((os.path.join(srcmatchdir, srcmatchindex.files[srcmatch]),
+                      os.path.join(trgdir, trgindex.files[trgmatch]),
                       os.path.join(aldir, alfile)))
     else:
       sys.stderr.write("No match for "+alfile+"\n")
       unals.append(alfile)
-  return (matches, srcfiles, trgfiles, unals)
+  return (matches, srcindex.remaining(), trgindex.remaining(), unals)
 
 def pair_found_files(srcdir, trgdir, aldir, ext='txt'):
   ''' Heuristically pair files from found directories together
   based on observed filename conventions. Warn on unmatched files '''
-  if (not os.path.exists(srcdir)) or (not os.path.exists(trgdir)) or \
-     (not os.path.exists(aldir)):
+  if (not fs_exists(srcdir)) or (not fs_exists(trgdir)) or \
+     (not fs_exists(aldir)):
     sys.stderr.write("Warning: couldn't find "+srcdir+" or "+ \
                      trgdir+"or "+aldir+"\n")
     return ([], [], [], [])
@@ -537,44 +1585,35 @@ def pair_found_files(srcdir, trgdir, aldir, ext='txt'):
 
   matches = []
   unals = []
-  trgfiles = os.listdir(trgdir)
-  srcfiles = os.listdir(srcdir)
-  alfiles = os.listdir(aldir)
+  trgindex = _FileIndex(fs_listdir(trgdir))
+  srcindex = _FileIndex(fs_listdir(srcdir))
+  alfiles = fs_listdir(aldir)
   for alfile in alfiles:
     srcfilematch = None
     trgfilematch = None
     for pat, repltmp in pats:
-      # print "Trying "+str(pat)+" on "+alfile
-      if re.match(pat, alfile):
-        # print "Matched"
-        repl = repltmp % re.match(pat, alfile).groups()
-        # print "Using "+repl+" to match "+alfile
-        for trgfile in trgfiles:
-          if re.match(repl, trgfile):
-            # print "Matched to target "+trgfile+"!"
-            trgfilematch= trgfile
-            break # from trg file search
-        if trgfilematch is None:
+      patmatch = re.match(pat, alfile)
+      if patmatch:
+        repl = repltmp % patmatch.groups()
+        prefix = repltmp[:repltmp.rindex(r".*\.")] % patmatch.groups()
+        found = trgindex.matches(prefix, ext, repl)
+        if len(found) == 0:
           break # from pattern search
-        for srcfile in srcfiles:
-          if re.match(repl, srcfile):
-            # print "Matched to "+srcfile+"!"
-            srcfilematch= srcfile
-            break # from trg file search
-        if srcfilematch is not None:
+        trgfilematch = found[0]
+        found = srcindex.matches(prefix, ext, repl)
+        if len(found) > 0:
+          srcfilematch = found[0]
           break # from pattern search
 
     if srcfilematch is not None and trgfilematch is not None:
-      # print "Matched "+alfile+" "+srcfilematch+" "+trgfilematch
-      trgfiles.remove(trgfilematch)
-      srcfiles.remove(srcfilematch)
-      matches.append((os.path.join(srcdir, srcfilematch),
-                      os.path.join(trgdir, trgfilematch),
+      trgindex.take(trgfilematch)
+      srcindex.take(srcfilematch)
+      matches.append((os.path.join(srcdir, srcindex.files[srcfilematch]),
+                      os.path.join(trgdir, trgindex.files[trgfilematch]),
                       os.path.join(aldir, alfile)))
     else:
-      # print "No match for "+alfile
       unals.append(alfile)
-  return (matches, srcfiles, trgfiles, unals)
+  return (matches, srcindex.remaining(), trgindex.remaining(), unals)
 
 def all_found_tuples(rootdir, src='uzb', trg='eng', xml=False, tweet=False):
   ''' traverse LRLP directory structure to build src, trg,
@@ -588,7 +1627,7 @@ def all_found_tuples(rootdir, src='uzb', trg='eng', xml=False, tweet=False):
   trg_path = os.path.join(tpath, trg, pathext)
   al_path = os.path.join(tpath, 'sentence_alignment')
   # check to see if alignfiles are xml or not
-  if os.path.exists(al_path) and os.listdir(al_path)[0].endswith("xml"):
+  if fs_exists(al_path) and fs_listdir(al_path)[0].endswith("xml"):
     (m, s, t, a) = pair_found_files_from_al_xml(src_path, trg_path, al_path)
   else:
     (m, s, t, a) = pair_found_files(src_path, trg_path, al_path, ext=fileext)
@@ -662,6 +1701,83 @@ def morph_tok(node):
       except IndexError:
         yield morphtok, morphtok
 
+class LTFToken(namedtuple('LTFToken', 'id text pos morph start_char end_char')):
+  ''' a TOKEN of an ltf segment; get() mirrors the element's attributes, so morph_tok works on it '''
+  __slots__ = ()
+  def get(self, key, default=None):
+    value = getattr(self, key, None) if key != 'text' else None
+    return default if value is None else value
+
+class LTFSegment(namedtuple('LTFSegment', 'docid id start_char end_char text tokens')):
+  ''' a SEG of an ltf document: offsets, ORIGINAL_TEXT and its tokens '''
+  __slots__ = ()
+  def get(self, key, default=None):
+    value = getattr(self, key, None) if key not in ('text', 'tokens') else None
+    return default if value is None else value
+
+def iter_ltf(source):
+  ''' one pass over an ltf document (path or file object), yielding an LTFSegment per SEG.
+  Elements are cleared as soon as they're read so the whole tree is never held.
+  The generator's return value is the document id '''
+  if isinstance(source, str):
+    with fs_open(source, 'rb') as fh:
+      return (yield from iter_ltf(fh))
+  docid = None
+  text = None
+  tokens = []
+  stack = []
+  for event, elem in ET.iterparse(source, events=('start', 'end')):
+    if event == 'start':
+      if elem.tag == 'DOC' and docid is None:
+        docid = elem.get('id')
+      elif elem.tag == 'SEG':
+        text = None
+        tokens = []
+      stack.append(elem)
+      continue
+    stack.pop()
+    if elem.tag == 'TOKEN':
+      tokens.append(LTFToken(elem.get('id'), elem.text, elem.get('pos'), elem.get('morph'),
+                             elem.get('start_char'), elem.get('end_char')))
+    elif elem.tag == 'ORIGINAL_TEXT':
+      text = elem.text
+    elif elem.tag == 'SEG':
+      yield LTFSegment(docid, elem.get('id'), elem.get('start_char'), elem.get('end_char'), text, tokens)
+    else:
+      continue
+    # finished with this element; drop it from the partial tree
+    elem.clear()
+    if len(stack) > 0:
+      stack[-1].remove(elem)
+  return docid
+
+def read_ltf(source):
+  ''' docid and list of LTFSegments of an ltf document. Parse errors are raised
+  before anything is returned '''
+  segs = []
+  reader = iter_ltf(source)
+  while True:
+    try:
+      segs.append(next(reader))
+    except StopIteration as done:
+      return done.value, segs
+
+def ltf_segment_fields(seg, nopos="none"):
+  ''' tokens, morph tokens, morphs and pos tags of an LTFSegment; tokens without text are skipped '''
+  toktext = []
+  morphtoktext = []
+  morphtext = []
+  postext = []
+  for y in seg.tokens:
+    if y.text is None:
+      continue
+    toktext.append(y.text)
+    postext.append(y.pos or nopos)
+    for mt, mtt in morph_tok(y):
+      morphtext.append(mt)
+      morphtoktext.append(mtt)
+  return toktext, morphtoktext, morphtext, postext
+
 def get_segments(xml):
   ''' Get segments from xml ltf file '''
   all_toktext = list()
@@ -708,24 +1824,21 @@ def extract_lines(s, t, sxml=True, txml=True):
     l = dd(list)
     if xml:
       try:
-        root = ET.parse(x)
+        docid, segs = read_ltf(x)
       except ParseError as detail:
         sys.stderr.write("Parse error on "+x+": "+str(detail)+"\n")
         return
-      for (docid, segid, start, end) in get_info(root):
+      for seg in segs:
         l["DOCID"].append(docid)
-        l["SEGID"].append(segid)
-        l["START"].append(start)
-        l["END"].append(end)
-      toks, morphtoks, morphs, poss = get_segments(root)
-      l["TOK"].extend(toks)
-      l["MORPHTOK"].extend(morphtoks)
-      l["MORPH"].extend(morphs)
-      l["POS"].extend(poss)
-      l["ORIG"].extend([ node.text.strip('\n')+"\n" if node.text is not None else "NONE\n" for node in root.findall(".//ORIGINAL_TEXT") ])
+        l["SEGID"].append(seg.id)
+        l["START"].append(seg.start_char)
+        l["END"].append(seg.end_char)
+        for key, field in zip(("TOK", "MORPHTOK", "MORPH", "POS"), ltf_segment_fields(seg)):
+          l[key].append(' '.join(field)+"\n")
+        l["ORIG"].append(seg.text.strip('\n')+"\n" if seg.text is not None else "NONE\n")
     else:
       import codecs
-      with codecs.open(x, 'r', 'utf-8') as f:
+      with codecs.getreader('utf-8')(fs_open(x, 'rb')) as f:
         l["ORIG"] = f.readlines()
       l["DOCID"] = [x+"\n"]*len(l["ORIG"])
     lengths = [len(i) for i in list(l.values())]
@@ -737,10 +1850,91 @@ def extract_lines(s, t, sxml=True, txml=True):
   # check that each side is internally consistentthe same length
   return ret
 
+def expandpaths(path):
+  ''' all files under a path (or glob), sorted '''
+  import glob
+  paths = sorted(glob.glob(path)) if glob.has_magic(path) else [path,]
+  ret = []
+  for p in paths:
+    if os.path.isdir(p):
+      for root, dirs, files in os.walk(p):
+        dirs.sort()
+        ret.extend(os.path.join(root, f) for f in sorted(files))
+    elif os.path.exists(p):
+      ret.append(p)
+  return ret
+
+def du(paths):
+  ''' total bytes in files under the given paths '''
+  total = 0
+  for path in paths:
+    for fname in expandpaths(path):
+      try:
+        total += os.path.getsize(fname)
+      except OSError:
+        pass
+  return total
+
+_stepmains = {}
+_stepmainslock = threading.Lock()
+
+def _loadmain(path):
+  ''' the main() of a repo python script, imported (once) without running it '''
+  import importlib.util
+  with _stepmainslock:
+    if path not in _stepmains:
+      main = None
+      try:
+        name = "_step_%s" % re.sub(r'\W', '_', os.path.basename(path)[:-3])
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        main = getattr(module, 'main', None)
+      except Exception as exc:
+        sys.stderr.write("can't load %s in process (%s); will run it in a shell\n" % (path, exc))
+      _stepmains[path] = main if callable(main) else None
+    return _stepmains[path]
+
+def _splitargs(argstring):
+  ''' split an argument string the way the shell would, if it is simple
+  enough to not need a shell. A trailing '| gzip > file' is allowed.
+  Returns (argv, gzipfile), or None if a shell is needed '''
+  import glob
+  import shlex
+  if '$' in argstring or '`' in argstring:
+    return None
+  lexer = shlex.shlex(argstring, posix=True, punctuation_chars=True)
+  lexer.whitespace_split = True
+  try:
+    tokens = list(lexer)
+  except ValueError:
+    return None
+  gzipfile = None
+  if len(tokens) >= 4 and tokens[-4:-1] == ['|', 'gzip', '>']:
+    gzipfile = tokens[-1]
+    tokens = tokens[:-4]
+  argv = []
+  for token in tokens:
+    if token and all(c in lexer.punctuation_chars for c in token):
+      return None
+    if glob.has_magic(token):
+      # like the shell, leave unmatched patterns alone
+      argv.extend(sorted(glob.glob(token)) or [token,])
+    else:
+      argv.append(token)
+  return argv, gzipfile
+
+def _pathoverlap(a, b):
+  ''' are these paths the same or is one inside the other? '''
+  a = os.path.normpath(a)
+  b = os.path.normpath(b)
+  return a == b or a.startswith(b+os.sep) or b.startswith(a+os.sep)
+
 class Step:
   def __init__(self, prog, progpath=scriptdir, argstring="", stdin=None,
                stdout=None, stderr=None, help=None, call=check_call,
-               abortOnFail=True, scriptbin=None, name=None, disabled = False):
+               abortOnFail=True, scriptbin=None, name=None, disabled = False,
+               inputs=None, outputs=None, inprocess=False, env=None, cpu=1, io=False):
     self.prog = prog
     self.name = self.prog if name is None else name
     self.scriptbin = scriptbin
@@ -753,16 +1947,183 @@ class Step:
     self.call = call
     self.abortOnFail = abortOnFail
     self.disabled = disabled
+    # paths read and written; None means unknown, so the step is run in isolation
+    self.inputs = inputs
+    self.outputs = outputs
+    self.failed = False
+    # run repo python scripts by forking this interpreter and calling their
+    # main(), rather than starting a shell and a fresh interpreter
+    self.inprocess = inprocess
+    # extra environment for the step
+    self.env = {} if env is None else env
+    # what the step costs a StepScheduler: cores, and whether it mostly moves bytes
+    self.cpu = cpu
+    self.io = io
+    # resource usage of the last run; see run_report
+    self.stats = {"name":self.name, "status":"not run"}
 
   def disable(self):
     self.disabled = True
   def enable(self):
     self.disabled = False
-    
+
+  def reads(self):
+    ''' declared inputs, including any redirected stdin '''
+    ret = list(self.inputs)
+    if self.stdin is not None:
+      ret.append(self.stdin)
+    return ret
+
+  def writes(self):
+    ''' declared outputs, including any redirected stdout/stderr '''
+    ret = list(self.outputs)
+    for redir in (self.stdout, self.stderr):
+      if redir is not None:
+        ret.append(redir)
+    return ret
+
+  def conflicts(self, other):
+    ''' must one of self and other wait for the other to finish? '''
+    if self.inputs is None or self.outputs is None or \
+       other.inputs is None or other.outputs is None:
+      return True
+    for mine, theirs in ((self.reads(), other.writes()),
+                         (self.writes(), other.writes()),
+                         (self.writes(), other.reads())):
+      for a in mine:
+        for b in theirs:
+          if _pathoverlap(a, b):
+            return True
+    return False
+
+  def _inprocesscall(self):
+    ''' (main, argv, gzipfile) if this step can run in process, else None '''
+    if not self.inprocess or self.scriptbin is not None or not self.prog.endswith(".py"):
+      return None
+    path = os.path.join(self.progpath, self.prog)
+    if os.path.dirname(os.path.abspath(path)) != scriptdir or not os.path.exists(path):
+      return None
+    split = _splitargs(self.argstring)
+    if split is None:
+      return None
+    main = _loadmain(path)
+    if main is None:
+      return None
+    argv, gzipfile = split
+    return main, [path,]+argv, gzipfile
+
+  def _fork(self, main, argv, gzipfile, capture, **kwargs):
+    ''' run main() in a forked child with sys.argv and redirected
+    stdin/stdout/stderr; returns (exit code, output, rusage) '''
+    import traceback
+    readfd = writefd = None
+    if capture:
+      readfd, writefd = os.pipe()
+    for fh in (sys.stdout, sys.stderr):
+      fh.flush()
+    pid = os.fork()
+    if pid == 0:
+      code = 1
+      try:
+        if capture:
+          os.close(readfd)
+          os.dup2(writefd, 1)
+          os.close(writefd)
+        for fd, fh in ((0, "stdin"), (1, "stdout"), (2, "stderr")):
+          if fh in kwargs:
+            os.dup2(kwargs[fh].fileno(), fd)
+        gzipper = None
+        if gzipfile is not None:
+          gzipper = Popen(["gzip",], stdin=PIPE, stdout=open(gzipfile, 'wb'))
+          os.dup2(gzipper.stdin.fileno(), 1)
+          gzipper.stdin.close()
+        # fresh stream objects; the parent's may have been locked by another thread
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', closefd=False, buffering=1)
+        sys.argv = argv
+        os.environ.update(self.env)
+        try:
+          main()
+          code = 0
+        except SystemExit as exc:
+          if exc.code is None:
+            code = 0
+          elif isinstance(exc.code, int):
+            code = exc.code
+          else:
+            sys.stderr.write("%s\n" % exc.code)
+            code = 1
+        except BaseException:
+          traceback.print_exc()
+          code = 1
+        sys.stdout.flush()
+        if gzipper is not None:
+          os.close(1)
+          gzipper.wait()
+          code = code or gzipper.returncode
+        sys.stderr.flush()
+      finally:
+        os._exit(code)
+    output = None
+    if capture:
+      os.close(writefd)
+      with os.fdopen(readfd, 'rb') as ifh:
+        output = ifh.read()
+    _, status, usage = os.wait4(pid, 0)
+    return os.waitstatus_to_exitcode(status), output, usage
+
+  def _call(self, callstring, **kwargs):
+    ''' do what self.call would, but reap the child with wait4 so its
+    (and its waited-for descendants') resource usage can be recorded '''
+    import resource
+    if self.call not in (check_call, check_output):
+      if self.env:
+        kwargs["env"] = dict(os.environ, **self.env)
+      # unknown callable; fall back to the usage of all children, which
+      # is only accurate when nothing else runs concurrently. their peak
+      # rss is the largest of every child ever reaped, not this step's,
+      # so there is none to record
+      before = resource.getrusage(resource.RUSAGE_CHILDREN)
+      retval = self.call(callstring, **kwargs)
+      after = resource.getrusage(resource.RUSAGE_CHILDREN)
+      self.stats["utime"] = after.ru_utime-before.ru_utime
+      self.stats["stime"] = after.ru_stime-before.ru_stime
+      return retval
+    capture = self.call is check_output
+    inprocess = self._inprocesscall()
+    self.stats["inprocess"] = inprocess is not None
+    if inprocess is not None:
+      del kwargs["shell"]
+      returncode, output, usage = self._fork(*inprocess, capture=capture, **kwargs)
+    else:
+      if capture:
+        kwargs["stdout"] = PIPE
+      if self.env:
+        kwargs["env"] = dict(os.environ, **self.env)
+      proc = Popen(callstring, **kwargs)
+      output = proc.stdout.read() if capture else None
+      _, status, usage = os.wait4(proc.pid, 0)
+      proc.returncode = returncode = os.waitstatus_to_exitcode(status)
+      if capture:
+        proc.stdout.close()
+    self.stats["utime"] = usage.ru_utime
+    self.stats["stime"] = usage.ru_stime
+    self.stats["maxrss_kb"] = usage.ru_maxrss
+    if returncode != 0:
+      raise CalledProcessError(returncode, callstring, output=output)
+    return output if capture else 0
+
   def run(self):
+    import time
+    self.stats = {"name":self.name, "prog":self.prog}
     if self.disabled:
       sys.stderr.write("SKIPPING DISABLED STEP\n")
+      self.stats["status"] = "disabled"
       return 0
+    written = self.writes() if self.outputs is not None else []
+    startbytes = du(written)
+    self.stats["start"] = time.time()
     kwargs = {}
     kwargs["shell"] = True
     if self.stdin is not None:
@@ -775,6 +2136,7 @@ class Step:
     # TODO: could check that prog exists and is executable
     # TODO: fail or succeed based on return code and specified behavior
     retval = ""
+    self.failed = False
     try:
       localstderr =  kwargs["stderr"] if self.stderr is not None else sys.stderr
       if self.scriptbin is None:
@@ -789,18 +2151,284 @@ class Step:
       if self.stderr is not None:
         callstring = callstring+" 2> %s" % self.stderr
       localstderr.write("Calling %s\n" % callstring)
-      retval = self.call(basecallstring, **kwargs)
+      self.stats["command"] = callstring
+      retval = self._call(basecallstring, **kwargs)
       sys.stderr.write("%s: Done\n" % prog)
+      self.stats["status"] = "done"
     except CalledProcessError as exc:
+      self.failed = True
+      self.stats["status"] = "failed"
+      self.stats["returncode"] = exc.returncode
       sys.stderr.write("%s: FAIL\n" % (prog))
       if self.stderr is not None:
         kwargs["stderr"].close()
         for line in open(self.stderr, 'r'):
           sys.stderr.write(line)
-      if self.abortOnFail:
-        sys.exit(1)
+    finally:
+      self.stats["wall"] = time.time()-self.stats["start"]
+      if self.outputs is not None:
+        self.stats["output_bytes"] = du(written)
+        self.stats["bytes_written"] = self.stats["output_bytes"]-startbytes
+      for fh in ("stdin", "stdout", "stderr"):
+        if fh in kwargs and not kwargs[fh].closed:
+          kwargs[fh].close()
+    if self.failed and self.abortOnFail:
+      sys.exit(1)
+    return retval
+
+class StepCache:
+  ''' remember, per step name, a fingerprint of what a successful run consumed
+  (program, arguments, script contents, declared inputs) and the state of its
+  declared outputs, so a rerun can skip it. Input contents are hashed, but the
+  hashes are memoized by size and mtime so unchanged files aren't re-read '''
+  def __init__(self, path):
+    import json
+    import threading
+    self.path = path
+    self.lock = threading.Lock()
+    self.data = {"steps":{}, "hashes":{}}
+    if os.path.exists(path):
+      try:
+        with open(path) as f:
+          self.data = json.load(f)
+      except ValueError:
+        sys.stderr.write("Ignoring unreadable step cache %s\n" % path)
+
+  def _digest(self, fname):
+    ''' content hash of a file, memoized by size and mtime '''
+    import hashlib
+    st = os.stat(fname)
+    key = os.path.abspath(fname)
+    with self.lock:
+      memo = self.data["hashes"].get(key)
+    if memo is not None and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+      return memo[2]
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+      for block in iter(lambda: f.read(1<<20), b''):
+        h.update(block)
+    with self.lock:
+      self.data["hashes"][key] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+  def fingerprint(self, step):
+    ''' hash of everything that determines what a step does '''
+    import hashlib
+    h = hashlib.sha1()
+    prog = os.path.join(step.progpath, step.prog)
+    scripts = [prog,]
+    if prog.endswith(".py") and step.progpath == scriptdir:
+      scripts.append(os.path.join(scriptdir, 'lputil.py'))
+    for item in (prog, step.scriptbin, step.argstring, step.stdin, step.stdout):
+      h.update(("%s\n" % item).encode('utf-8'))
+    for script in scripts:
+      if os.path.isfile(script):
+        h.update(self._digest(script).encode('utf-8'))
+    for path in step.reads():
+      h.update(("<%s\n" % path).encode('utf-8'))
+      for fname in expandpaths(path):
+        h.update(("%s %s\n" % (fname, self._digest(fname))).encode('utf-8'))
+    return h.hexdigest()
+
+  def outputstate(self, step):
+    ''' cheap summary (names, sizes, mtimes) of a step's outputs; None if any is missing '''
+    import hashlib
+    h = hashlib.sha1()
+    for path in step.outputs:
+      fnames = expandpaths(path)
+      if len(fnames) == 0 and not os.path.isdir(path):
+        return None
+      for fname in fnames:
+        st = os.stat(fname)
+        h.update(("%s %d %d\n" % (fname, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+  def cacheable(self, step):
+    return not step.disabled and step.inputs is not None and step.outputs is not None
+
+  def run(self, step):
+    ''' run a step unless it is unchanged since it last succeeded '''
+    if not self.cacheable(step):
+      return step.run()
+    fingerprint = self.fingerprint(step)
+    with self.lock:
+      entry = self.data["steps"].get(step.name)
+    if entry is not None and entry["fingerprint"] == fingerprint and \
+       entry["outputs"] is not None and entry["outputs"] == self.outputstate(step):
+      sys.stderr.write("%s: unchanged since last run; skipping\n" % step.name)
+      step.stats = {"name":step.name, "prog":step.prog, "status":"cached"}
+      retval = entry["retval"]
+      return retval.encode('utf-8') if entry["bytes"] else retval
+    with self.lock:
+      self.data["steps"].pop(step.name, None)
+    retval = step.run()
+    if not step.failed:
+      isbytes = isinstance(retval, bytes)
+      with self.lock:
+        self.data["steps"][step.name] = {"fingerprint":fingerprint,
+                                         "outputs":self.outputstate(step),
+                                         "retval":retval.decode('utf-8') if isbytes else retval,
+                                         "bytes":isbytes}
+      self.save()
     return retval
 
+  def save(self, steps=()):
+    ''' write the cache out. Outputs of the given steps are re-summarized first,
+    so that later steps legitimately touching them (e.g. relocating files into
+    the expanded lrlp) don't invalidate them '''
+    import json
+    with self.lock:
+      for step in steps:
+        entry = self.data["steps"].get(step.name)
+        if entry is not None and self.cacheable(step):
+          entry["outputs"] = self.outputstate(step)
+      tmp = self.path+".tmp"
+      with open(tmp, 'w') as f:
+        json.dump(self.data, f)
+      os.replace(tmp, self.path)
+
+class StepScheduler:
+  ''' run steps concurrently within a budget of cores (each step costs its
+  Step.cpu) and of simultaneous disk-heavy steps (those with Step.io). Steps
+  are added in groups; a step waits for every earlier step of its group it
+  conflicts with (see Step.conflicts), so one group with one worker is
+  exactly the sequential order '''
+  def __init__(self, jobs=1, cache=None, iojobs=None):
+    self.jobs = max(1, jobs)
+    self.iojobs = self.jobs if iojobs is None else max(1, iojobs)
+    self.cache = cache
+    self.steps = []
+    self.deps = []
+    self.groups = []
+    self.results = []
+    # per group
+    self.caches = []
+    self.thens = []
+    self.remaining = []
+    self.failed = {}
+
+  def add(self, steps, cache=None, then=None):
+    ''' add a group of steps in their nominal order; returns the group number.
+    Steps of separate groups never wait on each other, and a failure only
+    stops its own group. cache overrides the scheduler's cache for the group.
+    then, if given, is called with the group's step results once all of them
+    succeed, and may return more steps, which become a new group (same cache) '''
+    steps = list(steps)
+    group = len(self.caches)
+    self.caches.append(self.cache if cache is None else cache)
+    self.thens.append(then)
+    self.remaining.append(len(steps))
+    base = len(self.steps)
+    for i, step in enumerate(steps):
+      deps = set()
+      if not step.disabled:
+        for j in range(i):
+          if not steps[j].disabled and step.conflicts(steps[j]):
+            deps.add(base+j)
+      self.steps.append(step)
+      self.deps.append(deps)
+      self.groups.append(group)
+      self.results.append(None)
+    if len(steps) == 0:
+      self._finish(group)
+    return group
+
+  def _finish(self, group):
+    ''' a group is done; run its follow up '''
+    then = self.thens[group]
+    if then is None or group in self.failed:
+      return
+    try:
+      more = then([r for r, g in zip(self.results, self.groups) if g == group])
+    except BaseException as exc:
+      sys.stderr.write("group %d: follow up failed\n" % group)
+      self.failed[group] = exc
+      return
+    if more is not None:
+      self.add(more, cache=self.caches[group])
+
+  def run(self):
+    ''' run everything; once a step fails with abortOnFail, start nothing new
+    in its group, and re-raise its exit after all running steps finish '''
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    done = set()
+    running = {}
+    started = 0
+    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      while True:
+        cpu = sum(self.steps[idx].cpu for idx in running.values())
+        io = sum(1 for idx in running.values() if self.steps[idx].io)
+        for idx in range(started, len(self.steps)):
+          step = self.steps[idx]
+          if idx in done or idx in running.values() or self.groups[idx] in self.failed:
+            continue
+          if not self.deps[idx] <= done:
+            continue
+          # a step bigger than the whole budget still runs, alone
+          if len(running) > 0 and cpu+step.cpu > self.jobs:
+            continue
+          if step.io and io >= self.iojobs:
+            continue
+          running[pool.submit(self._run, idx)] = idx
+          cpu += step.cpu
+          io += 1 if step.io else 0
+        while started < len(self.steps) and \
+              (started in done or self.groups[started] in self.failed):
+          started += 1
+        if len(running) == 0:
+          break
+        finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in finished:
+          idx = running.pop(future)
+          done.add(idx)
+          group = self.groups[idx]
+          exc = future.exception()
+          if exc is not None:
+            if group not in self.failed:
+              sys.stderr.write("%s: not starting remaining steps\n" % self.steps[idx].name)
+              self.failed[group] = exc
+            continue
+          self.results[idx] = future.result()
+          self.remaining[group] -= 1
+          if self.remaining[group] == 0:
+            self._finish(group)
+    for cache in set(c for c in self.caches if c is not None):
+      cache.save([s for s, g in zip(self.steps, self.groups) if self.caches[g] is cache])
+    if len(self.failed) > 0:
+      raise self.failed[min(self.failed)]
+
+  def _run(self, idx):
+    step = self.steps[idx]
+    cache = self.caches[self.groups[idx]]
+    if cache is not None:
+      return cache.run(step)
+    return step.run()
+
+def write_run_report(steps, path, tokcache=None):
+  ''' write the resource usage of each step (see Step.run) as json, with how the TokenCache at tokcache did '''
+  import json
+  import time
+  report = {"created":time.time(), "steps":[step.stats for step in steps]}
+  if tokcache is not None and os.path.exists(tokcache):
+    report["tokcache"] = TokenCache(tokcache).stats()
+  totals = {}
+  for stat in report["steps"]:
+    for key in ("wall", "utime", "stime", "bytes_written"):
+      totals[key] = totals.get(key, 0)+stat.get(key, 0)
+  totals["maxrss_kb"] = max([stat.get("maxrss_kb", 0) for stat in report["steps"]]+[0,])
+  report["totals"] = totals
+  with open(path, 'w') as ofh:
+    json.dump(report, ofh, indent=2)
+    ofh.write("\n")
+  sys.stderr.write("Wrote run report to %s\n" % path)
+
+def run_steps(steps, jobs=1, cache=None):
+  ''' run a list of steps, in parallel where their inputs and outputs allow.
+  If cache (a StepCache) is given, unchanged steps are skipped '''
+  scheduler = StepScheduler(jobs, cache)
+  scheduler.add(steps)
+  scheduler.run()
+
 def make_action(steps):
   class customAction(argparse.Action):
     def __call__(self, parser, args, values, option_string=None):
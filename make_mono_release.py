@@ -9,16 +9,15 @@ import re
 import os
 import os.path
 import hashlib
+from lputil import dirfind
 
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
 def get_parallel_docs(paradir):
   paradocs = set()
-  for root, dirs, files in os.walk(paradir):
-    for file in files:
-      if file.endswith('.manifest'):
-        for line in open('%s/%s' % (root, file)):
-          paradocs.add(line.split('\t')[1])
+  for manifest in dirfind(paradir, '.manifest'):
+    for line in open(manifest):
+      paradocs.add(line.split('\t')[1])
   return paradocs
 
 def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
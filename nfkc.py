@@ -10,7 +10,10 @@ from collections import defaultdict as dd
 import re
 import os.path
 import gzip
-import unicodedata as ud
+from lputil import nfkc
+from io import BytesIO
+from multiprocessing import Pool
+from collections import deque
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -19,7 +22,9 @@ writer = codecs.getwriter('utf8')
 
 
 def prepfile(fh, code):
-  ret = gzip.open(fh.name, code if code.endswith("t") else code+"t") if fh.name.endswith(".gz") else fh
+  if fh is sys.stdin and 'b' in code:
+    fh = fh.buffer
+  ret = gzip.open(fh.name, code if code.endswith("t") or code.endswith("b") else code+"t") if fh.name.endswith(".gz") else fh
   if sys.version_info[0] == 2:
     if code.startswith('r'):
       ret = reader(fh)
@@ -30,6 +35,53 @@ def prepfile(fh, code):
       sys.exit(1)
   return ret
 
+def readchunks(fh, size):
+  ''' blocks of about size bytes of fh, ending at line ends '''
+  while True:
+    chunk = fh.read(size)
+    if not chunk:
+      return
+    if not chunk.endswith(b"\n"):
+      chunk += fh.readline()
+    yield chunk
+
+def normalize(chunk):
+  ''' nfkc normalized text of a chunk of bytes, and how many of its lines were skipped for not being utf-8 '''
+  # a newline never combines with its neighbors, so normalizing the chunk is normalizing each line
+  try:
+    return nfkc(chunk.decode('utf-8')), 0
+  except UnicodeDecodeError:
+    pass
+  ret = []
+  errcount = 0
+  for line in BytesIO(chunk):
+    try:
+      ret.append(nfkc(line.decode('utf-8')))
+    except UnicodeDecodeError:
+      errcount+=1
+  return ''.join(ret), errcount
+
+def normalized(chunks, jobs):
+  ''' normalize chunks, in order, jobs at a time '''
+  chunks = iter(chunks)
+  first = next(chunks, None)
+  second = next(chunks, None)
+  if jobs <= 1 or second is None:
+    for chunk in (first, second):
+      if chunk is not None:
+        yield normalize(chunk)
+    for chunk in chunks:
+      yield normalize(chunk)
+    return
+  # a bounded window rather than imap, which would read all of the input ahead
+  with Pool(jobs) as pool:
+    pending = deque(pool.apply_async(normalize, (chunk,)) for chunk in (first, second))
+    for chunk in chunks:
+      if len(pending) >= 2*jobs:
+        yield pending.popleft().get()
+      pending.append(pool.apply_async(normalize, (chunk,)))
+    while pending:
+      yield pending.popleft().get()
 
 
 def main():
@@ -37,6 +89,8 @@ def main():
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument("--infile", "-i", nargs='?', type=argparse.FileType('rb'), default=sys.stdin, help="input file")
   parser.add_argument("--outfile", "-o", nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="output file")
+  parser.add_argument("--jobs", "-j", type=int, default=1, help="processes to normalize with (output is the same as with one)")
+  parser.add_argument("--chunksize", type=int, default=1<<22, help="bytes of input per process at a time")
 
 
 
@@ -45,18 +99,14 @@ def main():
   except IOError as msg:
     parser.error(str(msg))
 
-  infile = prepfile(args.infile, 'r')
+  infile = prepfile(args.infile, 'rb')
   outfile = prepfile(args.outfile, 'w')
 
   errcount=0
-  for line in infile:
-    try:
-      outfile.write(ud.normalize('NFKC', line.decode('utf-8')))
-    except UnicodeDecodeError:
-      errcount+=1
-      continue
+  for text, chunkerrs in normalized(readchunks(infile, args.chunksize), args.jobs):
+    outfile.write(text)
+    errcount+=chunkerrs
   if errcount>0:
     sys.stderr.write("{} lines skipped for unicode errors\n".format(errcount))
 if __name__ == '__main__':
   main()
-
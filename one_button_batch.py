@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import os.path
+import shlex
+import json
+import time
+import one_button_lrlp
+from lputil import StepScheduler, write_run_report
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+
+class Job:
+  ''' one one_button_lrlp.py run, as part of a batch '''
+  def __init__(self, line):
+    self.line = line
+    self.steps, self.stepsbyname = one_button_lrlp.make_steps()
+    self.args = one_button_lrlp.parse_args(self.steps, shlex.split(line))
+    self.language = self.args.language
+    self.cache = one_button_lrlp.prepare(self.args, self.steps, self.stepsbyname)
+    self.start = self.args.start
+    self.stop = self.args.stop + 1
+    self.expdir = self.args.expdir
+    self.report = self.args.report if self.args.report is not None else \
+                  os.path.join(self.args.root, self.language, 'one_button_lrlp.report.json')
+
+  def schedule(self, scheduler):
+    ''' add this job's steps to the scheduler; steps after unpacking are
+    configured (and added) once unpacking is done '''
+    if self.start == 0 and self.stop > 0:
+      scheduler.add(self.steps[:1], cache=self.cache, then=self.unpacked)
+    elif self.start == 0:
+      scheduler.add(self.steps[:1], cache=self.cache)
+    else:
+      scheduler.add(self.rest(), cache=self.cache)
+
+  def unpacked(self, results):
+    self.expdir = one_button_lrlp.expdir_from(self.args, results[0])
+    return self.rest()
+
+  def rest(self):
+    one_button_lrlp.configure(self.args, self.steps, self.stepsbyname, self.expdir)
+    return self.steps[max(self.start, 1):self.stop]
+
+  def summary(self):
+    ''' when this job's steps started and finished, and how they fared '''
+    stats = [step.stats for step in self.steps[self.start:self.stop] if "start" in step.stats]
+    statuses = [stat.get("status", "not run") for stat in
+                (step.stats for step in self.steps[self.start:self.stop])]
+    # steps left unrun mean the run was aborted
+    ret = {"language":self.language, "command":self.line, "expdir":self.expdir,
+           "status":"aborted" if "not run" in statuses else "done",
+           "steps":len(statuses), "failed steps":statuses.count("failed")}
+    if len(stats) > 0:
+      ret["start"] = min(stat["start"] for stat in stats)
+      ret["end"] = max(stat["start"]+stat["wall"] for stat in stats)
+    return ret
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run one_button_lrlp.py for several languages at once, sharing "
+                                   "one budget of cores and disk-heavy steps between them",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--infile", "-i", type=argparse.FileType('r'), default=sys.stdin,
+                      help='jobs, one per line, each the arguments one_button_lrlp.py would get (# comments ok)')
+  parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+                      help='cores to share between all languages\' steps')
+  parser.add_argument("--iojobs", type=int, default=2,
+                      help='disk-heavy steps (unpacking, copying, tarring) that may run at once')
+  parser.add_argument("--report", default="one_button_batch.report.json",
+                      help='where to write per-language start, finish and elapsed times')
+  try:
+    args = parser.parse_args()
+  except IOError as msg:
+    parser.error(str(msg))
+
+  jobs = []
+  for line in args.infile:
+    line = line.split('#')[0].strip()
+    if len(line) == 0:
+      continue
+    jobs.append(Job(line))
+  languages = [job.language for job in jobs]
+  for language in set(languages):
+    if languages.count(language) > 1:
+      sys.stderr.write("%s appears more than once; its runs would clobber each other\n" % language)
+      sys.exit(1)
+
+  scheduler = StepScheduler(args.jobs, iojobs=args.iojobs)
+  for job in jobs:
+    job.schedule(scheduler)
+  batchstart = time.time()
+  try:
+    scheduler.run()
+  except SystemExit:
+    pass
+  finally:
+    for job in jobs:
+      write_run_report(job.steps[job.start:job.stop], job.report, job.args.tokcachepath)
+  summaries = []
+  for job in jobs:
+    summary = job.summary()
+    if "end" in summary:
+      summary["elapsed"] = summary["end"]-batchstart
+    summaries.append(summary)
+    sys.stderr.write("%s: %s after %s\n" % (job.language, summary["status"],
+                                             "%.1fs" % summary["elapsed"] if "elapsed" in summary else "nothing"))
+  with open(args.report, 'w') as ofh:
+    json.dump({"start":batchstart, "end":time.time(), "languages":summaries}, ofh, indent=2)
+    ofh.write("\n")
+  if any(summary["status"] != "done" for summary in summaries):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -7,7 +7,9 @@ import codecs
 from collections import defaultdict as dd
 import re
 import os.path
-from lputil import Step, make_action, dirfind, mkdir_p
+import gather_ephemera
+from lputil import Step, StepCache, make_action, dirfind, mkdir_p, run_steps, write_run_report, fs_exists, fs_glob, using_tarindex, \
+                   using_inventory, update_inventory, TokenCache
 from subprocess import check_output, check_call, CalledProcessError
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
@@ -19,16 +21,17 @@ def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
   group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
 
 
-def main():
+def make_steps():
+  ''' the steps, in order, and by name '''
   steps = []
   # Put additional steps in here. Arguments, stdin/stdout, etc. get set below
 
   # unpack_lrlp.sh
-  steps.append(Step('unpack_lrlp.sh', call=check_output,
+  steps.append(Step('unpack_lrlp.sh', call=check_output, io=True,
                     help="untars lrlp into position for further processing"))
 
   # gather_ephemera.py
-  steps.append(Step('gather_ephemera.py',
+  steps.append(Step('gather_ephemera.py', io=True,
                     help="relocates assorted bits from lrlp"))
 
   # extract_lexicon.py
@@ -37,7 +40,7 @@ def main():
                     abortOnFail=False))
 
   # clean_lexicon
-  steps.append(Step('clean.sh',
+  steps.append(Step('clean.py',
                     name="clean_lexicon",
                     help="wildeclean/nfkc lexicon file",
                     abortOnFail=False))
@@ -48,7 +51,7 @@ def main():
                     abortOnFail=False))
 
   # relocate lexicon
-  steps.append(Step('cp', progpath='/bin',
+  steps.append(Step('cp', progpath='/bin', io=True,
                     name="relocate_lexicon",
                     help="move the lexicon stuff into ephemera",
                     abortOnFail=False))
@@ -91,7 +94,10 @@ def main():
   stepsbyname = {}
   for step in steps:
     stepsbyname[step.name] = step
+  return steps, stepsbyname
 
+def parse_args(steps, argv=None):
+  ''' the command line options '''
   parser = argparse.ArgumentParser(description="Process a LRLP into flat format",
                                    formatter_class= \
                                    argparse.ArgumentDefaultsHelpFormatter)
@@ -124,13 +130,29 @@ def main():
   parser.add_argument("--liststeps", "-x", nargs=0, action=make_action(steps),
                       help='print step list and exit')
   parser.add_argument("--ruby", default="ruby", help='path to ruby (2.1 or higher)')
+  parser.add_argument("--jobs", "-j", type=int, default=1,
+                      help='number of steps that may run at once (steps only overlap if their inputs and outputs allow)')
   addonoffarg(parser, "swap", help="swap source/target in found data (e.g. il3)", default=False)
+  addonoffarg(parser, "cache", help="skip steps whose inputs, arguments and script are unchanged since "
+              "they last succeeded and whose outputs are intact", default=True)
+  addonoffarg(parser, "stream", help="don't unpack the lrlp; index the tarballs and have the extractors read "
+              "straight from them (only docs, tools and top level files are unpacked)", default=False)
+  addonoffarg(parser, "inprocess", help="run this repo's python steps by forking this interpreter and calling "
+              "their main(), instead of through a shell and a new interpreter", default=False)
+  addonoffarg(parser, "tokcache", help="remember tokenizer output per line in root/language/tokcache.sqlite (taking in "
+              "--previous's) so that text seen before isn't tokenized again", default=True)
+  parser.add_argument("--tokcachesize", type=int, default=5000000,
+                      help='most lines to keep in the tokenizer cache')
+  parser.add_argument("--report", default=None,
+                      help='where to write the json run report of per-step time, cpu, memory, and bytes written (default root/language/one_button_lrlp.report.json)')
   try:
-    args = parser.parse_args()
+    return parser.parse_args(argv)
   except IOError as msg:
     parser.error(str(msg))
     sys.exit(2)
 
+def prepare(args, steps, stepsbyname):
+  ''' check the options and set up step 0; returns the step cache, if any '''
   if args.expdir is not None and args.start <= 0:
     sys.stderr.write \
       ("Warning: expdir is set but will be ignored and determined dynamically")
@@ -141,8 +163,6 @@ def main():
 
   rootdir = args.root
   language = args.language
-  start = args.start
-  stop = args.stop + 1
   if (args.key is None) ^ (args.set is None):
     sys.stderr.write("key (-k) and set (-S) must both be set or unset\n")
     sys.exit(1)
@@ -151,22 +171,64 @@ def main():
   argstring += " -l %s -r %s %s" % (language, rootdir, ' '.join(args.tarball))
   sys.stderr.write("args for unpack lrlp are {}\n".format(argstring))
   stepsbyname["unpack_lrlp.sh"].argstring=argstring
+  stepsbyname["unpack_lrlp.sh"].inputs = list(args.tarball)
+  stepsbyname["unpack_lrlp.sh"].outputs = [os.path.join(rootdir, language, 'lrlps'),
+                                           os.path.join(rootdir, language, 'expanded')]
+  args.tarindex = None
+  if args.stream:
+    args.tarindex = os.path.join(rootdir, language, 'lrlps', 'lrlp.index.json')
+    stepsbyname["unpack_lrlp.sh"].prog = "index_lrlp.py"
+    stepsbyname["unpack_lrlp.sh"].argstring += " -o %s" % args.tarindex
 
-  if start == 0:
-    expdir = steps[0].run().strip().decode("utf-8")
-    if args.evalil:
-      expdir = os.path.join(expdir, 'set0')
-    start += 1
-  else:
-    expdir = args.expdir
-  monodir=os.path.join(expdir, 'data', 'monolingual_text')
-  # what are the mono files? (needed for later)
-  if args.mono and args.previous is None:
-    monoindirs = dirfind(monodir, "ltf.zip")
-  else:
-    monoindirs = []
-  # Patchups for the rest
-  if stop > 0:
+  for step in steps:
+    step.inprocess = args.inprocess
+  if args.stream:
+    # every script run after unpacking reads the lrlp through the index
+    for step in steps[1:]:
+      step.env["LRLP_TARINDEX"] = args.tarindex
+  args.tokcachepath = None
+  if args.tokcache:
+    mkdir_p(os.path.join(rootdir, language))
+    args.tokcachepath = os.path.join(rootdir, language, 'tokcache.sqlite')
+    tokcache = TokenCache(args.tokcachepath, args.tokcachesize)
+    if args.previous is not None and os.path.exists(os.path.join(args.previous, 'tokcache.sqlite')):
+      tokcache.seed(os.path.join(args.previous, 'tokcache.sqlite'))
+    # the run report counts hits for this run only
+    tokcache.resetstats()
+    for step in steps[1:]:
+      step.env["LRLP_TOKCACHE"] = args.tokcachepath
+  cache = None
+  if args.cache:
+    mkdir_p(os.path.join(rootdir, language))
+    cache = StepCache(os.path.join(rootdir, language, 'one_button_lrlp.cache.json'))
+  return cache
+
+def expdir_from(args, output):
+  ''' where step 0 says the lrlp was unpacked '''
+  expdir = output.strip().decode("utf-8")
+  if args.evalil:
+    expdir = os.path.join(expdir, 'set0')
+  return expdir
+
+def configure(args, steps, stepsbyname, expdir):
+  ''' set up the steps after unpacking, now that expdir is known '''
+  rootdir = args.root
+  language = args.language
+  inventory = None
+  if args.tarindex is None and os.path.isdir(expdir):
+    # list the unpacked lrlp once; later steps (and the patchups) take their listings from it
+    inventory = os.path.normpath(expdir)+".inventory.json"
+    update_inventory(expdir, inventory)
+    for step in steps[1:]:
+      step.env["LRLP_INVENTORY"] = inventory
+  with using_tarindex(args.tarindex), using_inventory(inventory):
+    monodir=os.path.join(expdir, 'data', 'monolingual_text')
+    # what are the mono files? (needed for later)
+    if args.mono and args.previous is None:
+      monoindirs = dirfind(monodir, "ltf.zip")
+    else:
+      monoindirs = []
+    # Patchups for the rest
     # TWEET
     tweetintab = os.path.join(expdir, 'docs', 'twitter_info.tab')
     tweetdir = os.path.join(rootdir, language, 'tweet', 'rsd')
@@ -198,14 +260,17 @@ def main():
           stepsbyname["get_tweet_by_id.rb"].progpath = "/bin"
           stepsbyname["get_tweet_by_id.rb"].prog = "cp"
           stepsbyname["get_tweet_by_id.rb"].argstring = "-r {} {}".format(oldtweetdir, tweetdir)
+          stepsbyname["get_tweet_by_id.rb"].inputs = [oldtweetdir,]
       else:
         stepsbyname["get_tweet_by_id.rb"].progpath = tweetprogpath
         stepsbyname["get_tweet_by_id.rb"].argstring = tweetdir+" -l "+language
         stepsbyname["get_tweet_by_id.rb"].scriptbin = args.ruby
+        stepsbyname["get_tweet_by_id.rb"].inputs = []
         if os.path.exists(tweetintab):
           stepsbyname["get_tweet_by_id.rb"].stdin = tweetintab
         else:
           stepsbyname["get_tweet_by_id.rb"].disable()
+      stepsbyname["get_tweet_by_id.rb"].outputs = [tweetdir,]
 
       # TOKENIZE AND RELOCATE TWEETS
       # find rb location, params file
@@ -236,6 +301,11 @@ def main():
         tokparam=tokparam,
         outfile=os.path.join(rootdir, language, 'ldc_tok.stats'))
       stepsbyname["ldc_tok.py"].stderr = os.path.join(rootdir, language, 'ldc_tok.err')
+      # ltf is built alongside the downloaded rsd
+      stepsbyname["ldc_tok.py"].inputs = [tweetdir,]
+      stepsbyname["ldc_tok.py"].outputs = [os.path.dirname(tweetdir), lrlpdir,
+                                           os.path.join(monodir, mononame+".zip"),
+                                           os.path.join(rootdir, language, 'ldc_tok.stats')]
 
     # EPHEMERA
     ephemdir = os.path.join(rootdir, language, 'ephemera')
@@ -245,6 +315,10 @@ def main():
     stepsbyname['gather_ephemera.py'].argstring = ephemarg
     ephemerr = os.path.join(rootdir, language, 'gather_ephemera.err')
     stepsbyname['gather_ephemera.py'].stderr = ephemerr
+    stepsbyname['gather_ephemera.py'].inputs = [os.path.join(expdir, x) for x in gather_ephemera.manifest]
+    stepsbyname['gather_ephemera.py'].outputs = [ephemdir,]
+    if args.previous is not None:
+      stepsbyname['gather_ephemera.py'].inputs.append(os.path.join(args.previous, 'ephemera'))
 
     # # LTF2RSD
     # l2rindir = os.path.join(expdir, 'data', 'translation', 'from_'+language,
@@ -275,7 +349,8 @@ def main():
     lexiconcleanerr = os.path.join(rootdir, language, 'clean_lexicon.err')
     lexiconnormerr = os.path.join(rootdir, language, 'normalize_lexicon.err')
     # lexicon v1.5 for y2
-    stepsbyname["extract_lexicon.py"].argstring = " -v {} -i {} -o {}".format(args.lexversion, lexiconinfile, lexiconrawoutfile)
+    lexiconinfiles = ' '.join(fs_glob(lexiconinfile)) or lexiconinfile if args.stream else lexiconinfile
+    stepsbyname["extract_lexicon.py"].argstring = " -v {} -i {} -o {}".format(args.lexversion, lexiconinfiles, lexiconrawoutfile)
     stepsbyname["extract_lexicon.py"].stderr = lexiconerr
 
     stepsbyname["clean_lexicon"].argstring = "{} {}".format(lexiconrawoutfile, lexiconoutfile)
@@ -288,6 +363,15 @@ def main():
 
     stepsbyname["relocate_lexicon"].argstring = "-r %s %s" % (lexiconoutdir, ephemdir)
 
+    stepsbyname["extract_lexicon.py"].inputs = [lexiconinfile,]
+    stepsbyname["extract_lexicon.py"].outputs = [lexiconoutdir,]
+    stepsbyname["clean_lexicon"].inputs = [lexiconrawoutfile,]
+    stepsbyname["clean_lexicon"].outputs = [lexiconoutfile,]
+    stepsbyname["normalize_lexicon.py"].inputs = [lexiconoutfile,]
+    stepsbyname["normalize_lexicon.py"].outputs = [lexiconnormoutfile,]
+    stepsbyname["relocate_lexicon"].inputs = [lexiconoutdir,]
+    stepsbyname["relocate_lexicon"].outputs = [ephemdir,]
+
     # PSM
     # just copy from previous or skip if no mono
     psmerr = os.path.join(rootdir, language, 'extract_psm_annotation.err')
@@ -301,10 +385,15 @@ def main():
         stepsbyname["extract_psm_annotation.py"].progpath = "/bin"
         stepsbyname["extract_psm_annotation.py"].prog = "cp"
         stepsbyname["extract_psm_annotation.py"].argstring = "{} {}".format(oldpsm, psmoutpath)
+        stepsbyname["extract_psm_annotation.py"].inputs = [oldpsm,]
     else:
       psmindir = os.path.join(monodir, 'zipped', '*.psm.zip')
+      # the shell can't see into the tarballs, so expand globs here
+      psminfiles = ' '.join(fs_glob(psmindir)) or psmindir if args.stream else psmindir
       stepsbyname["extract_psm_annotation.py"].argstring = "-i %s -o %s" % \
-                                                           (psmindir, psmoutpath)
+                                                           (psminfiles, psmoutpath)
+      stepsbyname["extract_psm_annotation.py"].inputs = [psmindir,]
+    stepsbyname["extract_psm_annotation.py"].outputs = [psmoutpath,]
 
 
     # ENTITY
@@ -313,15 +402,21 @@ def main():
     stepsbyname["extract_entity_annotation.py"].argstring="-r %s -o %s -et %s" \
       % (expdir, entityoutpath, tweetdir)
     stepsbyname["extract_entity_annotation.py"].stderr = entityerr
+    stepsbyname["extract_entity_annotation.py"].inputs = [os.path.join(expdir, 'data', 'annotation'), tweetdir]
+    stepsbyname["extract_entity_annotation.py"].outputs = [entityoutpath,]
 
     # PARALLEL
     paralleloutdir = os.path.join(rootdir, language, 'parallel', 'extracted')
     parallelerr = os.path.join(rootdir, language, 'extract_parallel.err')
     stepsbyname["extract_parallel.py"].argstring="--no-cdec -r %s -o %s -s %s" % \
       (expdir, paralleloutdir, language)
+    stepsbyname["extract_parallel.py"].argstring += " -j %d" % args.jobs
+    stepsbyname["extract_parallel.py"].cpu = args.jobs
     stepsbyname["extract_parallel.py"].stderr = parallelerr
     if args.swap:
       stepsbyname["extract_parallel.py"].argstring += " --swap"
+    stepsbyname["extract_parallel.py"].inputs = [os.path.join(expdir, 'data', 'translation'),]
+    stepsbyname["extract_parallel.py"].outputs = [paralleloutdir,]
 
     filteroutdir = os.path.join(rootdir, language, 'parallel', 'filtered')
     rejectoutdir = os.path.join(rootdir, language, 'parallel', 'rejected')
@@ -329,6 +424,8 @@ def main():
     stepsbyname["filter_parallel.py"].argstring="-s 2 -l %s -i %s -f %s -r %s" % \
       (language, paralleloutdir, filteroutdir, rejectoutdir)
     stepsbyname["filter_parallel.py"].stderr = filtererr
+    stepsbyname["filter_parallel.py"].inputs = [paralleloutdir,]
+    stepsbyname["filter_parallel.py"].outputs = [filteroutdir, rejectoutdir]
 
     # MONO
     # just copy from previous or skip if no mono
@@ -343,24 +440,62 @@ def main():
         stepsbyname["extract_mono.py"].progpath = "/bin"
         stepsbyname["extract_mono.py"].prog = "cp"
         stepsbyname["extract_mono.py"].argstring = "-r {} {}".format(oldmonodir, monooutdir)
+        stepsbyname["extract_mono.py"].inputs = [oldmonodir,]
+        stepsbyname["extract_mono.py"].outputs = [monooutdir,]
     else:
       monooutdir = os.path.join(rootdir, language, 'mono', 'extracted')
-      stepsbyname["extract_mono.py"].argstring = "--no-cdec -i %s -o %s" % \
-                                                 (' '.join(monoindirs), monooutdir)
+      stepsbyname["extract_mono.py"].argstring = "--no-cdec -j %d -i %s -o %s" % \
+                                                 (args.jobs, ' '.join(monoindirs), monooutdir)
+      stepsbyname["extract_mono.py"].cpu = args.jobs
+      stepsbyname["extract_mono.py"].inputs = list(monoindirs)
+      stepsbyname["extract_mono.py"].outputs = [monooutdir,]
 
 
     # COMPARABLE
-    if os.path.exists(os.path.join(expdir, 'data', 'translation', 'comparable')):
+    if fs_exists(os.path.join(expdir, 'data', 'translation', 'comparable')):
       compoutdir = os.path.join(rootdir, language, 'comparable', 'extracted')
       comperr = os.path.join(rootdir, language, 'extract_comparable.err')
       stepsbyname["extract_comparable.py"].argstring = "-r %s -o %s -s %s" % \
                                                        (expdir, compoutdir, language)
       stepsbyname["extract_comparable.py"].stderr = comperr
+      stepsbyname["extract_comparable.py"].inputs = [os.path.join(expdir, 'data', 'translation', 'comparable'),]
+      stepsbyname["extract_comparable.py"].outputs = [compoutdir,]
     else:
       stepsbyname["extract_comparable.py"].disable()
-    
-    for step in steps[start:stop]:
-      step.run()
+
+  if args.stream:
+    # the lrlp's contents aren't on disk, so the index stands in for them
+    for step in steps[1:]:
+      if step.inputs is not None:
+        step.inputs.append(args.tarindex)
+
+def main():
+  steps, stepsbyname = make_steps()
+  args = parse_args(steps)
+  cache = prepare(args, steps, stepsbyname)
+  start = args.start
+  firststep = start
+  stop = args.stop + 1
+  report = args.report if args.report is not None else \
+           os.path.join(args.root, args.language, 'one_button_lrlp.report.json')
+
+  if start == 0:
+    if cache is not None:
+      expdir = expdir_from(args, cache.run(steps[0]))
+    else:
+      expdir = expdir_from(args, steps[0].run())
+    start += 1
+  else:
+    expdir = args.expdir
+  if stop > 0:
+    configure(args, steps, stepsbyname, expdir)
+    try:
+      run_steps(steps[start:stop], jobs=args.jobs, cache=cache)
+    finally:
+      write_run_report(steps[firststep:stop], report, args.tokcachepath)
+    if cache is not None:
+      # unpacking happened outside the scheduler; later steps add to its tree
+      cache.save(steps[:1])
 
 
   print("Done.\nExpdir is %s" % expdir)
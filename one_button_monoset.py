@@ -7,10 +7,17 @@ import copy
 from collections import defaultdict as dd
 import re
 import os.path
-from lputil import Step, make_action, dirfind, mkdir_p
+from lputil import Step, StepCache, make_action, dirfind, mkdir_p, run_steps
 from subprocess import check_output, check_call, CalledProcessError
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
+def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
+  ''' add the switches --arg and --no-arg that set parser.arg to true/false, respectively'''
+  group = parser.add_mutually_exclusive_group()
+  dest = arg if dest is None else dest
+  group.add_argument('--%s' % arg, dest=dest, action='store_true', default=default, help=help)
+  group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
+
 
 def main():
   steps = []
@@ -67,6 +74,10 @@ def main():
   parser.add_argument("--liststeps", "-x", nargs=0, action=make_action(steps),
                       help='print step list and exit')
   parser.add_argument("--ruby", default="/opt/local/bin/ruby2.2", help='path to ruby (2.1 or higher)')
+  addonoffarg(parser, 'cache', default=True,
+              help='skip steps whose inputs, arguments and script are unchanged since they last succeeded and whose outputs are intact')
+  addonoffarg(parser, 'inprocess', default=False,
+              help="run this repo's python steps by forking this interpreter and calling their main(), instead of through a shell and a new interpreter")
 
   try:
     args = parser.parse_args()
@@ -153,6 +164,8 @@ def main():
     tweeterr = os.path.join(outdir, 'extract_tweet.err')
     stepsbyname["get_tweet_by_id.rb"].stderr = tweeterr
     stepsbyname["get_tweet_by_id.rb"].scriptbin = args.ruby
+    stepsbyname["get_tweet_by_id.rb"].inputs = []
+    stepsbyname["get_tweet_by_id.rb"].outputs = [tweetdir,]
 
         # TOKENIZE AND RELOCATE TWEETS
     # find rb location, params file
@@ -181,6 +194,10 @@ def main():
       tokparam=tokparam,
       outfile=os.path.join(rootdir, language, 'ldc_tok.stats'))
     stepsbyname["ldc_tok.py"].stderr = os.path.join(rootdir, language, 'ldc_tok.err')
+    stepsbyname["ldc_tok.py"].inputs = [tweetdir,]
+    stepsbyname["ldc_tok.py"].outputs = [os.path.dirname(tweetdir),
+                                         os.path.join(monodir, mononame+".zip"),
+                                         os.path.join(rootdir, language, 'ldc_tok.stats')]
 
   # # TODO: log tweets!
 
@@ -201,6 +218,8 @@ def main():
       if notweetsinmono:
         stepsbyname["extract_mono_%s" % flavor].argstring += " --removesn"
       stepsbyname["extract_mono_%s" % flavor].stderr = monoerr
+      stepsbyname["extract_mono_%s" % flavor].inputs = list(localmonoindirs)
+      stepsbyname["extract_mono_%s" % flavor].outputs = [monooutdir,]
 
 
       # since we package and extract all at once, use the ltf structure to declare the manifest names
@@ -227,6 +246,8 @@ def main():
       stepsbyname["make_mono_release_%s" % flavor].argstring = "--no-ext -r %s -l %s -c %s -s %s | gzip > %s" % \
                                                       (monooutdir, flavor, manarg, monostatsfile, monoxml)
       stepsbyname["make_mono_release_%s" % flavor].stderr = monoerr
+      stepsbyname["make_mono_release_%s" % flavor].inputs = [monooutdir,]
+      stepsbyname["make_mono_release_%s" % flavor].outputs = [monoxml, monostatsfile]
 
 
 
@@ -244,6 +265,8 @@ def main():
     if notweetsinmono:
       stepsbyname["extract_mono.py"].argstring += " --removesn"
     stepsbyname["extract_mono.py"].stderr = monoerr
+    stepsbyname["extract_mono.py"].inputs = list(monoindirs)
+    stepsbyname["extract_mono.py"].outputs = [monooutdir,]
 
 
     # since we package and extract all at once, use the ltf structure to declare the manifest names
@@ -266,9 +289,13 @@ def main():
     stepsbyname["make_mono_release.py"].argstring = "--no-ext -r %s -l %s -c %s -s %s | gzip > %s" % \
                                                     (monooutdir, language, manarg, monostatsfile, monoxml)
     stepsbyname["make_mono_release.py"].stderr = monoerr
+    stepsbyname["make_mono_release.py"].inputs = [monooutdir,]
+    stepsbyname["make_mono_release.py"].outputs = [monoxml, monostatsfile]
 
-  for step in steps[start:stop]:
-    step.run()
+  for step in steps:
+    step.inprocess = args.inprocess
+  cache = StepCache(os.path.join(outdir, 'one_button_monoset.cache.json')) if args.cache else None
+  run_steps(steps[start:stop], cache=cache)
 
   print("Done.\nLast file is %s" % outfile)
 
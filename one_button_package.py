@@ -5,7 +5,7 @@ import os.path
 import re
 import sys
 
-from lputil import Step, make_action
+from lputil import Step, StepCache, make_action, run_steps, write_run_report
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -24,7 +24,7 @@ def make_steps():
     steps.append(Step('make_mono_release.py', help="package mono flat data"))
 
     # package up audio and ephemera
-    steps.append(Step('make_tarball.py', name="tar-ephemera", help="package ephemera"))
+    steps.append(Step('make_tarball.py', name="tar-ephemera", io=True, help="package ephemera"))
 
     # make_parallel_release.py
     for i in ('train', 'dev', 'test', 'syscomb', 'setE', 'rejected'):
@@ -37,7 +37,7 @@ def make_steps():
     steps.append(Step('make_mono_release.py', name="comparable-trg", help="package trg side of comparable data"))
 
     # package up everything
-    steps.append(Step('make_tarball.py', name="tar-all", help="final package"))
+    steps.append(Step('make_tarball.py', name="tar-all", io=True, help="final package"))
 
     steps_by_name = dict((s.name, s) for s in steps)
     return steps, steps_by_name
@@ -58,6 +58,15 @@ def parse_args(steps):
     parser.add_argument("--start", "-s", type=int, default=0, help='step to start at')
     parser.add_argument("--stop", "-p", type=int, default=len(steps) - 1, help='step to stop at (inclusive)')
     parser.add_argument("--liststeps", "-x", nargs=0, action=make_action(steps), help='print step list and exit')
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help='number of steps that may run at once (steps only overlap if their inputs and outputs allow)')
+    addonoffarg(parser, "cache", help="skip steps whose inputs, arguments and script are unchanged since "
+                "they last succeeded and whose outputs are intact", default=True)
+    addonoffarg(parser, "inprocess", help="run this repo's python steps by forking this interpreter and calling "
+                "their main(), instead of through a shell and a new interpreter", default=False)
+    parser.add_argument("--report", default=None,
+                        help='where to write the json run report of per-step time, cpu, memory, and bytes written '
+                             '(default root/one_button_package.report.json)')
     try:
         return parser.parse_args()
     except IOError as msg:
@@ -100,6 +109,8 @@ def main():
             stepsbyname["make_mono_release.py"].argstring += (" -p " + psmoutpath)
         stepsbyname["make_mono_release.py"].argstring += (" --paradir %s | gzip > %s" % (paradir, monoxml))
         stepsbyname["make_mono_release.py"].stderr = monoerr
+        stepsbyname["make_mono_release.py"].inputs = [monooutdir, paradir, entityoutpath, psmoutpath]
+        stepsbyname["make_mono_release.py"].outputs = [monoxml, monostatsfile]
     else:
         stepsbyname["make_mono_release.py"].disable()
 
@@ -110,6 +121,8 @@ def main():
     stepsbyname["tar-ephemera"].argstring = "-p additional -i %s -o %s" %\
                                             (os.path.join(root_dir, 'ephemera', '*'), ephemerapack)
     stepsbyname["tar-ephemera"].stderr = os.path.join(root_dir, 'tar_ephemera.err')
+    stepsbyname["tar-ephemera"].inputs = [os.path.join(root_dir, 'ephemera')]
+    stepsbyname["tar-ephemera"].outputs = [ephemerapack]
 
     # PARALLEL RELEASES
     sets = ['train', 'rejected'] + args.sets
@@ -139,6 +152,8 @@ def main():
         stepsbyname["parallel-%s" % i] \
             .argstring += (" %s | gzip > %s" % (extra, parallelxml))
         stepsbyname["parallel-%s" % i].stderr = parallelerr
+        stepsbyname["parallel-%s" % i].inputs = [paralleloutdir, entityoutpath, psmoutpath]
+        stepsbyname["parallel-%s" % i].outputs = [parallelxml, statsfile]
 
     # COMPARABLE RELEASES
     cmpoutdir = os.path.join(root_dir, 'comparable', 'extracted')
@@ -160,6 +175,10 @@ def main():
                                                   "--exttokprefix AGILE -r %s -l eng -c eng -s %s | gzip > %s" % \
                                                   (cmpoutdir, cmptrgstatsfile, cmptrgxml)
         stepsbyname["comparable-trg"].stderr = os.path.join(root_dir, 'make_comparable_eng_release.err')
+        stepsbyname["comparable-src"].inputs = [cmpoutdir]
+        stepsbyname["comparable-src"].outputs = [cmpsrcxml, cmpsrcstatsfile]
+        stepsbyname["comparable-trg"].inputs = [cmpoutdir]
+        stepsbyname["comparable-trg"].outputs = [cmptrgxml, cmptrgstatsfile]
         # TODO: psm/entity info in comparable?
     else:
         stepsbyname["comparable-src"].disable()
@@ -174,10 +193,18 @@ def main():
     finalpackprefix = os.path.basename(finalpack)[:-4]
     stepsbyname["tar-all"].argstring = "-p %s -i %s -o %s" % \
                                        (finalpackprefix, ' '.join(final_items), finalpack)
-
-    for step in steps[start:stop]:
-        print("running {}, {}, {}, {}, {}".format(step.prog, step.name, step.scriptbin, step.progpath, step.call))
-        step.run()
+    stepsbyname["tar-all"].inputs = list(final_items)
+    stepsbyname["tar-all"].outputs = [finalpack]
+
+    for step in steps:
+        step.inprocess = args.inprocess
+    cache = StepCache(os.path.join(root_dir, 'one_button_package.cache.json')) if args.cache else None
+    report = args.report if args.report is not None else \
+             os.path.join(root_dir, 'one_button_package.report.json')
+    try:
+        run_steps(steps[start:stop], jobs=args.jobs, cache=cache)
+    finally:
+        write_run_report(steps[start:stop], report)
 
     print("Done")
 
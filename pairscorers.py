@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# scorers of aligned (foreign, english) line pairs, for filter_parallel.py
+import sys
+import re
+import importlib
+import unicodedata as ud
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+from lputil import controlmatcher
+
+scorers = {}
+
+def register(cls):
+  ''' class decorator: make a Scorer available by its name '''
+  scorers[cls.name] = cls
+  return cls
+
+def getscorer(name):
+  ''' the Scorer class called name, or, for a dotted name, the class module.Class '''
+  if name in scorers:
+    return scorers[name]
+  if '.' in name:
+    module, cls = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), cls)
+  raise KeyError("no scorer %s (there are %s)" % (name, ', '.join(sorted(scorers))))
+
+class Scorer(object):
+  ''' one signal about aligned lines. score() gets a batch of foreign lines and the english
+  lines they're aligned to and returns a float array, one score per pair; nan where the pair
+  says nothing either way. sides is which tails of the scores are suspect ('low', 'high' or 'both') '''
+  name = None
+  sides = 'low'
+
+  def __init__(self, args):
+    self.args = args
+
+  def prepare(self, flines, elines):
+    ''' look over a sample of the pairs before scoring any '''
+    pass
+
+  def options(self):
+    ''' whatever besides the lines determines the scores; saved scores are reused while it doesn't change '''
+    return {}
+
+  def score(self, flines, elines):
+    raise NotImplementedError
+
+@lru_cache(maxsize=None)
+def script(char):
+  ''' the script of a letter, as the first word of its unicode name ('LATIN', 'CYRILLIC', 'CJK', ...) '''
+  return ud.name(char, 'UNKNOWN').split(' ', 1)[0]
+
+def letterscripts(line):
+  return Counter(script(char) for char in line if char.isalpha())
+
+@register
+class ScriptScorer(Scorer):
+  ''' share of the english letters that are latin times share of the foreign letters in the foreign side's usual script '''
+  name = 'script'
+
+  def prepare(self, flines, elines):
+    counts = Counter()
+    for line in flines:
+      counts.update(letterscripts(line))
+    self.foreign = counts.most_common(1)[0][0] if counts else 'LATIN'
+
+  def options(self):
+    return {"foreign":self.foreign}
+
+  def score(self, flines, elines):
+    ret = np.full(len(flines), np.nan)
+    for i, (fline, eline) in enumerate(zip(flines, elines)):
+      shares = []
+      for line, want in ((fline, self.foreign), (eline, 'LATIN')):
+        counts = letterscripts(line)
+        total = sum(counts.values())
+        if total > 0:
+          shares.append(counts[want]/total)
+      if shares:
+        ret[i] = np.prod(shares)
+    return ret
+
+_digits = re.compile(r"\d+")
+
+def numbers(line):
+  return set(str(int(run)) for run in _digits.findall(line))
+
+@register
+class DigitScorer(Scorer):
+  ''' overlap (jaccard) of the numbers written on each side, whatever digits they're written in '''
+  name = 'digits'
+
+  def score(self, flines, elines):
+    ret = np.full(len(flines), np.nan)
+    for i, (fline, eline) in enumerate(zip(flines, elines)):
+      fnums, enums = numbers(fline), numbers(eline)
+      if fnums or enums:
+        ret[i] = len(fnums & enums)/len(fnums | enums)
+    return ret
+
+@register
+class PunctuationScorer(Scorer):
+  ''' agreement of the amount of punctuation on each side: 1 - |f-e|/max(f, e) '''
+  name = 'punct'
+
+  def score(self, flines, elines):
+    punct = controlmatcher(("Pc", "Pd", "Pe", "Pf", "Pi", "Po", "Ps"))[0]
+    fcounts = np.array([len(punct.findall(line)) for line in flines], dtype=float)
+    ecounts = np.array([len(punct.findall(line)) for line in elines], dtype=float)
+    most = np.maximum(fcounts, ecounts)
+    ret = np.full(len(flines), np.nan)
+    np.subtract(1, np.abs(fcounts-ecounts)/np.maximum(most, 1), out=ret, where=most > 0)
+    return ret
+
+@register
+class LexiconScorer(Scorer):
+  ''' share of the foreign words found in the lexicon (lexicon.norm from normalize_lexicon_tg.py)
+  that have a translation among the english words '''
+  name = 'lexicon'
+
+  def __init__(self, args):
+    super(LexiconScorer, self).__init__(args)
+    if getattr(args, 'lexicon', None) is None:
+      sys.stderr.write("The lexicon scorer needs --lexicon\n")
+      sys.exit(1)
+    self.translations = {}
+    with open(args.lexicon) as lfh:
+      for line in lfh:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 3 or len(fields[0].split()) != 1:
+          continue
+        self.translations.setdefault(fields[0], set()).update(fields[2].split())
+
+  def options(self):
+    return {"lexicon":self.args.lexicon, "entries":len(self.translations)}
+
+  def score(self, flines, elines):
+    ret = np.full(len(flines), np.nan)
+    for i, (fline, eline) in enumerate(zip(flines, elines)):
+      ewords = set(eline.lower().split())
+      known = [self.translations[word] for word in fline.lower().split() if word in self.translations]
+      if known:
+        ret[i] = sum(1 for trans in known if not trans.isdisjoint(ewords))/len(known)
+    return ret
+
+def passes(scores, sides, how, amount):
+  ''' which scores are in bounds, and the bounds. how is 'std' (mean±amount·std) or 'pct' (drop the
+  amount percent of scores in the suspect tails). nan scores always pass '''
+  known = scores[~np.isnan(scores)]
+  low, high = -np.inf, np.inf
+  if len(known) > 0:
+    if how == 'std':
+      low, high = np.mean(known)-amount*np.std(known), np.mean(known)+amount*np.std(known)
+    else:
+      tail = amount/2 if sides == 'both' else amount
+      low, high = np.percentile(known, tail), np.percentile(known, 100-tail)
+  if sides == 'low':
+    high = np.inf
+  elif sides == 'high':
+    low = -np.inf
+  with np.errstate(invalid='ignore'):
+    return np.isnan(scores) | ((scores >= low) & (scores <= high)), low, high
@@ -3,11 +3,11 @@
 import argparse
 import sys
 import codecs
-from itertools import cycle
+from array import array
 from collections import defaultdict as dd
 import re
 import os.path
-from heapq import heappush, heappop
+import numpy as np
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -15,38 +15,120 @@ def getoverlap(terms, words):
   ''' get fraction of words that are also terms '''
   return (len(terms.intersection(words))+0.0)/len(words)
 
+def readweights(termfile):
+  ''' lowercased term -> weight, from lines of a term and an optional tab-separated weight (default 1) '''
+  weights = {}
+  for line in termfile:
+    fields = line.strip().split('\t')
+    if fields[0] != '':
+      weights[fields[0].lower()] = float(fields[1]) if len(fields) > 1 else 1.0
+  return weights
+
+def readterms(termfile):
+  ''' lowercased terms, one per line '''
+  return set(readweights(termfile))
+
+def ranking(docs, scores):
+  ''' (doc, score) best first, ties by doc '''
+  order = np.lexsort((np.array(docs, dtype=str), -np.asarray(scores))) if len(docs) > 0 else []
+  return [(docs[i], float(scores[i])) for i in order]
+
+def rank(terms, docs):
+  ''' (doc, overlap) of docs (doc -> set of lowercased words), best first '''
+  return ranking(list(docs.keys()), np.array([getoverlap(terms, words) for words in docs.values()]))
+
+class DocTermMatrix(object):
+  ''' counts of the terms of vocab in each document, as csr arrays (indptr, indices, data), with each document's
+  length in tokens and, if types, its number of distinct types '''
+  def __init__(self, ids, lines, vocab, types=False):
+    self.vocab = {term:col for col, term in enumerate(vocab)}
+    rownums = {}
+    rows, cols = array('q'), array('q')
+    lengths = []
+    typesets = dd(set)
+    for doc, line in zip(ids, lines):
+      row = rownums.setdefault(doc.strip(), len(rownums))
+      if row == len(lengths):
+        lengths.append(0)
+      toks = line.lower().split()
+      lengths[row] += len(toks)
+      if types:
+        typesets[row].update(toks)
+      hits = [self.vocab[tok] for tok in toks if tok in self.vocab]
+      rows.extend([row]*len(hits))
+      cols.extend(hits)
+    self.docs = list(rownums)
+    self.lengths = np.array(lengths, dtype=np.float64)
+    self.types = np.array([len(typesets[row]) for row in range(len(lengths))], dtype=np.float64) if types else None
+    # sum the (row, col) pairs into row-major csr
+    keys, self.data = np.unique(np.frombuffer(rows, dtype=np.int64)*max(len(vocab), 1)+np.frombuffer(cols, dtype=np.int64),
+                                return_counts=True)
+    self.indices = keys % max(len(vocab), 1)
+    self.indptr = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // max(len(vocab), 1), minlength=len(lengths)), out=self.indptr[1:])
+
+  def rowof(self):
+    ''' row of each stored count '''
+    return np.repeat(np.arange(len(self.docs)), np.diff(self.indptr))
+
+  def df(self):
+    ''' number of documents with each term '''
+    return np.bincount(self.indices, minlength=len(self.vocab))
+
+  def score(self, weights, scoring='bm25', k1=1.2, b=0.75):
+    ''' each document's score against weights (vocab terms by term lists) '''
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(self.docs)
+    rows = self.rowof()
+    tf = self.data.astype(np.float64)
+    if scoring == 'overlap':
+      # weighted share of the document's types that are terms
+      entry = np.ones(len(tf))
+    elif scoring == 'tfidf':
+      idf = np.log((1.0+n)/(1.0+self.df()))+1.0
+      entry = tf/np.maximum(self.lengths[rows], 1)*idf[self.indices]
+    else:
+      df = self.df()
+      idf = np.log(1.0+(n-df+0.5)/(df+0.5))
+      norm = k1*(1.0-b+b*self.lengths[rows]/max(self.lengths.mean() if n > 0 else 0.0, 1e-9))
+      entry = idf[self.indices]*tf*(k1+1.0)/(tf+norm)
+    contrib = entry[:, None]*weights[self.indices]
+    ret = np.stack([np.bincount(rows, weights=contrib[:, i], minlength=n) for i in range(weights.shape[1])], axis=1).astype(np.float64)
+    if scoring == 'overlap':
+      ret /= np.maximum(self.types, 1)[:, None]
+    return ret
+
 def main():
-  parser = argparse.ArgumentParser(description="Rank documents by bag-of-words type overlap with triggers",
+  parser = argparse.ArgumentParser(description="Rank documents by relevance to trigger term lists: bag-of-words type overlap, bm25 or tf-idf",
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument("--infile", "-i", nargs='?', type=argparse.FileType('r'), default=sys.stdin, help="input data file used for making ranking decisions (original english)")
-  parser.add_argument("--idfile", "-d", nargs='?', type=argparse.FileType('r'), help="id file (docid per line)")
-  parser.add_argument("--termfile", "-t", nargs='?', type=argparse.FileType('r'), help="term file, presumed to be one term per line")
-  parser.add_argument("--outfile", "-o", nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="output file")
+  parser.add_argument("--idfile", "-d", nargs='?', type=argparse.FileType('r'), default=None, help="id file (docid per line); without one, each line is a document, named by its line number")
+  parser.add_argument("--termfile", "-t", nargs='+', type=argparse.FileType('r'), help="term files, presumed to be one term per line, optionally with a tab-separated weight")
+  parser.add_argument("--outfile", "-o", nargs='+', type=argparse.FileType('w'), default=[sys.stdout], help="output file for each term file")
+  parser.add_argument("--scoring", "-s", default="overlap", choices=["overlap", "bm25", "tfidf"], help="document score")
+  parser.add_argument("--k1", type=float, default=1.2, help="bm25 term frequency saturation")
+  parser.add_argument("--b", type=float, default=0.75, help="bm25 length normalization")
 
   try:
     args = parser.parse_args()
   except IOError as msg:
     parser.error(str(msg))
 
-  infile = args.infile
-  idfile = args.idfile
-  termfile = args.termfile
-  outfile =  args.outfile
+  if len(args.outfile) != len(args.termfile):
+    sys.stderr.write("%d term files but %d output files\n" % (len(args.termfile), len(args.outfile)))
+    sys.exit(1)
 
-  terms = set()
-  docs = dd(set)
-  for line in termfile:
-    terms.add(line.strip().lower())
-  for doc, seg in zip(idfile, infile):
-    doc = doc.strip()
-    seg = seg.strip()
-    docs[doc].update([x.lower() for x in seg.split()])
-  scores = []
-  for doc, words in docs.items():
-    heappush(scores, (-getoverlap(terms, words), doc))
-  while len(scores) > 0:
-    score, doc = heappop(scores)
-    outfile.write("%s\t%f\n" % (doc, -score))
+  termweights = [readweights(termfile) for termfile in args.termfile]
+  vocab = list(dict.fromkeys(term for weights in termweights for term in weights))
+  ids = args.idfile if args.idfile is not None else (str(linenum) for linenum in range(1, sys.maxsize))
+  # every term list is scored from the one matrix
+  matrix = DocTermMatrix(ids, args.infile, vocab, types=args.scoring == 'overlap')
+  weights = np.array([[weights.get(term, 0.0) for weights in termweights] for term in vocab]).reshape(len(vocab), len(termweights))
+  scores = matrix.score(weights, args.scoring, args.k1, args.b)
+  for col, outfile in enumerate(args.outfile):
+    for doc, score in ranking(matrix.docs, scores[:, col]):
+      outfile.write("%s\t%f\n" % (doc, score))
+    outfile.close()
 
 
 if __name__ == '__main__':
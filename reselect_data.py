@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import sys
 import codecs
 
 from collections import defaultdict as dd
@@ -9,30 +8,10 @@ import re
 import os
 import os.path
 from lputil import mkdir_p, touch
-from subprocess import check_output, STDOUT, CalledProcessError
 from shutil import copy
-import shlex
+from selection import read_ids, write_ids, read_cats, selection_files, route
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
-def runselection(prefix, idfile, catfile, remainder, filetypes, srclang, indir, outdir):
-  ''' apply a previous data selection to a set of files '''
-  try:
-    for filetype in filetypes:
-      if os.path.exists(os.path.join(indir, filetype)):
-        for flang in [srclang, 'eng']:
-          flatfile = os.path.join(indir, filetype, "%s.%s.%s.flat" % (prefix, filetype, flang))
-          if not(os.path.exists(flatfile)):
-            print("***Warning: %s does not exist so not selecting" % flatfile)
-            continue
-          cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -P %s -r %s" % (scriptdir, flatfile, idfile, catfile, outdir, filetype, remainder)
-          print("Running "+cmd)
-          cmd_output=check_output(shlex.split(cmd), stderr=STDOUT)
-          print(cmd_output)
-  except CalledProcessError as exc:
-    print("Status : FAIL", exc.returncode, exc.output)
-    sys.exit(1)
-
-
 def main():
   parser = argparse.ArgumentParser(description="Make dataset selections for experimentation given previously generated categorization files",
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -41,6 +20,7 @@ def main():
   parser.add_argument("--extractpath", "-e", default="filtered", help="location of extracted data (might want to use 'filtered')")
   parser.add_argument("--remainder", "-r", default="train", help="remainder category. Should match previous remainder category")
   parser.add_argument("--previous", "-p", help="location of previous cat files")
+  parser.add_argument("--threads", type=int, default=8, help="files to split at once")
 
 
 
@@ -77,48 +57,22 @@ def main():
       if (not os.path.exists(manfile)) or os.path.getsize(manfile) == 0:
         print("removing "+prefix)
         preflist.remove(prefix)
-  # doc-based processing
-  for prefix in docprefixes:
-    idfile = os.path.join(outpath, "%s.ids" % prefix)
-    manfile = os.path.join(extractpath, "%s.eng.manifest" % prefix)
-    try:
-      check_output("cut -f2 %s > %s" % (manfile, idfile), stderr=STDOUT, shell=True)
-    except CalledProcessError as exc:
-      print("Status : FAIL", exc.returncode, exc.output)
-    catfile = os.path.join(args.previous, "%s.cats" % prefix)
-    newcatfile = os.path.join(outpath, os.path.basename(catfile))
-    if os.path.exists(catfile):
-      copy(catfile, newcatfile)
-    else:
-      touch(newcatfile)
-    runselection(prefix, idfile, newcatfile, args.remainder, filetypes, args.language, extractpath, outpath)
-    for i in (args.language, 'eng'):
-      manifest = os.path.join(extractpath, "%s.%s.manifest" % (prefix, i))
-      cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -r %s" % (scriptdir, manifest, idfile, newcatfile, outpath, args.remainder)
-      print("Running "+cmd)
-      check_output(cmd, stderr=STDOUT, shell=True)
-
-  # nodoc-based processing
-
-  for prefix in nodocprefixes:
-    idfile = os.path.join(outpath, "%s.fakeids" % prefix)
-    try:
-      mansize = int(check_output("wc -l %s" % os.path.join(extractpath, "%s.eng.manifest" % prefix), shell=True).decode('utf-8').strip().split(' ')[0])
-      check_output("seq %d > %s" % (mansize, idfile), stderr=STDOUT, shell=True)
-    except CalledProcessError as exc:
-      print("Status : FAIL", exc.returncode, exc.output)
+  # doc-based processing keeps documents together; nodoc-based processing selects segments
+  for prefix in docprefixes+nodocprefixes:
+    perseg = prefix in nodocprefixes
+    ids = read_ids(os.path.join(extractpath, "%s.eng.manifest" % prefix), perseg=perseg)
+    write_ids(os.path.join(outpath, "%s.%s" % (prefix, "fakeids" if perseg else "ids")), ids)
     catfile = os.path.join(args.previous, "%s.cats" % prefix)
     newcatfile = os.path.join(outpath, os.path.basename(catfile))
     if os.path.exists(catfile):
       copy(catfile, newcatfile)
     else:
       touch(newcatfile)
-    runselection(prefix, idfile, newcatfile, args.remainder, filetypes, args.language, extractpath, outpath)
-    for i in (args.language, 'eng'):
-      manifest = os.path.join(extractpath, "%s.%s.manifest" % (prefix, i))
-      cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -r %s" % (scriptdir, manifest, idfile, newcatfile, outpath, args.remainder)
-      print("Running "+cmd)
-      check_output(cmd, stderr=STDOUT, shell=True)
+    infiles = selection_files(extractpath, prefix, filetypes, args.language)
+    print("Selecting %s into %s" % (', '.join(infile for infile, subdir in infiles), outpath))
+    backupcount = route(ids, read_cats(newcatfile), infiles, outpath, args.remainder, threads=args.threads)
+    if backupcount > 0:
+      print("{} lines of {} routed via backup retrieval".format(backupcount, prefix))
 
 if __name__ == '__main__':
   main()
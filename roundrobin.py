@@ -2,7 +2,9 @@
 
 import argparse
 import sys
-from itertools import cycle
+from bisect import bisect_left, insort
+from collections import Counter, deque
+from heapq import heapify, heappop
 import logging as log
 
 log.basicConfig(level=log.DEBUG)
@@ -27,15 +29,138 @@ def parse_args():
     parser.add_argument("--setElstfile", "-E", default=None, type=argparse.FileType('r'),
                         help="file of desired documents for setE (subject to length constraints,"
                              " must be a set called 'setE')")
+    parser.add_argument("--excludefile", "-x", default=None, type=argparse.FileType('r'),
+                        help="file of documents to keep out of every category but the remainder"
+                             " (e.g. duplicates found by dedup_index.py)")
+    parser.add_argument("--fit", default="roundrobin", choices=["roundrobin", "bestfit"],
+                        help="roundrobin: categories take turns taking the next document in order; bestfit: biggest"
+                             " documents first, each into the category it fits best, to come closer to the sizes")
     try:
         return parser.parse_args()
     except IOError as msg:
         parser.error(str(msg))
 
 
-def main(filelist, wcfile, outfile, sizes, categories, **args):
-    # NOTE: always round robins into remainder. Should there be an option to not do this?
+def assign(files, counts, sizes, categories, remainder="train", devlst=(), setElst=(), exclude=(), fit="roundrobin"):
+    """
+    Assigns documents to categories, each while it has room for them
+    :param files: documents, in order of distribution
+    :param counts: dictionary of document and counts
+    :param sizes: word count wanted in each category
+    :param categories: category names, matching sizes
+    :param remainder: category of everything else
+    :param devlst: documents to put in dev first
+    :param setElst: documents to put in setE first
+    :param exclude: documents that only go in the remainder
+    :param fit: 'roundrobin' (categories take turns taking the next document) or 'bestfit' (biggest documents first,
+                each into the category it fits best)
+    :return: dictionary of category and its requested size, words left and documents, in output order
+    """
     assert len(sizes) == len(categories), "Sizes and categories must be same dimension"
+    tot_count = sum(counts.values())
+    assert sum(sizes) < tot_count, f'Splits of sizes {sizes} not possible; total words= {tot_count}'
+
+    data = {}
+    for cat, size in zip(categories, sizes):
+        data[cat] = {"SIZE": size, "LEFT": size, "SET": []}
+    data[remainder] = {"SIZE": float("inf"), "LEFT": float("inf"), "SET": []}
+
+    # documents not yet assigned
+    available = set(files)
+
+    # excluded docs go straight to the remainder
+    if exclude:
+        exclude = set(exclude)
+        excluded = [doc for doc in files if doc in exclude]
+        available.difference_update(excluded)
+        data[remainder]["SET"].extend(excluded)
+        log.info(f"{len(excluded)} excluded documents put in {remainder}")
+
+    # select specified dev docids
+    if 'dev' in categories and devlst:
+        preselect_docs(available, 'dev', devlst, data['dev'], counts)
+
+    # select specified set docids
+    if 'setE' in categories and setElst:
+        preselect_docs(available, 'setE', setElst, data['setE'], counts)
+
+    files = deque(doc for doc in files if doc in available)
+    if fit == "bestfit":
+        bestfit(files, counts, data, remainder)
+    else:
+        roundrobin(files, counts, data)
+    report(data, counts, remainder)
+    return data
+
+
+def roundrobin(files, counts, data):
+    """
+    Categories take turns; each takes the next document if it has room for it
+    :param files: deque of documents, in order of distribution
+    :param counts: dictionary of document and counts
+    :param data: categories from assign, in turn order; the last, the remainder, has room for anything
+    """
+    # NOTE: always round robins into remainder. Should there be an option to not do this?
+    cats = list(data.keys())
+    # categories that could still take something, by the smallest document left (with lazy deletion)
+    active = list(range(len(cats)))
+    smallest = [counts[doc] for doc in files]
+    heapify(smallest)
+    gone = Counter()
+    turn = 0
+    while files:
+        doc = files.popleft()
+        start = bisect_left(active, turn)
+        for idx in active[start:] + active[:start]:
+            if data[cats[idx]]["LEFT"] >= counts[doc]:
+                break
+        data[cats[idx]]["SET"].append(doc)
+        data[cats[idx]]["LEFT"] -= counts[doc]
+        turn = (idx + 1) % len(cats)
+        gone[counts[doc]] += 1
+        while smallest and gone[smallest[0]] > 0:
+            gone[heappop(smallest)] -= 1
+        if smallest:
+            active = [i for i in active if data[cats[i]]["LEFT"] >= smallest[0]]
+
+
+def bestfit(files, counts, data, remainder):
+    """
+    Best-fit decreasing: biggest documents first (same-sized ones in distribution order), each into the category
+    with the least room that still fits it; the remainder takes the rest
+    :param files: documents, in order of distribution
+    :param counts: dictionary of document and counts
+    :param data: categories from assign
+    :param remainder: category of everything else
+    """
+    cats = [cat for cat in data if cat != remainder]
+    # (room left, category), kept sorted
+    rooms = sorted((data[cat]["LEFT"], idx) for idx, cat in enumerate(cats))
+    for doc in sorted(files, key=lambda doc: -counts[doc]):
+        fit = bisect_left(rooms, (counts[doc], -1))
+        if fit == len(rooms):
+            data[remainder]["SET"].append(doc)
+            data[remainder]["LEFT"] -= counts[doc]
+            continue
+        left, idx = rooms.pop(fit)
+        data[cats[idx]]["SET"].append(doc)
+        data[cats[idx]]["LEFT"] = left - counts[doc]
+        insort(rooms, (left - counts[doc], idx))
+
+
+def report(data, counts, remainder):
+    """ log the words each category got against what it asked for """
+    for cat in data:
+        words = sum(counts[doc] for doc in data[cat]["SET"])
+        if cat == remainder:
+            log.info(f"{cat}: {words} words in {len(data[cat]['SET'])} documents")
+        else:
+            log.info(f"{cat}: {words} of {data[cat]['SIZE']} words requested "
+                     f"({100.0 * words / max(data[cat]['SIZE'], 1):.1f}%; {words - data[cat]['SIZE']:+d}) "
+                     f"in {len(data[cat]['SET'])} documents")
+
+
+def main(filelist, wcfile, outfile, sizes, categories, **args):
     devlst = list()
     if args['devlstfile']:
         assert 'dev' in categories
@@ -46,47 +171,28 @@ def main(filelist, wcfile, outfile, sizes, categories, **args):
         assert 'setE' in categories
         setElst = args['setElstfile'].read().split()
 
+    exclude = list()
+    if args['excludefile']:
+        exclude = args['excludefile'].read().split()
+
     counts = {}
     for line in wcfile:
         word, count = line.strip().split('\t')
         counts[word] = int(count)
-    tot_count = sum(counts.values())
-    assert sum(sizes) < tot_count, f'Splits of sizes {sizes} not possible; total words= {tot_count}'
     files = []
     for line in filelist:
         files.append(line.strip().split()[0])
 
-    data = {}
-    for cat, size in zip(categories, sizes):
-        data[cat] = {"LEFT": size, "SET": []}
-    data[args['remainder']] = {"LEFT": float("inf"), "SET": []}
-
-    # select specified dev docids
-    if 'dev' in categories and devlst:
-        preselect_docs(files,  'dev', devlst, data['dev'], counts)
-
-    # select specified set docids
-    if 'setE' in categories and setElst:
-        preselect_docs(files,  'setE', setElst, data['setE'], counts)
-
-    for cat in cycle(list(data.keys())):
-        if len(files) == 0:
-            break
-        if data[cat]["LEFT"] >= counts[files[0]]:
-            doc = files.pop(0)
-            data[cat]["SET"].append(doc)
-            data[cat]["LEFT"] -= counts[doc]
-
+    data = assign(files, counts, sizes, categories, args['remainder'], devlst, setElst, exclude, args['fit'])
     for cat in list(data.keys()):
-        log.info("%s %f\n" % (cat, data[cat]["LEFT"]))
         for doc in data[cat]["SET"]:
             outfile.write("%s\t%s\n" % (doc, cat))
 
 
-def preselect_docs(files, cat, inp_list, cat_data, counts):
+def preselect_docs(available, cat, inp_list, cat_data, counts):
     """
     Assigns documents to a specified category
-    :param files: list of files
+    :param available: set of documents not yet assigned
     :param cat: category name such as dev or setE
     :param inp_list: list of documents to be assigned to category
     :param cat_data: shared memory to update stats of assignments
@@ -95,11 +201,11 @@ def preselect_docs(files, cat, inp_list, cat_data, counts):
     """
     added_lst = list()
     for doc in inp_list:
-        if doc in files:
+        if doc in available:
             if cat_data["LEFT"] >= counts[doc]:
                 cat_data["SET"].append(doc)
                 cat_data["LEFT"] -= counts[doc]
-                files.remove(doc)
+                available.remove(doc)
                 added_lst.append(doc)
     if len(added_lst) < len(inp_list):
         log.info(f"The word limit of {cat} is reached, {len(added_lst)} documents are added.\n "
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+In-process data selection: the ids and english original of a prefix are read once, documents are sized and ranked
+together, assigned categories by roundrobin.assign, and every flat file and manifest of the prefix is routed into the
+category directories in one pass, the way categorize.py splits a single file
+"""
+
+import os
+import os.path
+from collections import defaultdict as dd
+from concurrent.futures import ThreadPoolExecutor
+
+from lputil import mkdir_p
+from categorize import backup
+from rankdocuments import rank
+from roundrobin import assign
+
+
+def read_ids(manifest, perseg=False):
+    """ document id of each segment in a manifest (its second field, as `cut -f2` gives it), or, if the selection
+    is per segment, the segment's line number """
+    with open(manifest) as fh:
+        if perseg:
+            return [str(linenum) for linenum, line in enumerate(fh, start=1)]
+        return [line.rstrip('\n').split('\t')[1 if '\t' in line else 0].strip() for line in fh]
+
+
+def write_ids(path, ids):
+    with open(path, 'w') as fh:
+        fh.write(''.join("%s\n" % doc for doc in ids))
+
+
+def doc_stats(engfile, ids):
+    """ word count and set of lowercased words of each document (countwords.py and rankdocuments.py), in order of
+    first appearance, from one read of the english original """
+    counts = {}
+    words = dd(set)
+    with open(engfile) as fh:
+        for doc, seg in zip(ids, fh):
+            toks = seg.split()
+            counts[doc] = counts.get(doc, 0) + len(toks)
+            words[doc].update(tok.lower() for tok in toks)
+    return counts, words
+
+
+def read_cats(catfile):
+    """ document -> category of a cat file """
+    cats = {}
+    with open(catfile) as fh:
+        for line in fh:
+            doc, cat = line.strip().split('\t')
+            cats[doc] = cat
+    return cats
+
+
+def write_cats(catfile, data):
+    """ write roundrobin.assign output as a cat file; returns document -> category """
+    cats = {}
+    with open(catfile, 'w') as fh:
+        for cat in data:
+            for doc in data[cat]["SET"]:
+                fh.write("%s\t%s\n" % (doc, cat))
+                cats[doc] = cat
+    return cats
+
+
+def select(prefix, ids, counts, words, terms, sizes, categories, remainder, outdir, devlst=(), setElst=(),
+           exclude=(), fit="roundrobin"):
+    """ rank and assign the documents of a prefix, writing its ranks, counts and cats files; returns
+    document -> category """
+    ranks = rank(terms, words)
+    with open(os.path.join(outdir, "%s.ranks" % prefix), 'w') as fh:
+        for doc, score in ranks:
+            fh.write("%s\t%f\n" % (doc, score))
+    with open(os.path.join(outdir, "%s.counts" % prefix), 'w') as fh:
+        for doc, count in counts.items():
+            fh.write("%s\t%d\n" % (doc, count))
+    data = assign([doc for doc, score in ranks], counts, sizes, categories, remainder, devlst, setElst, exclude, fit)
+    return write_cats(os.path.join(outdir, "%s.cats" % prefix), data)
+
+
+def selection_files(indir, prefix, filetypes, srclang):
+    """ (path, subdirectory) of the flat files of each filetype and the manifests of a prefix """
+    ret = []
+    for filetype in filetypes:
+        if os.path.exists(os.path.join(indir, filetype)):
+            for flang in [srclang, 'eng']:
+                flatfile = os.path.join(indir, filetype, "%s.%s.%s.flat" % (prefix, filetype, flang))
+                if not (os.path.exists(flatfile)):
+                    print("***Warning: %s does not exist so not selecting" % flatfile)
+                    continue
+                ret.append((flatfile, filetype))
+    for flang in [srclang, 'eng']:
+        ret.append((os.path.join(indir, "%s.%s.manifest" % (prefix, flang)), '.'))
+    return ret
+
+
+def _route_file(infile, subdir, targets, names, outdir):
+    base = os.path.basename(infile)
+    fhs = []
+    try:
+        for name in names:
+            mkdir_p(os.path.join(outdir, name, subdir))
+            fhs.append(open(os.path.join(outdir, name, subdir, base), 'wb'))
+        with open(infile, 'rb') as ifh:
+            for target, line in zip(targets, ifh):
+                fhs[target].write(line)
+    finally:
+        for fh in fhs:
+            fh.close()
+
+
+def route(ids, cats, infiles, outdir, remainder="train", usebackup=True, threads=8):
+    """
+    Puts each line of each file in the directory of its document's category, as categorize.py does
+    :param ids: document of each line
+    :param cats: dictionary of document and category
+    :param infiles: (path, subdirectory) of the files; path goes to outdir/category/subdirectory/basename
+    :param remainder: category of lines of documents not in cats
+    :param usebackup: match documents by LDC universal document id when their full id isn't in cats
+    :param threads: files routed at once
+    :return: number of lines placed by universal document id
+    """
+    names = list(dict.fromkeys(list(cats.values()) + [remainder]))
+    index = {name: i for i, name in enumerate(names)}
+    backups = {backup(doc): cat for doc, cat in cats.items()} if usebackup else {}
+    # where each line goes, decided once for all the files
+    targets = []
+    backupcount = 0
+    for doc in ids:
+        if doc in cats:
+            targets.append(index[cats[doc]])
+        elif backup(doc) in backups:
+            targets.append(index[backups[backup(doc)]])
+            backupcount += 1
+        else:
+            targets.append(index[remainder])
+    with ThreadPoolExecutor(threads) as pool:
+        for result in [pool.submit(_route_file, infile, subdir, targets, names, outdir) for infile, subdir in infiles]:
+            result.result()
+    return backupcount
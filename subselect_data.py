@@ -5,53 +5,15 @@ import os
 import os.path
 import sys
 import logging as log
-from subprocess import check_output, STDOUT, CalledProcessError
 
 from lputil import mkdir_p
+from rankdocuments import readterms
+from selection import read_ids, write_ids, doc_stats, select, selection_files, route
 
 log.basicConfig(level=log.DEBUG)
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 
-def run_selection(prefix, idfile, engfile, termfile, categories, remainder, sizes, filetypes,
-                  srclang, indir, outdir, devlstfile=None, setElstfile=None):
-
-    """ do a data selection and apply it to a set of files """
-    rankfile = os.path.join(outdir, "%s.ranks" % prefix)
-    countfile = os.path.join(outdir, "%s.counts" % prefix)
-    catfile = os.path.join(outdir, "%s.cats" % prefix)
-    try:
-        cmd_output = check_output("%s/rankdocuments.py -i %s -d %s -t %s -o %s" %
-                                  (script_dir, engfile, idfile, termfile, rankfile), stderr=STDOUT, shell=True)
-        cmd_output = check_output("%s/countwords.py -i %s -d %s -o %s" %
-                                  (script_dir, engfile, idfile, countfile), stderr=STDOUT, shell=True)
-        roundrobin_cmd = f"{script_dir}/roundrobin.py -w {countfile} -f {rankfile} -s {sizes} -c {categories}" \
-                         f" -r {remainder} -o {catfile}"
-        if devlstfile:
-            print("receive specified dev set ids")
-            roundrobin_cmd += f' -d {devlstfile}'
-        if setElstfile:
-            roundrobin_cmd += f' -E {setElstfile}'
-        cmd_output = check_output(roundrobin_cmd, stderr=STDOUT, shell=True)
-        print(cmd_output.decode('utf-8'))
-
-        for filetype in filetypes:
-            if os.path.exists(os.path.join(indir, filetype)):
-                for flang in [srclang, 'eng']:
-                    flatfile = os.path.join(indir, filetype, "%s.%s.%s.flat" % (prefix, filetype, flang))
-                    if not (os.path.exists(flatfile)):
-                        print("***Warning: %s does not exist so not selecting" % flatfile)
-                        continue
-                    cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -P %s" % (
-                        script_dir, flatfile, idfile, catfile, outdir, filetype)
-                    print("Running " + cmd)
-                    cmd_output = check_output(cmd, stderr=STDOUT, shell=True)
-    except CalledProcessError as exc:
-        print("Status : FAIL", exc.returncode, exc.output)
-        sys.exit(1)
-    return catfile
-
-
 def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
     """ add the switches --arg and --no-arg that set parser.arg to true/false, respectively"""
     group = parser.add_mutually_exclusive_group()
@@ -60,10 +22,25 @@ def addonoffarg(parser, arg, dest=None, default=True, help="TODO"):
     group.add_argument('--no-%s' % arg, dest=dest, action='store_false', default=default, help="See --%s" % arg)
 
 
+def read_exclusions(excludefile, docprefixes, nodocprefixes):
+    """ ids of a dedup_index.py exclusion list (prefix docid linenum) per prefix: docids for document-based prefixes
+    and line numbers (the fake ids) for the others """
+    ids = {prefix: [] for prefix in docprefixes + nodocprefixes}
+    with open(excludefile) as xfh:
+        for line in xfh:
+            prefix, docid, linenum = line.rstrip('\n').split('\t')
+            if prefix in docprefixes:
+                ids[prefix].append(docid)
+            elif prefix in nodocprefixes:
+                ids[prefix].append(linenum)
+    for prefix, prefids in ids.items():
+        print("excluding %d ids of %s from held-out categories" % (len(set(prefids)), prefix))
+    return ids
+
+
 def main(args):
     indir = args.indir
     origsizes = args.sizes
-    termfile = args.termfile
 
     # TODO: find these?
     # doc = keep full docs together  (can detect this by counting number of unique docs)
@@ -81,17 +58,19 @@ def main(args):
     origpath = os.path.join(extractpath, 'original')
     outpath = os.path.join(indir, args.outdir)
     mkdir_p(outpath)
-    sf_ann_doc_ids_file = None
+    setElst = []
     if 'setE' in args.categories:
         #  annotated SF docs goes to setE
         sf_ann_doc_ids_file = os.path.join(outpath, "sf.ann.doc.ids")
         sf_ann_dir = os.path.join(indir, '../expanded/lrlp/data/annotation/situation_frame/')
-        scan_sf_ann_doc_ids(sf_ann_dir, sf_ann_doc_ids_file)
+        setElst = list(scan_sf_ann_doc_ids(sf_ann_dir, sf_ann_doc_ids_file))
+    devlst = []
+    if args.devlstfile:
+        assert 'dev' in args.categories
+        devlst = open(args.devlstfile).read().split()
+    with open(args.termfile) as fh:
+        terms = readterms(fh)
 
-    # number of words in each file
-    fullsizes = {}
-    adjsizes = {}
-    sizesum = 0.0
     for preflist in [docprefixes, nodocprefixes]:
         for prefix in list(preflist):
             # don't deal with it more if there's nothing in the manifest
@@ -99,62 +78,52 @@ def main(args):
             if (not os.path.exists(manfile)) or os.path.getsize(manfile) == 0:
                 print("removing " + prefix)
                 preflist.remove(prefix)
+    exclude = {}
+    if args.exclude:
+        exclude = read_exclusions(args.exclude, docprefixes, nodocprefixes)
+
+    # ids, number of words and words of each document, from one read of each prefix
+    ids = {}
+    stats = {}
+    fullsizes = {}
+    sizesum = 0.0
     for prefix in docprefixes + nodocprefixes:
+        manfile = os.path.join(extractpath, "%s.eng.manifest" % prefix)
+        ids[prefix] = read_ids(manfile, perseg=prefix in nodocprefixes)
+        write_ids(os.path.join(outpath, "%s.%s" % (prefix, "fakeids" if prefix in nodocprefixes else "ids")), ids[prefix])
         engfile = os.path.join(origpath, "%s.original.eng.flat" % prefix)
-        prefsize = int(check_output("wc -w %s" % engfile, shell=True).decode('utf8').strip().split(' ')[0])
-        fullsizes[prefix] = prefsize
-        sizesum += prefsize
+        stats[prefix] = doc_stats(engfile, ids[prefix])
+        fullsizes[prefix] = sum(stats[prefix][0].values())
+        sizesum += fullsizes[prefix]
     # adjust size split by proportion, with minimum
+    adjsizes = {}
     for prefix in docprefixes + nodocprefixes:
         mult = fullsizes[prefix] / sizesum
         adjsizes[prefix] = [max(args.minimum, int(mult * x)) for x in origsizes]
         print(prefix, adjsizes[prefix])
-    # doc-based processing
-    catlist = ' '.join(args.categories)
-    for prefix in docprefixes:
-        idfile = os.path.join(outpath, "%s.ids" % prefix)
-        manfile = os.path.join(extractpath, "%s.eng.manifest" % prefix)
-        try:
-            check_output("cut -f2 %s > %s" % (manfile, idfile), stderr=STDOUT, shell=True)
-        except CalledProcessError as exc:
-            print("Status : FAIL", exc.returncode, exc.output)
-        engfile = os.path.join(origpath, "%s.original.eng.flat" % prefix)
-        sizelist = ' '.join(map(str, adjsizes[prefix]))
-        catfile = run_selection(prefix, idfile, engfile, termfile, catlist, args.remainder, sizelist, filetypes,
-                                args.language, extractpath, outpath, args.devlstfile, setElstfile=sf_ann_doc_ids_file)
-        for i in (args.language, 'eng'):
-            manifest = os.path.join(extractpath, "%s.%s.manifest" % (prefix, i))
-            cmd = "%s/categorize.py -i %s -d %s -c %s -p %s" % (script_dir, manifest, idfile, catfile, outpath)
-            print("Running " + cmd)
-            check_output(cmd, stderr=STDOUT, shell=True)
-
-    # nodoc-based processing
-    for prefix in nodocprefixes:
-        idfile = os.path.join(outpath, "%s.fakeids" % prefix)
-        try:
-            mansize = int(
-                check_output("wc -l %s" % os.path.join(extractpath, "%s.eng.manifest" % prefix), shell=True).decode(
-                    'utf8').strip().split(' ')[0])
-            check_output("seq %d > %s" % (mansize, idfile), stderr=STDOUT, shell=True)
-        except CalledProcessError as exc:
-            print("Status : FAIL", exc.returncode, exc.output)
-        engfile = os.path.join(origpath, "%s.original.eng.flat" % prefix)
-        sizelist = ' '.join(map(str, adjsizes[prefix]))
-        catfile = run_selection(prefix, idfile, engfile, termfile, catlist, args.remainder, sizelist, filetypes,
-                                args.language, extractpath, outpath)
-        for i in (args.language, 'eng'):
-            manifest = os.path.join(extractpath, "%s.%s.manifest" % (prefix, i))
-            cmd = "%s/categorize.py -i %s -d %s -c %s -p %s" % (script_dir, manifest, idfile, catfile, outpath)
-            print("Running " + cmd)
-            check_output(cmd, stderr=STDOUT, shell=True)
+
+    # doc-based processing keeps documents together; nodoc-based processing selects segments
+    for prefix in docprefixes + nodocprefixes:
+        counts, words = stats[prefix]
+        if prefix in docprefixes:
+            cats = select(prefix, ids[prefix], counts, words, terms, adjsizes[prefix], args.categories, args.remainder,
+                          outpath, devlst, setElst, exclude.get(prefix, ()), args.fit)
+        else:
+            cats = select(prefix, ids[prefix], counts, words, terms, adjsizes[prefix], args.categories, args.remainder,
+                          outpath, exclude=exclude.get(prefix, ()), fit=args.fit)
+        infiles = selection_files(extractpath, prefix, filetypes, args.language)
+        print("Selecting %s into %s" % (', '.join(infile for infile, subdir in infiles), outpath))
+        backupcount = route(ids[prefix], cats, infiles, outpath, args.remainder, threads=args.threads)
+        if backupcount > 0:
+            print("{} lines of {} routed via backup retrieval".format(backupcount, prefix))
 
     # warning if entries not found in given dev list
     if args.devlstfile:
-        devlst = set(open(args.devlstfile).read().split())
-        all_docids = list()
+        devlst = set(devlst)
+        all_docids = set()
         for prefix in docprefixes:
-            all_docids += open(os.path.join(outpath, "%s.ids" % prefix)).read().split('\n')
-        for i in devlst - set(all_docids):
+            all_docids.update(ids[prefix])
+        for i in devlst - all_docids:
             print("***Warning: docid not found: %s" % i)
 
 
@@ -201,6 +170,11 @@ if __name__ == '__main__':
     parser.add_argument("--remainder", "-r", default="train", help="remainder category. Should be a new category")
     parser.add_argument("--devlstfile", "-d", default=None,
                         help="file of desired documents for dev (subject to length constraints, must be a set called 'dev')")
+    parser.add_argument("--exclude", "-x", default=None,
+                        help="exclusion list from dedup_index.py; its segments are only put in the remainder category")
+    parser.add_argument("--threads", type=int, default=8, help="files to split at once")
+    parser.add_argument("--fit", default="roundrobin", choices=["roundrobin", "bestfit"],
+                        help="how documents are assigned (see roundrobin.py --fit)")
     addonoffarg(parser, 'allperseg', help="all selection is perseg instead of default splits [e.g. il3]", default=False)
 
     try:
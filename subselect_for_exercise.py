@@ -8,20 +8,18 @@ from collections import defaultdict as dd
 import re
 import os.path
 from lputil import mkdir_p
-from subprocess import check_output, STDOUT, CalledProcessError
+from selection import read_ids, write_ids, selection_files, route
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 
 
-def runselection(prefix, idfile, categories, remainder, sizes, filetypes, srclang, indir, outdir, devlstfile=None, fromFront=True):
+def runselection(prefix, ids, categories, remainder, sizes, filetypes, srclang, indir, outdir, devlstfile=None, fromFront=True, threads=8):
   ''' do a data selection and apply it to a set of files '''
   catfile = os.path.join(outdir, "%s.cats" % prefix)
   # read docs into uniq list
   docs = []
-  with open(idfile) as fh:
-    for line in fh:
-      doc = line.strip()
-      if len(docs)==0 or doc != docs[-1]:
-        docs.append(doc)
+  for doc in ids:
+    if len(docs)==0 or doc != docs[-1]:
+      docs.append(doc)
   cats = [remainder,]*len(docs)
   currdoc = 0 if fromFront else -1
   inc = 1 if fromFront else -1
@@ -34,7 +32,7 @@ def runselection(prefix, idfile, categories, remainder, sizes, filetypes, srclan
     sys.stderr.write("not enough docs for declared categories; stopping in %s \n" % cat)
   # not the right way to handle devlst; but ok overkill i think
   if devlstfile is not None and "dev" in categories:
-    devlst = set(open(args.devlstfile).read().split())
+    devlst = set(open(devlstfile).read().split())
     for idx in range(len(docs)):
       if docs[idx] in devlst:
         cats[idx]="dev"
@@ -42,20 +40,11 @@ def runselection(prefix, idfile, categories, remainder, sizes, filetypes, srclan
     for tup in zip(docs, cats):
       fh.write("\t".join(tup)+"\n")
 
-  try:
-    for filetype in filetypes:
-      if os.path.exists(os.path.join(indir, filetype)):
-        for flang in [srclang, 'eng']:
-          flatfile = os.path.join(indir, filetype, "%s.%s.%s.flat" % (prefix, filetype, flang))
-          if not(os.path.exists(flatfile)):
-            print("***Warning: %s does not exist so not selecting" % flatfile)
-            continue
-          cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -P %s -r %s" % (scriptdir, flatfile, idfile, catfile, outdir, filetype, remainder)
-          print("Running "+cmd)
-          cmd_output=check_output(cmd, stderr=STDOUT, shell=True)
-  except CalledProcessError as exc:
-    print("Status : FAIL", exc.returncode, exc.output)
-    sys.exit(1)
+  infiles = selection_files(indir, prefix, filetypes, srclang)
+  print("Selecting %s into %s" % (', '.join(infile for infile, subdir in infiles), outdir))
+  backupcount = route(ids, dict(zip(docs, cats)), infiles, outdir, remainder, threads=threads)
+  if backupcount > 0:
+    print("{} lines of {} routed via backup retrieval".format(backupcount, prefix))
   return catfile
 
 
@@ -76,6 +65,7 @@ def main():
   parser.add_argument("--categories", "-c", nargs='+', help="list of categories. Must match sizes")
   parser.add_argument("--remainder", "-r", default="train", help="remainder category. Should be a new category")
   parser.add_argument("--devlstfile", "-d", default=None, help="file of desired documents for dev (subject to length constraints, must be a set called 'dev')")
+  parser.add_argument("--threads", type=int, default=8, help="files to split at once")
   addonoffarg(parser, 'fromFront', default=False, help="do doc assignment from the beginning (instead of the end)")
 
 
@@ -114,44 +104,21 @@ def main():
       if (not os.path.exists(manfile)) or os.path.getsize(manfile) == 0:
         print("removing "+prefix)
         preflist.remove(prefix)
-  # doc-based processing
-
-  for prefix in docprefixes:
-    idfile = os.path.join(outpath, "%s.ids" % prefix)
-    manfile = os.path.join(extractpath, "%s.eng.manifest" % prefix)
-    try:
-      check_output("cut -f2 %s > %s" % (manfile, idfile), stderr=STDOUT, shell=True)
-    except CalledProcessError as exc:
-      print("Status : FAIL", exc.returncode, exc.output)
-    catfile = runselection(prefix, idfile, args.categories, args.remainder, origsizes, filetypes, args.language, extractpath, outpath, args.devlstfile, fromFront=args.fromFront)
-    for i in (args.language, 'eng'):
-      manifest = os.path.join(extractpath, "%s.%s.manifest" % (prefix, i))
-      cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -r %s" % (scriptdir, manifest, idfile, catfile, outpath, args.remainder)
-      print("Running "+cmd)
-      check_output(cmd, stderr=STDOUT, shell=True)
-
-  # nodoc-based processing
-  for prefix in nodocprefixes:
-    idfile = os.path.join(outpath, "%s.fakeids" % prefix)
-    try:
-      mansize = int(check_output("wc -l %s" % os.path.join(extractpath, "%s.eng.manifest" % prefix), shell=True).decode('utf8').strip().split(' ')[0])
-      check_output("seq %d > %s" % (mansize, idfile), stderr=STDOUT, shell=True)
-    except CalledProcessError as exc:
-      print("Status : FAIL", exc.returncode, exc.output)
-    catfile = runselection(prefix, idfile, args.categories, args.remainder, origsizes, filetypes, args.language, extractpath, outpath, fromFront=args.fromFront)
-    for i in (args.language, 'eng'):
-      manifest = os.path.join(extractpath, "%s.%s.manifest" % (prefix, i))
-      cmd = "%s/categorize.py -i %s -d %s -c %s -p %s -r %s" % (scriptdir, manifest, idfile, catfile, outpath, args.remainder)
-      print("Running "+cmd)
-      check_output(cmd, stderr=STDOUT, shell=True)
+  # doc-based processing keeps documents together; nodoc-based processing selects segments
+  ids = {}
+  for prefix in docprefixes+nodocprefixes:
+    perseg = prefix in nodocprefixes
+    ids[prefix] = read_ids(os.path.join(extractpath, "%s.eng.manifest" % prefix), perseg=perseg)
+    write_ids(os.path.join(outpath, "%s.%s" % (prefix, "fakeids" if perseg else "ids")), ids[prefix])
+    runselection(prefix, ids[prefix], args.categories, args.remainder, origsizes, filetypes, args.language, extractpath, outpath, None if perseg else args.devlstfile, fromFront=args.fromFront, threads=args.threads)
 
   # warning if entries not found in given dev list
   if args.devlstfile:
     devlst = set(open(args.devlstfile).read().split())
-    all_docids = list()
+    all_docids = set()
     for prefix in docprefixes:
-      all_docids += open(os.path.join(outpath, "%s.ids" % prefix)).read().split('\n')
-    for i in devlst - set(all_docids):
+      all_docids.update(ids[prefix])
+    for i in devlst - all_docids:
       print ("***Warning: docid not found: %s" % i)
 
 if __name__ == '__main__':